@@ -0,0 +1,36 @@
+"""Compare two benchmark result files
+
+    python -m benchmarks.compare before.json after.json
+"""
+import json
+import sys
+
+
+def flatten(results, prefix=''):
+    """Yield (dotted name, value) for every number in results"""
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from flatten(value, name + '.')
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+
+def main(argv=None):
+    before_file, after_file = (argv or sys.argv[1:])[:2]
+    with open(before_file) as fh:
+        before = dict(flatten(json.load(fh)['results']))
+    with open(after_file) as fh:
+        after = dict(flatten(json.load(fh)['results']))
+
+    print(f"{'measurement':<40} {'before':>12} {'after':>12} {'ratio':>7}")
+    for name, old in before.items():
+        if name not in after:
+            continue
+        new = after[name]
+        ratio = f"{new / old:7.2f}" if old else "      -"
+        print(f"{name:<40} {old:>12.6g} {new:>12.6g} {ratio}")
+
+
+if __name__ == '__main__':
+    main()
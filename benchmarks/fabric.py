@@ -0,0 +1,64 @@
+"""Synthetic fabrics and drivers for the benchmarks"""
+import time
+from worchestic.matrix import Matrix
+from worchestic.signals import Source
+
+
+class LatencyDriver:
+    """A driver which takes latency seconds per command
+
+    select_many is a single command, as if the device took
+    a list of crosspoints in one message.
+    """
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.commands = 0
+
+    def select(self, input, output):
+        self.commands += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def select_many(self, crosspoints):
+        self.commands += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+def build_fabric(tiers=8, matrices=1, outputs=64, trunks=64, sources=64,
+                 latency=0):
+    """Build a fabric of tiers of matrices
+
+    Each matrix of the first tier is fed by its own sources, and each matrix
+    of a later tier by trunks outputs from every matrix of the tier
+    before it. So each matrix after the first has matrices * trunks
+    inputs, and the fan-out of each matrix is matrices * trunks of its
+    outputs.
+
+    Returns:
+        (sources, tiers) where tiers is a list of the matrices of
+        each tier, with the root tier last.
+    """
+    if tiers > 1 and matrices * trunks > outputs:
+        raise ValueError(f"{matrices} matrices x {trunks} trunks is more "
+                         f"than {outputs} outputs")
+    all_sources = []
+    fabric = []
+    previous = None
+    for tier in range(tiers):
+        current = []
+        for idx in range(matrices):
+            if previous is None:
+                inputs = [Source(f"src{idx}-{n}") for n in range(sources)]
+                all_sources.extend(inputs)
+            else:
+                inputs = [
+                    upstream.outputs[idx * trunks + n]
+                    for upstream in previous
+                    for n in range(trunks)
+                ]
+            current.append(Matrix(f"tier{tier}-{idx}", LatencyDriver(latency),
+                                  inputs, outputs))
+        fabric.append(current)
+        previous = current
+    return all_sources, fabric
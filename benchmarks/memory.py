@@ -0,0 +1,81 @@
+"""Memory used by a synthetic 64x64x8 tier fabric
+
+Run from the top of the source tree with:
+
+    python -m benchmarks.memory
+"""
+import gc
+import tracemalloc
+from worchestic.matrix import Matrix, MatrixOutput
+from worchestic.signals import Source
+from .fabric import build_fabric
+
+
+def dict_backed(kls):
+    """A subclass of kls with a __dict__, as the classes were before __slots__"""
+    return type(kls.__name__, (kls,), {})
+
+
+def allocated(factory, count=10000):
+    """Average bytes allocated by each of count calls to factory"""
+    gc.collect()
+    tracemalloc.start()
+    objs = [factory() for _ in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objs
+    return size // count
+
+
+def per_instance(matrix, source):
+    """Bytes per instance of the slotted classes and dict backed copies"""
+    factories = {
+        'MatrixOutput': lambda kls: kls(matrix, 0),
+        'Matrix.Input': lambda kls: kls(matrix, 0),
+        'Source': lambda kls: kls("example"),
+        'AvailableSource': lambda kls: kls(0, 1, source, source),
+    }
+    classes = {
+        'MatrixOutput': MatrixOutput,
+        'Matrix.Input': Matrix.Input,
+        'Source': Source,
+        'AvailableSource': Matrix.AvailableSource,
+    }
+    rv = {}
+    for name, factory in factories.items():
+        kls = classes[name]
+        unslotted = dict_backed(kls)
+        rv[name] = (allocated(lambda: factory(kls)),
+                    allocated(lambda: factory(unslotted)))
+    Source.reset_registry()
+    return rv
+
+
+def main(tiers=8, width=64):
+    Source.reset_registry()
+    gc.collect()
+    tracemalloc.start()
+    sources, fabric = build_fabric(tiers, outputs=width, trunks=width,
+                                   sources=width)
+    built, _ = tracemalloc.get_traced_memory()
+    root = fabric[-1][0]
+    for idx, source in enumerate(sources):
+        root.select(idx, source)
+    routed, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"fabric: {tiers} tiers of {width}x{width}")
+    print(f"  built:  {built / 1024:10.1f} KiB")
+    print(f"  routed: {routed / 1024:10.1f} KiB (peak {peak / 1024:.1f} KiB)")
+    sizes = per_instance(root, sources[0])
+    print(f"{'class':<16} {'slots':>6} {'dict':>6}  bytes per instance")
+    for name, (slotted, unslotted) in sizes.items():
+        print(f"{name:<16} {slotted:>6} {unslotted:>6}")
+    slotted, unslotted = sizes['MatrixOutput']
+    outputs = tiers * width
+    saving = (unslotted - slotted) * outputs
+    print(f"saving on {outputs} outputs alone: {saving / 1024:.1f} KiB")
+
+
+if __name__ == '__main__':
+    main()
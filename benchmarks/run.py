@@ -0,0 +1,204 @@
+"""Routing, availability and companion benchmarks
+
+Run from the top of the source tree, results are written as JSON:
+
+    python -m benchmarks.run --tiers 3 --matrices 4 --output before.json
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import gc
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from worchestic.fabric import FabricGraph
+from worchestic.group import SourceGroup
+from worchestic.matrix import UnroutableOutput, LockedOutput
+from worchestic.signals import Source
+from .fabric import build_fabric
+
+
+def timings(samples):
+    """Summary statistics, in seconds, of a list of timings"""
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'min': samples[0],
+        'median': statistics.median(samples),
+        'p95': samples[int(0.95 * (len(samples) - 1))],
+        'max': samples[-1],
+        'mean': statistics.fmean(samples),
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def bench_select(sources, fabric, rounds, rng):
+    """Latency of single selects on the root tier"""
+    roots = fabric[-1]
+    samples = []
+    failed = 0
+    for _ in range(rounds):
+        root = rng.choice(roots)
+        idx = rng.randrange(len(root.outputs))
+        source = rng.choice(sources)
+        start = time.perf_counter()
+        try:
+            root.select(idx, source)
+        except (UnroutableOutput, LockedOutput):
+            failed += 1
+        samples.append(time.perf_counter() - start)
+    return dict(timings(samples), failed=failed)
+
+
+def bench_salvo(sources, fabric, size, rng):
+    """Throughput of a salvo of routes sent as one batch"""
+    graph = FabricGraph(*fabric[-1], delegate=False)
+    roots = fabric[-1]
+    routes = [
+        (rng.choice(roots), rng.randrange(len(roots[0].outputs)),
+         rng.choice(sources))
+        for _ in range(size)
+    ]
+    start = time.perf_counter()
+    failed = 0
+    with graph.batch():
+        for matrix, idx, source in routes:
+            try:
+                matrix.select(idx, source)
+            except (UnroutableOutput, LockedOutput):
+                failed += 1
+    elapsed = time.perf_counter() - start
+    commands = sum(m._driver.commands for tier in fabric for m in tier)
+    return {
+        'routes': size,
+        'failed': failed,
+        'seconds': elapsed,
+        'routes_per_second': size / elapsed,
+        'driver_commands': commands,
+    }
+
+
+def bench_available(fabric, rounds):
+    """Cost of available_sources on a root matrix, cold and cached"""
+    root = fabric[-1][0]
+    cold = []
+    warm = []
+    for _ in range(rounds):
+        for tier in fabric:
+            for matrix in tier:
+                matrix._reachable = None
+        cold.append(timed(lambda: root.available_sources))
+        warm.append(timed(lambda: root.available_sources))
+    return {
+        'sources': len(root.available_sources),
+        'cold': timings(cold),
+        'warm': timings(warm),
+    }
+
+
+def bench_companions(groups, size, rounds, rng):
+    """Cost of SourceGroup.get_companions"""
+    sourcegroup = SourceGroup(**{
+        f"group{g}": [Source(f"g{g}-{n}") for n in range(size)]
+        for g in range(groups)
+    })
+    candidates = [s for grp in sourcegroup.groups.values() for s in grp]
+    samples = [
+        timed(sourcegroup.get_companions, rng.choice(candidates))
+        for _ in range(rounds)
+    ]
+    return timings(samples)
+
+
+def bench_memory(args):
+    """Memory used to build the fabric"""
+    gc.collect()
+    tracemalloc.start()
+    build_fabric(**fabric_config(args))
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'bytes': size, 'peak_bytes': peak}
+
+
+def fabric_config(args):
+    return {
+        'tiers': args.tiers,
+        'matrices': args.matrices,
+        'outputs': args.outputs,
+        'trunks': args.trunks,
+        'sources': args.sources,
+        'latency': args.latency,
+    }
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    results = {}
+
+    def fresh():
+        Source.reset_registry()
+        return build_fabric(**fabric_config(args))
+
+    results['build_seconds'] = timed(fresh)
+    results['select'] = bench_select(*fresh(), args.rounds, rng)
+    results['salvo'] = bench_salvo(*fresh(), args.salvo, rng)
+    results['available_sources'] = bench_available(fresh()[1], args.rounds)
+    results['companions'] = bench_companions(args.groups, args.group_size,
+                                             args.rounds, rng)
+    results['memory'] = bench_memory(args)
+    return {
+        'config': dict(fabric_config(args), rounds=args.rounds,
+                       salvo=args.salvo, groups=args.groups,
+                       group_size=args.group_size, seed=args.seed),
+        'python': platform.python_version(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+
+def parser():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--tiers', type=int, default=3)
+    p.add_argument('--matrices', type=int, default=4,
+                   help="matrices per tier")
+    p.add_argument('--outputs', type=int, default=16,
+                   help="outputs per matrix")
+    p.add_argument('--trunks', type=int, default=4,
+                   help="trunks from each matrix to each of the next tier")
+    p.add_argument('--sources', type=int, default=16,
+                   help="sources per first tier matrix")
+    p.add_argument('--latency', type=float, default=0,
+                   help="seconds per driver command")
+    p.add_argument('--rounds', type=int, default=200)
+    p.add_argument('--salvo', type=int, default=100,
+                   help="routes per salvo")
+    p.add_argument('--groups', type=int, default=3,
+                   help="companion groups")
+    p.add_argument('--group-size', type=int, default=500,
+                   help="sources per companion group")
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--output', help="file to write the results to")
+    return p
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
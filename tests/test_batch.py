@@ -0,0 +1,160 @@
+import asyncio
+from unittest import TestCase, IsolatedAsyncioTestCase
+from unittest.mock import Mock, AsyncMock
+from utils import make_signal
+from worchestic.matrix import Matrix
+from worchestic.group import MatrixGroup, SourceGroup
+from worchestic.batch import Batch, batch, current_batch
+from worchestic.fabric import FabricGraph
+
+
+class AsyncDriver:
+    """Records calls, and waits for the gate before completing"""
+    def __init__(self, gate=None, started=None):
+        self.calls = []
+        self.gate = gate
+        self.started = started
+
+    async def select(self, input, output):
+        self.started and self.started.set()
+        if self.gate:
+            await self.gate.wait()
+        self.calls.append((input, output))
+
+
+class BatchTests(TestCase):
+    def test_take_empties_the_batch(self):
+        b = Batch()
+        m = Mock()
+        b.queue(m, 1, 0)
+        b.queue(m, 2, 1)
+        self.assertEqual(len(b), 2)
+        self.assertEqual(b.take(), [(m, [(1, 0), (2, 1)])])
+        self.assertEqual(len(b), 0)
+
+    def test_a_driver_error_rolls_the_batch_back(self):
+        sources = [make_signal(), make_signal()]
+        m = Matrix("m", Mock(), sources, 2)
+        m._driver.select_many.side_effect = OSError("no reply")
+        with self.assertRaises(OSError):
+            with batch():
+                m.select(0, sources[1])
+                m.select(1, sources[0])
+        self.assertEqual(m._current, {})
+        self.assertEqual(m._holding, set())
+        self.assertIsNone(m.outputs[0].source)
+
+    def test_batch_works_without_a_fabric(self):
+        sources = [make_signal(), make_signal()]
+        m = Matrix("m", Mock(), sources, 2)
+        with batch():
+            m.select(0, sources[1])
+            self.assertIsNotNone(current_batch.get())
+        m._driver.select_many.assert_called_once_with([(1, 0)])
+        self.assertIsNone(current_batch.get())
+
+
+class SyncSelectOfAsyncDriverTests(TestCase):
+    def setUp(self):
+        self.sources = [make_signal(), make_signal()]
+        self.m1 = Matrix("m1", AsyncDriver(), self.sources, 2)
+        self.root_m = Matrix("root", Mock(), self.m1.outputs, 1)
+
+    def assert_unchanged(self):
+        self.assertEqual(self.m1._current, {})
+        self.assertFalse(self.m1.outputs[0].locked)
+        self.assertIsNone(self.root_m.outputs[0].source)
+
+    def test_select_raises_and_is_rolled_back(self):
+        with self.assertRaises(TypeError):
+            self.root_m.select(0, self.sources[1])
+        self.assert_unchanged()
+
+    def test_batch_raises_and_is_rolled_back(self):
+        with self.assertRaises(TypeError):
+            with batch():
+                self.root_m.select(0, self.sources[1])
+        self.assert_unchanged()
+        self.root_m._driver.select_many.assert_not_called()
+
+    def test_reading_back_raises(self):
+        driver = AsyncMock()
+        matrix = Matrix("m", driver, self.sources, 1)
+        with self.assertRaises(TypeError):
+            matrix.read_crosspoints()
+        with self.assertRaises(TypeError):
+            FabricGraph(matrix).reconcile()
+
+
+class AsyncSelectTests(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.sources1 = [make_signal("s1-0"), make_signal("s1-1")]
+        self.gate = asyncio.Event()
+        self.m1 = Matrix("m1", AsyncDriver(self.gate), self.sources1, 2)
+        # The root driver opens the gate the m1 driver waits on, so
+        # the select only completes if they are driven concurrently.
+        self.root_m = Matrix("root", AsyncDriver(started=self.gate),
+                             self.m1.outputs, 1)
+
+    async def test_matrix_aselect_drives_all_hops_concurrently(self):
+        await asyncio.wait_for(self.root_m.aselect(0, self.sources1[1]), 1)
+        self.assertEqual(self.root_m._driver.calls, [(0, 0)])
+        self.assertEqual(self.m1._driver.calls, [(1, 0)])
+        self.assertIs(self.root_m.outputs[0].source, self.sources1[1])
+
+    async def test_output_aselect_locks_the_output(self):
+        self.gate.set()
+        await self.m1.outputs[1].aselect(self.sources1[0])
+        self.assertTrue(self.m1.outputs[1].locked)
+        self.assertEqual(self.m1._driver.calls, [(0, 1)])
+
+    async def test_async_select_many_is_preferred(self):
+        driver = AsyncMock()
+        m = Matrix("m", driver, self.sources1, 2)
+        await m.aselect(0, self.sources1[1])
+        driver.select_many.assert_awaited_once_with([(1, 0)])
+
+    async def test_a_driver_error_rolls_the_select_back(self):
+        driver = AsyncMock()
+        m = Matrix("m", driver, self.sources1, 2)
+        await m.aselect(0, self.sources1[0])
+        driver.select_many.side_effect = [OSError("no reply"), None]
+        with self.assertRaises(OSError):
+            await m.aselect(0, self.sources1[1])
+        self.assertEqual(m._current, {0: 0})
+        self.assertIs(m.outputs[0].source, self.sources1[0])
+        self.assertEqual(m._holding, {0})
+        # The crosspoint replaced is sent again
+        driver.select_many.assert_awaited_with([(0, 0)])
+
+    async def test_a_driver_error_upstream_frees_the_trunk(self):
+        self.m1._driver = AsyncMock()
+        self.m1._driver.select_many.side_effect = OSError("no reply")
+        with self.assertRaises(OSError):
+            await self.root_m.aselect(0, self.sources1[1])
+        self.assertEqual(self.root_m._current, {})
+        self.assertEqual(self.m1._current, {})
+        self.assertFalse(self.m1.outputs[0].locked)
+        self.assertIsNone(self.root_m.outputs[0].source)
+
+    async def test_sync_drivers_run_in_the_executor(self):
+        driver = Mock(spec=["select"])
+        m = Matrix("m", driver, self.sources1, 2)
+        await m.aselect(1, self.sources1[0])
+        driver.select.assert_called_once_with(0, 1)
+
+
+class AsyncGroupSelectTests(IsolatedAsyncioTestCase):
+    async def test_companions_are_driven_concurrently(self):
+        video = [make_signal(), make_signal()]
+        usb = [make_signal(), make_signal()]
+        gate = asyncio.Event()
+        mat_video = Matrix("video", AsyncDriver(gate), video, 1)
+        mat_usb = Matrix("usb", AsyncDriver(started=gate), usb, 1)
+        for hid in usb:
+            hid.preferred_out = mat_usb.outputs[0]
+        group = MatrixGroup(SourceGroup(video=video, usb=usb),
+                            video=mat_video, usb=mat_usb)
+        await asyncio.wait_for(group.aselect("video", 0, video[1]), 1)
+        self.assertEqual(mat_video._driver.calls, [(1, 0)])
+        self.assertEqual(mat_usb._driver.calls, [(1, 0)])
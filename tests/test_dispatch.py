@@ -0,0 +1,94 @@
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import Mock
+from utils import make_signal
+from worchestic.matrix import Matrix
+from worchestic.batch import batch
+from worchestic.dispatch import DriverDispatcher, waiting_for_drivers, track
+
+
+class BlockingDriver:
+    def __init__(self, delay=0, wait_for=None, signal=None):
+        self.calls = []
+        self.delay = delay
+        self.wait_for = wait_for
+        self.signal = signal
+        self.unblocked = None
+
+    def select(self, input, output):
+        if self.signal:
+            self.signal.set()
+        if self.wait_for:
+            self.unblocked = self.wait_for.wait(1)
+        time.sleep(self.delay)
+        self.calls.append((input, output))
+
+
+class ThreadedDriverTests(TestCase):
+    def setUp(self):
+        self.dispatcher = DriverDispatcher(max_workers=4)
+
+    def tearDown(self):
+        self.dispatcher.shutdown()
+
+    def test_commands_for_one_driver_keep_their_order(self):
+        inner = BlockingDriver(delay=0.001)
+        driver = self.dispatcher.wrap(inner)
+        futures = [driver.select(i, 0) for i in range(20)]
+        for f in futures:
+            f.result(1)
+        self.assertEqual(inner.calls, [(i, 0) for i in range(20)])
+
+    def test_different_drivers_run_in_parallel(self):
+        event = threading.Event()
+        waiting = BlockingDriver(wait_for=event)
+        signalling = BlockingDriver(signal=event)
+        f1 = self.dispatcher.wrap(waiting).select(0, 0)
+        f2 = self.dispatcher.wrap(signalling).select(0, 0)
+        f1.result(2)
+        f2.result(2)
+        self.assertTrue(waiting.unblocked)
+
+    def test_select_many_falls_back_to_select(self):
+        inner = BlockingDriver()
+        self.dispatcher.wrap(inner).select_many([(0, 1), (1, 0)]).result(1)
+        self.assertEqual(inner.calls, [(0, 1), (1, 0)])
+
+    def test_crosspoints_are_read_after_queued_commands(self):
+        inner = BlockingDriver(delay=0.05)
+        inner.read_crosspoints = lambda: list(inner.calls)
+        driver = self.dispatcher.wrap(inner)
+        driver.select(0, 1)
+        self.assertEqual(driver.read_crosspoints().result(1), [(0, 1)])
+
+    def test_driver_errors_are_raised_at_the_end_of_the_block(self):
+        inner = Mock()
+        inner.select.side_effect = IOError("device gone")
+        driver = self.dispatcher.wrap(inner)
+        with self.assertRaises(IOError):
+            with waiting_for_drivers():
+                track(driver.select(0, 0))
+
+    def test_matrix_waits_once_at_the_end_of_a_multi_hop_route(self):
+        # The leaf command can only complete if the root command
+        # has been issued without waiting for it.
+        event = threading.Event()
+        leaf = BlockingDriver(wait_for=event)
+        root = BlockingDriver(signal=event)
+        sources = [make_signal(), make_signal()]
+        m1 = Matrix("m1", self.dispatcher.wrap(leaf), sources, 2)
+        root_m = Matrix("root", self.dispatcher.wrap(root), m1.outputs, 1)
+        root_m.select(0, sources[1])
+        self.assertTrue(leaf.unblocked)
+        self.assertEqual(leaf.calls, [(1, 0)])
+        self.assertEqual(root.calls, [(0, 0)])
+
+    def test_batches_wait_for_threaded_drivers(self):
+        inner = BlockingDriver(delay=0.01)
+        sources = [make_signal(), make_signal()]
+        m1 = Matrix("m1", self.dispatcher.wrap(inner), sources, 2)
+        with batch():
+            m1.select(0, sources[1])
+            m1.select(1, sources[0])
+        self.assertEqual(inner.calls, [(1, 0), (0, 1)])
@@ -0,0 +1,201 @@
+import asyncio
+from unittest import TestCase
+from unittest.mock import Mock
+from utils import make_signal
+from worchestic.matrix import Matrix, ShortestPathRouter, scarce_trunk_cost
+from worchestic.group import MatrixGroup, SourceGroup
+from worchestic.fabric import FabricGraph
+
+
+class FabricGraphTests(TestCase):
+    def setUp(self):
+        self.sources1 = [make_signal("s1-0"), make_signal("s1-1"), make_signal("s1-2")]
+        self.m1 = Matrix("m1", Mock(), self.sources1, 2)
+        self.sources2 = [self.sources1[1], make_signal("s2-0")]
+        self.m2 = Matrix("m2", Mock(), self.sources2, 2)
+        self.root_m = Matrix("root", Mock(),
+                             self.m1.outputs + self.m2.outputs, 3)
+        self.fabric = FabricGraph(self.root_m)
+
+    def test_registering_a_matrix_registers_upstream_matrices(self):
+        self.assertSetEqual(set(self.fabric.matrices),
+                            {self.root_m, self.m1, self.m2})
+
+    def test_compiled_adjacency_has_a_slot_per_input(self):
+        self.fabric.compile()
+        self.assertEqual(self.fabric.offsets[-1], 3 + 2 + 4)
+        root = self.fabric.matrices.index(self.root_m)
+        kinds = [self.fabric.kinds[s] for s in self.fabric._slots(root)]
+        self.assertEqual(kinds, [FabricGraph.TRUNK] * 4)
+
+    def test_reachable_matches_available_sources(self):
+        self.assertSetEqual(self.fabric.reachable(self.root_m),
+                            self.root_m.available_sources)
+
+    def test_reachable_stops_at_locked_trunks(self):
+        self.root_m.select(0, self.sources1[0])
+        self.root_m.select(1, self.sources1[1])
+        self.assertSetEqual(self.fabric.reachable(self.root_m),
+                            self.root_m.available_sources)
+
+    def test_route_matches_the_shortest_path_router(self):
+        self.root_m.select(0, self.sources1[0])
+        for source in self.sources1 + self.sources2:
+            expected = ShortestPathRouter().route(self.root_m, source)
+            self.assertEqual(self.fabric.route(self.root_m, source), expected)
+
+    def test_routes_share_the_cache_of_the_matrices(self):
+        self.assertIs(self.fabric.router, Matrix.router)
+        fabric = FabricGraph(self.root_m, cost=scarce_trunk_cost)
+        self.assertIs(fabric.router.cost, scarce_trunk_cost)
+        self.assertEqual(fabric.router.cache_size, 0)
+
+    def test_matrices_delegate_routing_to_the_graph(self):
+        self.assertIs(self.root_m.router, self.fabric)
+        self.root_m.select(0, self.sources1[1])
+        self.root_m._driver.select.assert_called_with(0, 0)
+        self.m1._driver.select.assert_called_with(1, 0)
+
+    def test_trunk_usage_counts_claimed_trunks(self):
+        self.root_m.select(0, self.sources1[0])
+        usage = self.fabric.trunk_usage()
+        self.assertEqual(usage[self.m1], (1, 2))
+        self.assertEqual(usage[self.m2], (0, 2))
+
+    def test_replug_recompiles_and_registers_new_matrices(self):
+        self.fabric.compile()
+        x1_sources = [make_signal("x1-0")]
+        x1 = Matrix("x1", Mock(), x1_sources, 1)
+        self.m2.replug_input(1, x1.outputs[0])
+        self.assertFalse(self.fabric._compiled)
+        self.assertIn(x1_sources[0], self.fabric.reachable(self.root_m))
+        self.assertIn(x1, self.fabric.matrices)
+
+
+class FabricGraphGroupTests(TestCase):
+    def test_register_group_registers_all_matrices(self):
+        video = [make_signal(), make_signal()]
+        usb = [make_signal(), make_signal()]
+        mat_video = Matrix("video", Mock(), video, 1)
+        mat_usb = Matrix("usb", Mock(), usb, 1)
+        group = MatrixGroup(SourceGroup(video=video, usb=usb),
+                            video=mat_video, usb=mat_usb)
+        fabric = FabricGraph()
+        fabric.register_group(group)
+        self.assertSetEqual(set(fabric.matrices), {mat_video, mat_usb})
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        self.sources1 = [make_signal("s1-0"), make_signal("s1-1"), make_signal("s1-2")]
+        self.m1 = Matrix("m1", Mock(), self.sources1, 2)
+        self.sources2 = [make_signal("s2-0"), make_signal("s2-1")]
+        self.m2 = Matrix("m2", Mock(), self.sources2, 2)
+        self.root_m = Matrix("root", Mock(),
+                             self.m1.outputs + self.m2.outputs, 3)
+        self.fabric = FabricGraph(self.root_m)
+
+    def test_batched_selects_are_sent_with_select_many(self):
+        with self.fabric.batch():
+            self.root_m.select(0, self.sources1[0])
+            self.root_m.select(1, self.sources2[1])
+            self.root_m._driver.select.assert_not_called()
+        self.root_m._driver.select.assert_not_called()
+        self.root_m._driver.select_many.assert_called_once_with([(0, 0), (2, 1)])
+        self.m1._driver.select_many.assert_called_once_with([(0, 0)])
+        self.m2._driver.select_many.assert_called_once_with([(1, 0)])
+
+    def test_batch_keeps_only_the_last_crosspoint_per_output(self):
+        with self.fabric.batch():
+            self.root_m.select(0, self.sources1[0])
+            self.root_m.select(0, self.sources1[1])
+        self.root_m._driver.select_many.assert_called_once_with([(0, 0)])
+        self.m1._driver.select_many.assert_called_once_with([(1, 0)])
+
+    def test_routing_state_is_updated_during_the_batch(self):
+        with self.fabric.batch():
+            self.root_m.select(0, self.sources1[0])
+            self.assertTrue(self.m1.outputs[0].locked)
+            self.assertIs(self.root_m.outputs[0].source, self.sources1[0])
+
+    def test_nested_batches_commit_once(self):
+        with self.fabric.batch() as outer:
+            with self.fabric.batch() as inner:
+                self.root_m.select(0, self.sources1[0])
+            self.assertIs(inner, outer)
+            self.root_m._driver.select_many.assert_not_called()
+        self.root_m._driver.select_many.assert_called_once()
+
+    def test_batch_falls_back_to_select_for_simple_drivers(self):
+        class Driver:
+            def __init__(self):
+                self.calls = []
+
+            def select(self, input, output):
+                self.calls.append((input, output))
+
+        self.m2._driver = Driver()
+        self.fabric.salvo([(self.root_m, 0, self.sources2[0]),
+                           (self.root_m, 1, self.sources2[1])])
+        self.assertEqual(self.m2._driver.calls, [(0, 0), (1, 1)])
+
+    def test_queued_commands_are_sent_if_the_batch_raises(self):
+        with self.assertRaises(RuntimeError):
+            with self.fabric.batch():
+                self.root_m.select(0, self.sources1[0])
+                raise RuntimeError()
+        self.root_m._driver.select_many.assert_called_once_with([(0, 0)])
+        self.assertIsNone(self.fabric.current_batch)
+
+
+class ReadbackDriver:
+    """A driver which remembers its crosspoints, like the hardware"""
+    def __init__(self):
+        self.crosspoints = {}
+        self.commands = []
+
+    def select(self, input, output):
+        self.commands.append((input, output))
+        self.crosspoints[output] = input
+
+    def read_crosspoints(self):
+        return dict(self.crosspoints)
+
+
+class ReconcileTests(TestCase):
+    def setUp(self):
+        self.sources = [make_signal("s0"), make_signal("s1"), make_signal("s2")]
+        self.m1 = Matrix("m1", ReadbackDriver(), self.sources, 2)
+        self.root_m = Matrix("root", ReadbackDriver(),
+                             self.m1.outputs + [make_signal("r0")], 2)
+        self.fabric = FabricGraph(self.root_m)
+        self.root_m.select(0, self.sources[0])
+        self.root_m.select(1, self.sources[2])
+        for matrix in self.fabric.matrices:
+            matrix._driver.commands = []
+
+    def test_matching_hardware_needs_no_commands(self):
+        self.assertEqual(self.fabric.reconcile(), {})
+        self.assertEqual(self.m1._driver.commands, [])
+
+    def test_only_differing_crosspoints_are_driven(self):
+        self.m1._driver.crosspoints = {0: 2}
+        self.root_m._driver.crosspoints.pop(1)
+        driven = self.fabric.reconcile()
+        self.assertEqual(driven, {self.m1: [(0, 0), (2, 1)],
+                                  self.root_m: [(1, 1)]})
+        self.assertEqual(self.m1._driver.crosspoints,
+                         {o: i for o, i in self.m1._current.items()})
+
+    def test_drivers_without_readback_are_fully_driven(self):
+        driver = Mock(spec=['select', 'select_many'])
+        self.m1._driver = driver
+        driven = self.fabric.reconcile()
+        self.assertEqual(driven, {self.m1: [(0, 0), (2, 1)]})
+        driver.select_many.assert_called_once_with([(0, 0), (2, 1)])
+
+    def test_areconcile(self):
+        self.root_m._driver.crosspoints = {}
+        driven = asyncio.run(self.fabric.areconcile())
+        self.assertEqual(driven, {self.root_m: [(0, 0), (1, 1)]})
+        self.assertEqual(self.root_m._driver.crosspoints, {0: 0, 1: 1})
@@ -26,6 +26,26 @@ class SourceGroupTest(TestCase):
     def test_none_values_are_not_valid_companions(self):
         self.assertEqual(len(self.signal_group.get_companions(self.usb[2])),0)
 
+    def test_added_groups_provide_companions(self):
+        audio = [make_signal(), make_signal()]
+        self.signal_group.add_group('audio', audio)
+        self.assertSetEqual(self.signal_group.get_companions(self.usb[1]),
+                            {self.video[1], audio[1]})
+        self.assertSetEqual(self.signal_group.get_companions(audio[0]),
+                            {self.video[0], self.video[2], self.usb[0]})
+
+    def test_add_group_can_set_the_preferred_output(self):
+        audio = [make_signal(), None]
+        output = Mock()
+        self.signal_group.add_group('audio', audio, preferred_out=output)
+        self.assertIs(audio[0].preferred_out, output)
+
+    def test_removed_groups_no_longer_provide_companions(self):
+        self.signal_group.remove_group('usb')
+        self.assertSetEqual(self.signal_group.get_companions(self.video[0]),
+                            {self.video[2]})
+        self.assertEqual(self.signal_group.get_companions(self.usb[0]), set())
+
 class SingalGroupInitTests(TestCase):
     def test_assign_out_set_preferred_ouptut(self):
         self.video = [make_signal(), make_signal(), make_signal(), make_signal()]
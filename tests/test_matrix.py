@@ -1,13 +1,25 @@
+import gc
+import logging
+import threading
+import time
+import weakref
 from unittest import TestCase, skip
-from unittest.mock import Mock
+from unittest.mock import Mock, patch, call
 from worchestic.matrix import (
     Matrix,
     MatrixOutput,
+    MatrixDriver,
     LockedOutput,
+    UnroutableOutput,
     AlreadyUnlocked,
+    ShortestPathRouter,
+    scarce_trunk_cost,
+    propagation,
 )
 
-from utils import make_signal
+from worchestic.fabric import FabricGraph
+from worchestic.signals import Source, SourceRegistry
+from utils import make_signal, state_of
 
 
 class MatrixOutputTests(TestCase):
@@ -66,6 +78,17 @@ class MatrixOutputTests(TestCase):
         with self.assertRaises(AlreadyUnlocked):
             self.o.release()
 
+    def test_outputs_have_no_instance_dict(self):
+        self.assertFalse(hasattr(self.o, '__dict__'))
+
+
+class MatrixDriverTests(TestCase):
+    def test_select_many_defaults_to_calling_select_in_order(self):
+        driver = MatrixDriver()
+        driver.select = Mock()
+        driver.select_many([(0, 1), (2, 0)])
+        self.assertEqual(driver.select.call_args_list, [((0, 1),), ((2, 0),)])
+
 
 class SimpleMatrixTests(TestCase):
     def setUp(self):
@@ -226,6 +249,27 @@ class ThreeLevelMatrixTests(TestCase):
                 sum(1 for o in self.m1.outputs if o.locked)
         )
 
+    def test_reusing_a_released_trunk_reclaims_its_upstream(self):
+        self.root_m.select(0, self.sources1[0])
+        self.root_m.select(0, self.sources3[0])
+        self.root_m.select(1, self.sources1[1])
+        self.assertEqual(self.root_m.outputs[1].source, self.sources1[1])
+        self.assertEqual(
+                1,
+                sum(o._sem.load() for o in self.m1.outputs)
+        )
+
+    def test_releasing_a_shared_trunk_keeps_its_upstream_claimed(self):
+        self.root_m.select(0, self.sources1[0])
+        self.root_m.select(1, self.sources1[0])
+        shared = self.root_m.inputs[self.root_m._current[0]]
+        self.assertEqual(shared._sem.load(), 2)
+        self.root_m.select(0, self.sources3[0])
+        self.assertEqual(
+                1,
+                sum(1 for o in self.m1.outputs if o.locked)
+        )
+
     def test_updating_a_selected_input_source_cascades_to_the_output(self,):
         self.root_m.select(0, self.sources1[0])
         self.assertEqual(self.root_m.outputs[0].uuid, self.sources1[0].uuid)
@@ -266,3 +310,569 @@ class ThreeLevelMatrixTests(TestCase):
         x1.select(0, sources_x1[0])
         self.n1.replug_input(len(self.m1.outputs), x1.outputs[0])
         self.assertEqual(self.root_m.outputs[1].source, sources_x1[0])
+
+
+class ReachabilityIndexTests(TestCase):
+    def setUp(self):
+        self.sources1 = [make_signal("s1-0"), make_signal("s1-1")]
+        self.m1 = Matrix("m1", Mock(), self.sources1, 2)
+        self.n1 = Matrix("n1", Mock(), self.m1.outputs, 2)
+        self.root_m = Matrix("root", Mock(), self.n1.outputs, 1)
+
+    def test_index_is_reused_between_lookups(self):
+        self.root_m.available_sources
+        with patch.object(self.root_m, "_walk_sources") as walk:
+            self.root_m.available_sources
+            list(self.root_m.iter_sources())
+        walk.assert_not_called()
+
+    def test_walking_sources_skips_disabled_debug_logging(self):
+        with patch("worchestic.matrix.logger.isEnabledFor", return_value=False), \
+             patch("worchestic.matrix.logger.debug") as debug:
+            self.root_m.available_sources
+        debug.assert_not_called()
+
+    def test_routes_to_lists_only_routes_for_the_source(self):
+        routes = self.root_m.routes_to(self.sources1[0])
+        # The cheapest route through each input of the root
+        self.assertEqual(len(routes), 2)
+        self.assertTrue(all(r.source is self.sources1[0] for r in routes))
+
+    def test_replug_upstream_invalidates_downstream_index(self):
+        self.root_m.available_sources
+        new_source = make_signal("new")
+        self.m1.replug_input(0, new_source)
+        self.assertIsNone(self.n1._reachable)
+        self.assertIsNone(self.root_m._reachable)
+        self.assertIn(new_source, self.root_m.available_sources)
+
+    def test_claiming_a_trunk_only_invalidates_downstream(self):
+        self.root_m.available_sources
+        self.n1.outputs[0].claim()
+        self.assertIsNotNone(self.m1._reachable)
+        self.assertIsNotNone(self.n1._reachable)
+        self.assertIsNone(self.root_m._reachable)
+
+    def test_locked_trunks_are_reflected_after_select(self):
+        self.root_m.select(0, self.sources1[0])
+        routes = self.root_m.routes_to(self.sources1[0])
+        self.assertEqual([r.path_len for r in routes], [0, 1])
+
+
+class SourceQueryTests(TestCase):
+    def setUp(self):
+        self.sources1 = [make_signal("s1-0"), make_signal("s1-1")]
+        self.m1 = Matrix("m1", Mock(), self.sources1, 2)
+        self.near = make_signal("near")
+        self.n1 = Matrix("n1", Mock(), [self.near] + self.m1.outputs, 2)
+        self.root_m = Matrix("root", Mock(), self.n1.outputs, 2)
+
+    def test_query_matches_iter_sources(self):
+        # iter_sources keeps only the cheapest of the routes queried
+        cheapest = {}
+        for r in self.root_m.query_sources():
+            key = r.input_idx, r.source
+            cheapest[key] = min(cheapest.get(key, r.path_len), r.path_len)
+        self.assertEqual(
+            cheapest,
+            {(r.input_idx, r.source): r.path_len for r in self.root_m.iter_sources()})
+
+    def test_the_index_keeps_one_route_per_input_and_source(self):
+        routes = list(self.root_m.iter_sources())
+        self.assertEqual(len(routes), 6)
+        self.assertEqual(len({(r.input_idx, r.source) for r in routes}), 6)
+
+    def test_query_does_not_build_the_index(self):
+        list(self.root_m.query_sources())
+        self.assertIsNone(self.root_m._reachable)
+        self.assertIsNone(self.m1._reachable)
+
+    def test_is_available_stops_at_the_first_route(self):
+        with patch.object(self.m1, "_stream_sources") as walk:
+            self.assertTrue(self.root_m.is_available(self.near))
+        walk.assert_not_called()
+        self.assertFalse(self.root_m.is_available(make_signal("other")))
+
+    def test_is_available_asks_the_router(self):
+        with patch.object(self.root_m.router, "route",
+                          wraps=self.root_m.router.route) as route:
+            self.assertTrue(self.root_m.is_available(self.sources1[1]))
+        route.assert_called_once_with(self.root_m, self.sources1[1])
+        self.assertIsNone(self.root_m._reachable)
+
+    def test_max_path_len_prunes_the_walk(self):
+        with patch.object(self.m1, "_stream_sources") as walk:
+            self.assertEqual(list(self.root_m.query_sources(max_path_len=1)), [])
+        walk.assert_not_called()
+        routes = list(self.root_m.query_sources(max_path_len=2))
+        self.assertEqual({r.source for r in routes}, {self.near})
+
+    def test_unique_yields_one_route_per_source(self):
+        routes = list(self.root_m.query_sources(unique=True))
+        self.assertEqual([r.source for r in routes],
+                         [self.near] + self.sources1)
+        self.assertEqual(len(list(self.root_m.query_sources(self.near))), 2)
+
+    def test_exclude_locked_skips_claimed_trunks(self):
+        self.root_m.select(0, self.sources1[0])
+        sources = {r.source for r in self.root_m.query_sources()}
+        self.assertIn(self.sources1[0], sources)
+        free = list(self.root_m.query_sources(exclude_locked=True))
+        self.assertTrue(free)
+        self.assertTrue(all(r.input_idx == 1 for r in free))
+
+    def test_available_sources_is_kept_with_the_index(self):
+        available = self.root_m.available_sources
+        self.assertIs(self.root_m.available_sources, available)
+        self.m1.replug_input(0, make_signal("new"))
+        self.assertIsNot(self.root_m.available_sources, available)
+
+
+class RollbackTests(TestCase):
+    def setUp(self):
+        self.sources = [make_signal("s0"), make_signal("s1"), make_signal("s2")]
+        self.m1 = Matrix("m1", Mock(), self.sources, 2)
+        self.root_m = Matrix("root", Mock(), self.m1.outputs, 2)
+        self.root_m.select(0, self.sources[0])
+        self.before = self.state()
+
+    def state(self):
+        return state_of([self.m1, self.root_m])
+
+    def test_a_driver_error_upstream_rolls_back_the_route(self):
+        self.m1._driver.select.side_effect = IOError("no reply")
+        with self.assertRaises(IOError):
+            self.root_m.select(0, self.sources[1])
+        self.assertEqual(self.state(), self.before)
+
+    def test_crosspoints_driven_before_the_error_are_restored(self):
+        self.root_m._driver.select.side_effect = IOError("no reply")
+        with self.assertRaises(IOError):
+            self.root_m.select(0, self.sources[1])
+        self.assertEqual(self.state(), self.before)
+        m1_calls = self.m1._driver.select.call_args_list
+        self.assertEqual(m1_calls[-1], call(0, 0))
+
+    def test_a_failed_salvo_leaves_earlier_routes_as_they_were(self):
+        fabric = FabricGraph(self.root_m)
+        self.root_m._driver.select_many.side_effect = IOError("no reply")
+        with self.assertRaises(IOError):
+            fabric.salvo([(self.root_m, 1, self.sources[2]),
+                          (self.root_m, 0, self.sources[1])])
+        self.assertEqual(self.state(), self.before)
+        self.assertIsNone(self.root_m.outputs[1].source)
+
+    def test_routing_works_after_a_rollback(self):
+        self.m1._driver.select.side_effect = IOError("no reply")
+        with self.assertRaises(IOError):
+            self.root_m.select(1, self.sources[1])
+        self.m1._driver.select.side_effect = None
+        self.root_m.select(1, self.sources[1])
+        self.assertIs(self.root_m.outputs[1].source, self.sources[1])
+        self.assertIs(self.root_m.outputs[0].source, self.sources[0])
+
+    def test_rolling_back_an_unroutable_select_is_not_a_warning(self):
+        with self.assertLogs('worchestic.matrix', 'DEBUG') as logs:
+            with self.assertRaises(UnroutableOutput):
+                with self.root_m.route_lock():
+                    self.root_m.select(1, self.sources[1])
+                    self.root_m.select(1, make_signal("unplugged"))
+        self.assertEqual(
+            [r.getMessage() for r in logs.records if r.levelno >= logging.WARNING],
+            [])
+        self.assertEqual(self.state(), self.before)
+
+
+class TrunkSharingTests(TestCase):
+    def setUp(self):
+        self.sources = [make_signal("s0"), make_signal("s1")]
+        self.direct = make_signal("direct")
+        self.m1 = Matrix("m1", Mock(), self.sources, 2)
+        self.root_m = Matrix("root", Mock(), self.m1.outputs + [self.direct], 3)
+
+    def test_fan_out_shares_one_trunk(self):
+        self.root_m.select(0, self.sources[0])
+        self.root_m.select(1, self.sources[0])
+        self.assertEqual(self.m1.outputs[0]._sem.load(), 2)
+        self.assertFalse(self.m1.outputs[1].locked)
+        self.m1._driver.select.assert_called_once_with(0, 0)
+
+    def test_shared_trunk_is_freed_by_its_last_user(self):
+        self.root_m.select(0, self.sources[0])
+        self.root_m.select(1, self.sources[0])
+        self.root_m.select(0, self.direct)
+        self.assertEqual(self.m1.outputs[0]._sem.load(), 1)
+        self.assertIn(0, self.m1._holding)
+        self.root_m.select(1, self.direct)
+        self.assertFalse(self.m1.outputs[0].locked)
+        self.assertNotIn(0, self.m1._holding)
+
+    def test_the_default_cached_router_reuses_trunks(self):
+        self.assertGreater(Matrix.router.cache_size, 0)
+        self.root_m.select(0, self.sources[0])
+        self.root_m.select(0, self.direct)
+        # Same locks as when the route to sources[0] was cached, but
+        # now the other trunk carries it
+        self.m1.select(0, self.sources[1])
+        self.m1.select(1, self.sources[0])
+        self.m1._driver.select.reset_mock()
+        self.root_m.select(1, self.sources[0])
+        self.assertEqual(self.root_m._current[1], 1)
+        self.m1._driver.select.assert_not_called()
+
+    def test_released_trunk_still_carrying_the_source_is_reused(self):
+        self.root_m.select(0, self.sources[0])
+        self.root_m.select(0, self.direct)
+        self.m1._driver.select.reset_mock()
+        self.root_m.select(1, self.sources[0])
+        self.m1._driver.select.assert_not_called()
+        self.assertEqual(self.root_m._current[1], 0)
+        self.assertTrue(self.m1.outputs[0].locked)
+
+    def test_reselecting_a_released_output_doesnt_drive(self):
+        self.m1.select(0, self.sources[1])
+        self.m1.release(0)
+        self.m1._driver.select.reset_mock()
+        self.m1.select(0, self.sources[1])
+        self.m1._driver.select.assert_not_called()
+        self.assertIn(0, self.m1._holding)
+
+
+class ReleaseTests(TestCase):
+    def setUp(self):
+        self.sources = [make_signal("r0"), make_signal("r1")]
+        self.leaf = Matrix("leaf", Mock(), self.sources, 2)
+        self.root_m = Matrix("root", Mock(), self.leaf.outputs, 2)
+
+    def trunk(self):
+        return self.root_m.inputs[self.root_m._current[0]]
+
+    def test_the_route_is_freed_by_the_last_user(self):
+        output = self.root_m.outputs[0]
+        output.select(self.sources[0])
+        output.claim()
+        output.release()
+        self.assertTrue(self.trunk().locked)
+        self.assertTrue(self.root_m._routed(0))
+        output.release()
+        self.assertFalse(self.trunk().locked)
+        self.assertFalse(self.root_m._routed(0))
+
+    def test_an_output_only_releases_its_input_once(self):
+        self.root_m.select(0, self.sources[0])
+        self.root_m.select(1, self.sources[0])
+        trunk = self.trunk()
+        self.assertEqual(trunk._sem.load(), 2)
+        self.root_m.release(0)
+        self.root_m.release(0)
+        self.assertEqual(trunk._sem.load(), 1)
+
+    def test_selecting_a_released_output_claims_its_input_again(self):
+        output = self.root_m.outputs[0]
+        output.select(self.sources[0])
+        output.release()
+        self.assertIs(output.source, self.sources[0])
+        output.select(self.sources[0])
+        self.assertTrue(self.root_m._routed(0))
+        self.assertTrue(self.trunk().locked)
+
+
+class ShortestPathRouterTests(TestCase):
+    def setUp(self):
+        self.sources1 = [make_signal("s1-0"), make_signal("s1-1")]
+        self.m1 = Matrix("m1", Mock(), self.sources1, 2)
+        self.sources2 = [self.sources1[1], make_signal("s2-0")]
+        self.m2 = Matrix("m2", Mock(), self.sources2, 2)
+        self.root_m = Matrix("root", Mock(),
+                             self.m1.outputs + self.m2.outputs, 2)
+
+    def test_route_returns_first_hop_of_the_shortest_route(self):
+        route = ShortestPathRouter().route(self.root_m, self.sources1[1])
+        self.assertEqual(route.input_idx, 0)
+        self.assertIs(route.path, self.m1.outputs[0])
+        self.assertEqual(route.path_len, 2)
+
+    def test_route_prefers_a_claimed_trunk_carrying_the_source(self):
+        self.root_m.select(0, self.sources2[1])
+        route = ShortestPathRouter().route(self.root_m, self.sources2[1])
+        self.assertEqual(route.path_len, 0)
+        self.assertEqual(route.input_idx, 2)
+
+    def test_route_is_none_for_unreachable_sources(self):
+        self.assertIsNone(ShortestPathRouter().route(self.root_m,
+                                                     make_signal()))
+
+    def test_search_stops_at_the_first_route(self):
+        cost = Mock(return_value=1)
+        ShortestPathRouter(cost).route(self.root_m, self.sources1[0])
+        # m2 is never expanded, as m1 reaches the source first.
+        self.assertNotIn(self.m2, [c.args[0] for c in cost.call_args_list])
+
+    def test_cost_function_can_exclude_inputs(self):
+        def no_m1(matrix, idx, inp):
+            return None if inp in self.m1.outputs else 1
+        route = ShortestPathRouter(no_m1).route(self.root_m, self.sources1[1])
+        self.assertIs(route.path, self.m2.outputs[0])
+
+    def test_matrix_uses_its_router_for_select(self):
+        def no_m1(matrix, idx, inp):
+            return None if inp in self.m1.outputs else 1
+        root_m = Matrix("root2", Mock(), self.m1.outputs + self.m2.outputs, 1,
+                        router=ShortestPathRouter(no_m1))
+        root_m.select(0, self.sources1[1])
+        root_m._driver.select.assert_called_with(2, 0)
+
+    def test_scarce_trunk_cost_spreads_routes_over_matrices(self):
+        self.root_m.select(0, self.sources1[1])
+        route = ShortestPathRouter(scarce_trunk_cost).route(self.root_m,
+                                                            self.sources1[1])
+        self.assertIs(route.path, self.m1.outputs[0])
+        self.m1.outputs[0].release()
+        self.m1.outputs[1].claim()
+        route = ShortestPathRouter(scarce_trunk_cost).route(self.root_m,
+                                                            self.sources1[1])
+        self.assertIs(route.path, self.m2.outputs[0])
+
+
+class ConcurrentRoutingTests(TestCase):
+    def setUp(self):
+        self.sources1 = [make_signal("s1-%d" % i) for i in range(4)]
+        self.m1 = Matrix("m1", Mock(), self.sources1, 4)
+        self.sources2 = [make_signal("s2-%d" % i) for i in range(4)]
+        self.m2 = Matrix("m2", Mock(), self.sources2, 4)
+        self.root_m = Matrix("root", Mock(), self.m1.outputs, 4)
+
+    def test_route_lock_holds_every_upstream_matrix(self):
+        blocked = threading.Event()
+        with self.root_m.route_lock():
+            thread = threading.Thread(
+                target=lambda: self.m1._lock.acquire(timeout=0.05) or blocked.set()
+            )
+            thread.start()
+            thread.join()
+        self.assertTrue(blocked.is_set())
+
+    def test_routes_through_disjoint_matrices_run_in_parallel(self):
+        done = threading.Event()
+        with self.root_m.route_lock():
+            thread = threading.Thread(
+                target=lambda: (self.m2.select(0, self.sources2[1]), done.set())
+            )
+            thread.start()
+            thread.join(1)
+        self.assertTrue(done.is_set())
+
+    def test_concurrent_selects_keep_trunk_claims_consistent(self):
+        self.m1._driver.select.side_effect = lambda i, o: time.sleep(0)
+        errors = []
+
+        def worker(out):
+            try:
+                for n in range(50):
+                    self.root_m.select(out, self.sources1[(out + n) % 4])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        for idx, trunk in enumerate(self.m1.outputs):
+            users = sum(1 for inp in self.root_m._current.values() if inp == idx)
+            self.assertEqual(trunk._sem.load(), users)
+        for idx, out in enumerate(self.root_m.outputs):
+            self.assertIs(out.source, self.sources1[(idx + 49) % 4])
+
+
+class ReverseIndexTests(TestCase):
+    def setUp(self):
+        self.sources1 = [make_signal("s1-0"), make_signal("s1-1")]
+        self.m1 = Matrix("m1", Mock(), self.sources1, 3)
+        self.root_m = Matrix("root", Mock(), self.m1.outputs, 3)
+
+    def test_carrying_lists_every_output_on_the_route(self):
+        self.root_m.select(0, self.sources1[1])
+        self.assertSetEqual(MatrixOutput.carrying(self.sources1[1]),
+                            {self.root_m.outputs[0], self.m1.outputs[0]})
+
+    def test_carrying_forgets_outputs_switched_away(self):
+        self.m1.select(2, self.sources1[1])
+        self.m1.select(2, self.sources1[0])
+        self.assertSetEqual(MatrixOutput.carrying(self.sources1[1]), set())
+        self.assertSetEqual(MatrixOutput.carrying(self.sources1[0]),
+                            {self.m1.outputs[2]})
+
+    def test_carrying_can_be_limited_to_a_fabric(self):
+        other = Matrix("other", Mock(), self.sources1, 1)
+        other.select(0, self.sources1[1])
+        self.root_m.select(0, self.sources1[1])
+        fabric = FabricGraph(self.root_m)
+        self.assertSetEqual(fabric.carrying(self.sources1[1]),
+                            {self.root_m.outputs[0], self.m1.outputs[0]})
+        self.assertIn(other.outputs[0],
+                      MatrixOutput.carrying(self.sources1[1]))
+
+    def test_carrying_forgets_matrices_with_nothing_routed(self):
+        other = Matrix("other", Mock(), self.sources1, 1,
+                       router=ShortestPathRouter())
+        other.select(0, self.sources1[1])
+        self.assertIn(other, MatrixOutput._carrying)
+        other.outputs[0]._source_changed(None)
+        self.assertNotIn(other, MatrixOutput._carrying)
+        other.select(0, self.sources1[0])
+        matrix = weakref.ref(other)
+        del other
+        gc.collect()
+        self.assertIsNone(matrix())
+
+    def test_carrying_every_matrix_uses_the_source_index(self):
+        self.root_m.select(0, self.sources1[1])
+        self.assertSetEqual(set(MatrixOutput._carried_by[self.sources1[1]]),
+                            {self.root_m.outputs[0], self.m1.outputs[0]})
+        source = Source("gone", registry=SourceRegistry(weak=True))
+        self.m1.replug_input(0, source)
+        self.m1.select(1, source)
+        self.assertIn(source, MatrixOutput._carried_by)
+        self.m1.replug_input(0, self.sources1[0])
+        self.m1.select(1, self.sources1[0])
+        source = weakref.ref(source)
+        gc.collect()
+        self.assertIsNone(source())
+
+    def test_outputs_using_follows_selects(self):
+        self.m1.select(0, self.sources1[1])
+        self.m1.select(2, self.sources1[1])
+        self.assertSetEqual(self.m1.outputs_using(1), {0, 2})
+        self.m1.select(0, self.sources1[0])
+        self.assertSetEqual(self.m1.outputs_using(1), {2})
+        self.assertSetEqual(self.m1.outputs_using(0), {0})
+
+    def test_replug_only_notifies_outputs_using_the_input(self):
+        self.m1.select(0, self.sources1[0])
+        self.m1.select(1, self.sources1[1])
+        new_source = make_signal("new")
+        with patch.object(MatrixOutput, "_source_changed") as changed:
+            self.m1.replug_input(1, new_source)
+        changed.assert_called_once_with(new_source)
+
+
+class PropagationTests(TestCase):
+    def setUp(self):
+        # A diamond, m1 feeds the root directly and via n1
+        self.sources1 = [make_signal("s1-0"), make_signal("s1-1")]
+        self.m1 = Matrix("m1", Mock(), self.sources1, 2)
+        self.n1 = Matrix("n1", Mock(), [self.m1.outputs[1]], 1)
+        self.root_m = Matrix("root", Mock(),
+                             [self.m1.outputs[0], self.n1.outputs[0]], 2)
+        self.root_m.select(0, self.sources1[0])
+        self.root_m.select(1, self.sources1[0])
+        self.sinks = [Mock(), Mock()]
+        for output, sink in zip(self.root_m.outputs, self.sinks):
+            output.connected_to(sink)
+            sink.reset_mock()
+
+    def test_sinks_are_told_once_per_change(self):
+        new_source = make_signal("new")
+        self.m1.replug_input(0, new_source)
+        for sink in self.sinks:
+            sink.source_changed.assert_called_once_with(new_source)
+
+    def test_changes_in_a_propagation_block_are_pushed_once(self):
+        sources = [make_signal("new0"), make_signal("new1")]
+        with propagation():
+            self.m1.replug_input(0, sources[0])
+            self.m1.replug_input(0, sources[1])
+            for sink in self.sinks:
+                sink.source_changed.assert_not_called()
+        for sink in self.sinks:
+            sink.source_changed.assert_called_once_with(sources[1])
+        self.assertIs(self.root_m.outputs[1].source, sources[1])
+
+    def test_selects_in_a_propagation_block_share_trunks(self):
+        sources = [make_signal("t0"), make_signal("t1")]
+        leaf = Matrix("leaf", Mock(), sources, 2)
+        root = Matrix("root", Mock(), leaf.outputs, 2)
+        with propagation():
+            root.select(0, sources[0])
+            self.assertIs(leaf.outputs[0].source, sources[0])
+            root.select(1, sources[0])
+        self.assertEqual(root._current[0], root._current[1])
+        self.assertEqual([o.locked for o in leaf.outputs], [True, False])
+        self.assertIs(root.outputs[1].source, sources[0])
+
+    def test_deep_fabrics_propagate_without_recursion(self):
+        source = make_signal("leaf")
+        chain = [Matrix("c0", Mock(), [source], 1)]
+        chain[0].select(0, source)
+        for n in range(1, 300):
+            chain.append(Matrix(f"c{n}", Mock(), chain[-1].outputs, 1))
+            chain[-1].select(0, source)
+        new_source = make_signal("new")
+        chain[0].replug_input(0, new_source)
+        self.assertIs(chain[-1].outputs[0].source, new_source)
+
+
+class RouteCacheTests(TestCase):
+    def setUp(self):
+        self.sources1 = [make_signal("s1-0"), make_signal("s1-1")]
+        self.m1 = Matrix("m1", Mock(), self.sources1, 2)
+        self.sources2 = [make_signal("s2-0"), make_signal("s2-1")]
+        self.m2 = Matrix("m2", Mock(), self.sources2, 2)
+        self.router = ShortestPathRouter(cache_size=8)
+        self.root_m = Matrix("root", Mock(),
+                             self.m1.outputs + self.m2.outputs, 2,
+                             router=self.router)
+
+    def test_repeated_routes_hit_the_cache(self):
+        first = self.router.route(self.root_m, self.sources1[0])
+        second = self.router.route(self.root_m, self.sources1[0])
+        self.assertEqual(first, second)
+        self.assertEqual(self.router.cache_info()['hits'], 1)
+        self.assertEqual(self.router.cache_info()['misses'], 1)
+
+    def test_claims_on_searched_matrices_invalidate_the_route(self):
+        self.router.route(self.root_m, self.sources1[0])
+        self.m1.outputs[0].claim()
+        route = self.router.route(self.root_m, self.sources1[0])
+        self.assertIs(route.path, self.m1.outputs[1])
+        self.assertEqual(self.router.cache_info()['hits'], 0)
+
+    def test_replugging_invalidates_the_route(self):
+        self.router.route(self.root_m, self.sources1[0])
+        self.m1.replug_input(0, make_signal("new"))
+        self.assertIsNone(self.router.route(self.root_m, self.sources1[0]))
+
+    def test_alternating_recalls_hit_the_cache(self):
+        # The first two rounds leave each trunk carrying its source,
+        # which is part of the stamp, after that the routes are recalled
+        for _ in range(3):
+            self.root_m.select(0, self.sources1[0])
+            self.root_m.select(0, self.sources2[1])
+        self.assertEqual(self.router.cache_info()['hits'], 2)
+        self.assertIs(self.root_m.outputs[0].source, self.sources2[1])
+
+    def test_stamp_returns_to_earlier_value_when_locks_do(self):
+        before = self.root_m.stamp
+        self.m1.outputs[0].claim()
+        self.assertNotEqual(self.root_m.stamp, before)
+        self.m1.outputs[0].release()
+        self.assertEqual(self.root_m.stamp, before)
+
+    def test_cache_is_bounded(self):
+        for n in range(20):
+            self.router.route(self.root_m, make_signal())
+        self.assertEqual(self.router.cache_info()['size'], 8)
+
+    def test_the_cache_keeps_nothing_alive(self):
+        source = Source("leaf", registry=SourceRegistry(weak=True))
+        leaf = Matrix("leaf", Mock(), [source], 1, router=self.router)
+        root = Matrix("root", Mock(), leaf.outputs, 1, router=self.router)
+        root.select(0, source)
+        self.assertIsNotNone(self.router.route(root, source))
+        refs = [weakref.ref(obj) for obj in (leaf, root, source)]
+        del leaf, root, source
+        gc.collect()
+        self.assertEqual([ref() for ref in refs], [None, None, None])
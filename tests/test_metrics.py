@@ -0,0 +1,114 @@
+from unittest import TestCase
+from unittest.mock import Mock
+from utils import make_signal
+from worchestic import metrics
+from worchestic.matrix import Matrix
+from worchestic.fabric import FabricGraph
+from worchestic.group import MatrixGroup, SourceGroup
+from worchestic.metrics import Recorder, Histogram, RouteTracer
+
+
+class HistogramTests(TestCase):
+    def test_values_are_counted_in_the_first_bucket_holding_them(self):
+        histogram = Histogram((1, 2, 4))
+        for value in (0.5, 1, 3, 9):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 0, 1, 1])
+        self.assertEqual(list(histogram.cumulative()),
+                         [(1, 2), (2, 2), (4, 3), (float('inf'), 4)])
+        self.assertEqual(histogram.sum, 13.5)
+
+
+class RecorderTests(TestCase):
+    def setUp(self):
+        self.sources = [make_signal("s0"), make_signal("s1")]
+        self.m1 = Matrix("m1", Mock(), self.sources, 2)
+        self.root_m = Matrix("root", Mock(), self.m1.outputs, 2)
+        self.recorder = metrics.enable()
+        self.addCleanup(metrics.disable)
+
+    def test_selects_record_search_lock_and_driver_metrics(self):
+        self.root_m.select(0, self.sources[0])
+        for metric, device in [('route_search_seconds', 'root'),
+                               ('route_search_seconds', 'm1'),
+                               ('route_lock_wait_seconds', 'root'),
+                               ('driver_command_seconds', 'root'),
+                               ('driver_command_seconds', 'm1')]:
+            self.assertEqual(self.recorder.histogram(metric, device).count, 1,
+                             (metric, device))
+
+    def test_batches_record_crosspoints_per_command(self):
+        FabricGraph(self.root_m).salvo([(self.root_m, 0, self.sources[0]),
+                                        (self.root_m, 1, self.sources[1])])
+        histogram = self.recorder.histogram('driver_crosspoints', 'root')
+        self.assertEqual((histogram.count, histogram.sum), (1, 2))
+
+    def test_companion_fanout(self):
+        usb = [make_signal("u0"), make_signal("u1")]
+        mat_usb = Matrix("usb", Mock(), usb, 1)
+        for hid in usb:
+            hid.preferred_out = mat_usb.outputs[0]
+        group = MatrixGroup(SourceGroup(video=self.sources, usb=usb),
+                            video=self.m1, usb=mat_usb)
+        group.select("video", 0, self.sources[1])
+        histogram = self.recorder.histogram('companion_fanout', 'm1')
+        self.assertEqual((histogram.count, histogram.sum), (1, 1))
+
+    def test_prometheus_text(self):
+        self.root_m.select(0, self.sources[0])
+        text = self.recorder.prometheus()
+        self.assertIn("# TYPE worchestic_route_search_seconds histogram\n", text)
+        self.assertIn('worchestic_route_search_seconds_bucket'
+                      '{device="root",le="+Inf"} 1\n', text)
+        self.assertIn('worchestic_route_search_seconds_count{device="root"} 1\n',
+                      text)
+
+    def test_nothing_is_recorded_once_disabled(self):
+        metrics.disable()
+        self.root_m.select(0, self.sources[0])
+        self.assertEqual(self.recorder.prometheus(), "")
+
+    def test_matrices_can_have_their_own_recorder(self):
+        own = Recorder()
+        self.m1.metrics = own
+        self.root_m.select(0, self.sources[0])
+        self.assertIsNone(self.recorder.histogram('route_search_seconds', 'm1'))
+        self.assertEqual(own.histogram('route_search_seconds', 'm1').count, 1)
+
+
+class RouteTracerTests(TestCase):
+    def setUp(self):
+        self.sources = [make_signal("s0"), make_signal("s1")]
+        self.m1 = Matrix("m1", Mock(), self.sources, 2)
+        self.root_m = Matrix("root", Mock(), self.m1.outputs, 2)
+        self.records = []
+        metrics.enable_tracing(rate=1, sink=self.records.append)
+        self.addCleanup(metrics.disable_tracing)
+
+    def test_a_record_lists_each_hop_upstream_first(self):
+        self.root_m.select(1, self.sources[1])
+        [record] = self.records
+        self.assertEqual((record['matrix'], record['output'], record['source']),
+                         ("root", 1, "s1"))
+        self.assertEqual([(h['matrix'], h['output'], h['input'], h['reused'])
+                          for h in record['hops']],
+                         [("m1", 0, 1, False), ("root", 1, 0, False)])
+        self.assertIsNone(record['error'])
+
+    def test_errors_are_recorded(self):
+        self.m1._driver.select.side_effect = IOError("no reply")
+        with self.assertRaises(IOError):
+            self.root_m.select(0, self.sources[0])
+        self.assertIn("no reply", self.records[0]['error'])
+
+    def test_only_a_sample_is_traced(self):
+        Matrix.tracer.rate = 0
+        self.root_m.select(0, self.sources[0])
+        self.assertEqual(self.records, [])
+
+    def test_records_are_logged_by_default(self):
+        tracer = RouteTracer(rate=1)
+        self.root_m.tracer = tracer
+        with self.assertLogs('worchestic.trace') as logs:
+            self.root_m.select(0, self.sources[0])
+        self.assertEqual(logs.records[0].route['matrix'], "root")
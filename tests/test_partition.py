@@ -0,0 +1,120 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock
+from utils import make_signal
+from worchestic.matrix import Matrix, LockedOutput, UnroutableOutput
+from worchestic.partition import (PartitionServer, Partition, RemoteOutput,
+                                  spawn_partition)
+from worchestic.planner import Planner
+from worchestic.fabric import FabricGraph
+from worchestic.signals import Source, SourceRegistry
+
+
+def build_leaf():
+    """The matrices of the partition started by spawn_partition"""
+    sources = [make_signal("cam0"), make_signal("cam1"), make_signal("cam2")]
+    return [Matrix("leaf", Mock(), sources, 2)]
+
+
+class PartitionTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.sources = [make_signal("s0"), make_signal("s1"), make_signal("s2")]
+        self.leaf = Matrix("leaf", Mock(), self.sources, 2)
+        self.server = PartitionServer([self.leaf], os.path.join(tmp.name, "sock"))
+        self.server.start()
+        self.addCleanup(self.server.close)
+        self.partition = Partition(self.server.address)
+        self.addCleanup(self.partition.close)
+        self.local = make_signal("local")
+        self.trunks = self.partition.matrix("leaf").outputs
+        self.root = Matrix("root", Mock(), self.trunks + [self.local], 2)
+
+    def test_trunks_are_proxies_of_the_remote_outputs(self):
+        self.assertEqual(len(self.trunks), 2)
+        self.assertIsInstance(self.trunks[0], RemoteOutput)
+        self.assertEqual(self.root.available_sources,
+                         frozenset(self.sources + [self.local]))
+
+    def test_routes_are_made_by_the_owning_partition(self):
+        self.root.select(0, self.sources[1])
+        self.leaf._driver.select.assert_called_once_with(1, 0)
+        self.root._driver.select.assert_called_once_with(0, 0)
+        self.assertIs(self.root.outputs[0].source, self.sources[1])
+        self.assertTrue(self.leaf.outputs[0].locked)
+        self.assertEqual(self.partition.crosspoints("leaf"), {0: 1})
+
+    def test_releasing_frees_the_remote_output(self):
+        self.root.select(0, self.sources[1])
+        self.root.select(0, self.local)
+        self.assertFalse(self.trunks[0].locked)
+        self.assertFalse(self.leaf.outputs[0].locked)
+
+    def test_trunks_carrying_the_source_are_shared(self):
+        self.root.select(0, self.sources[1])
+        self.root.select(1, self.sources[1])
+        self.assertEqual(self.trunks[0]._sem.load(), 2)
+        self.assertEqual(self.leaf.outputs[0]._sem.load(), 1)
+        self.leaf._driver.select.assert_called_once()
+
+    def test_selects_find_sources_in_the_fabric_registry(self):
+        own = Source("own", registry=SourceRegistry())
+        self.leaf.replug_input(2, own)
+        FabricGraph(self.leaf)
+        self.partition.refresh()
+        # Standing in for it on this side, as in another process
+        mirror, = [s for s in self.root.available_sources
+                   if s.uuid == own.uuid]
+        self.assertIsNot(mirror, own)
+        self.root.select(0, mirror)
+        self.assertIs(self.leaf.outputs[0].source, own)
+
+    def test_remote_changes_are_seen_after_a_refresh(self):
+        self.assertIn(self.sources[1], self.root.available_sources)
+        self.leaf.replug_input(1, None)
+        self.assertIn(self.sources[1], self.root.available_sources)
+        self.partition.refresh()
+        self.assertNotIn(self.sources[1], self.root.available_sources)
+        with self.assertRaises(UnroutableOutput):
+            self.root.select(0, self.sources[1])
+
+    def test_errors_are_raised_from_the_owner(self):
+        self.leaf.outputs[0].select(self.sources[0])
+        with self.assertRaises(LockedOutput):
+            self.trunks[0].select(self.sources[1])
+
+    def test_a_failed_route_releases_the_remote_claim(self):
+        self.root._driver.select.side_effect = IOError("no reply")
+        with self.assertRaises(IOError):
+            self.root.select(0, self.sources[1])
+        self.assertFalse(self.trunks[0].locked)
+        self.assertFalse(self.leaf.outputs[0].locked)
+        self.assertIsNone(self.root.outputs[0].source)
+
+    def test_salvos_are_planned_across_partitions(self):
+        routes = [(self.root, 0, self.sources[0]),
+                  (self.root, 1, self.sources[2])]
+        Planner().salvo(routes)
+        self.assertEqual(self.partition.crosspoints("leaf"), {0: 0, 1: 2})
+        self.assertIs(self.root.outputs[1].source, self.sources[2])
+
+
+class SpawnedPartitionTests(TestCase):
+    def test_a_partition_in_another_process(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        address = os.path.join(tmp.name, "sock")
+        process = spawn_partition(build_leaf, address)
+        self.addCleanup(process.terminate)
+        with Partition(address, timeout=30) as partition:
+            root = Matrix("root", Mock(), partition.matrix("leaf").outputs, 1)
+            cam2 = partition.source("cam2")
+            self.assertEqual(root.available_sources,
+                             frozenset(partition.sources("leaf")))
+            root.select(0, cam2)
+            self.assertEqual(partition.crosspoints("leaf"), {0: 2})
+            self.assertEqual(root.outputs[0].source.name, "cam2")
+            root.release(0)
+            self.assertFalse(root.inputs[0].locked)
@@ -0,0 +1,159 @@
+import asyncio
+import time
+from unittest import TestCase
+from utils import state_of, two_level_fabric
+from worchestic.matrix import (LockedOutput, UnroutableOutput, hop_cost,
+                               is_locked)
+from worchestic.planner import Planner
+
+
+class PlannerTests(TestCase):
+    def setUp(self):
+        self.fabric, self.root, self.sources = two_level_fabric()
+        self.planner = Planner()
+
+    def test_planning_changes_nothing(self):
+        before = state_of(self.fabric)
+        plans = self.planner.plan([(self.root, 0, self.sources[0]),
+                                   (self.root, 1, self.sources[3])])
+        self.assertEqual(state_of(self.fabric), before)
+        self.assertEqual([len(p.hops) for p in plans], [2, 2])
+
+    def test_a_salvo_needing_too_many_trunks_is_infeasible(self):
+        routes = [(self.root, i, self.sources[i]) for i in range(3)]
+        self.assertFalse(self.planner.feasible(routes))
+        with self.assertRaises(UnroutableOutput):
+            self.planner.salvo(routes)
+        self.assertEqual(self.root._current, {})
+        for matrix in self.fabric.matrices:
+            matrix._driver.select.assert_not_called()
+            matrix._driver.select_many.assert_not_called()
+
+    def test_trunks_carrying_the_source_are_shared(self):
+        plans = self.planner.plan([(self.root, 0, self.sources[0]),
+                                   (self.root, 1, self.sources[0]),
+                                   (self.root, 2, self.sources[1])])
+        self.assertEqual(len(plans[0].new_trunks), 1)
+        self.assertEqual(plans[1].new_trunks, [])
+        self.assertEqual(len(plans[2].new_trunks), 1)
+
+    def test_releases_earlier_in_a_salvo_free_trunks(self):
+        self.root.select(0, self.sources[0])
+        self.root.select(1, self.sources[1])
+        self.assertFalse(self.planner.feasible([(self.root, 2, self.sources[2])]))
+        self.assertTrue(self.planner.feasible([(self.root, 0, self.sources[2]),
+                                               (self.root, 2, self.sources[1])]))
+
+    def test_locked_outputs_are_infeasible(self):
+        self.root.select(0, self.sources[0])
+        self.root.outputs[0].claim()
+        with self.assertRaises(LockedOutput):
+            self.planner.plan([(self.root, 0, self.sources[1])])
+
+    def test_salvo_matches_selecting_each_route(self):
+        routes = [(0, 0), (1, 3), (2, 0), (0, 4), (3, 1)]
+        self.fabric.salvo([(self.root, i, self.sources[s]) for i, s in routes])
+        fabric, root, sources = two_level_fabric()
+        for i, s in routes:
+            root.select(i, sources[s])
+        self.assertEqual(state_of(self.fabric), state_of(fabric))
+
+    def test_asalvo(self):
+        routes = [(self.root, 0, self.sources[0]),
+                  (self.root, 1, self.sources[4])]
+        asyncio.run(self.fabric.asalvo(routes))
+        self.assertIs(self.root.outputs[0].source, self.sources[0])
+        self.assertIs(self.root.outputs[1].source, self.sources[4])
+
+    def test_salvo_of_a_generator(self):
+        self.planner.salvo((self.root, i, self.sources[s])
+                           for i, s in [(0, 0), (1, 3)])
+        self.assertIs(self.root.outputs[0].source, self.sources[0])
+        self.assertIs(self.root.outputs[1].source, self.sources[3])
+
+    def test_asalvo_of_a_generator(self):
+        asyncio.run(self.planner.asalvo((self.root, i, self.sources[s])
+                                        for i, s in [(0, 0), (1, 3)]))
+        self.assertIs(self.root.outputs[0].source, self.sources[0])
+        self.assertIs(self.root.outputs[1].source, self.sources[3])
+
+    def test_the_cost_sees_the_planned_locks(self):
+        m1 = self.root.inputs[0].port[0]
+        seen = []
+
+        def cost(matrix, idx, inp):
+            seen.append([is_locked(o) for o in m1.outputs])
+            return hop_cost(matrix, idx, inp)
+
+        Planner(cost).plan([(self.root, 0, self.sources[0]),
+                            (self.root, 1, self.sources[1])])
+        self.assertEqual(seen[0], [False, False])
+        self.assertTrue(any(seen[-1]))
+        self.assertEqual([o.locked for o in m1.outputs], [False, False])
+
+
+class ReservationTests(TestCase):
+    def setUp(self):
+        self.fabric, self.root, self.sources = two_level_fabric()
+        self.m1, self.m2 = (inp.port[0] for inp in self.root.inputs[::2])
+        self.root.select(0, self.sources[0])
+        self.routes = [(self.root, 0, self.sources[3]),
+                       (self.root, 1, self.sources[2])]
+        for matrix in self.fabric.matrices:
+            matrix._driver.reset_mock()
+
+    def test_reserving_routes_upstream_of_the_final_crosspoints(self):
+        self.fabric.reserve("show", self.routes)
+        self.assertIs(self.root.outputs[0].source, self.sources[0])
+        self.assertIsNone(self.root.outputs[1].source)
+        self.assertEqual(sum(o.locked for o in self.m1.outputs), 2)
+        self.assertEqual(sum(o.locked for o in self.m2.outputs), 1)
+        self.root._driver.select.assert_not_called()
+        self.m2._driver.select_many.assert_called_once_with([(0, 0)])
+
+    def test_triggering_sends_only_the_final_crosspoints(self):
+        self.fabric.reserve("show", self.routes)
+        for matrix in self.fabric.matrices:
+            matrix._driver.reset_mock()
+        self.fabric.trigger("show")
+        self.assertIs(self.root.outputs[0].source, self.sources[3])
+        self.assertIs(self.root.outputs[1].source, self.sources[2])
+        self.root._driver.select_many.assert_called_once()
+        self.assertEqual(len(self.root._driver.select_many.call_args[0][0]), 2)
+        for matrix in (self.m1, self.m2):
+            matrix._driver.select.assert_not_called()
+            matrix._driver.select_many.assert_not_called()
+        # The old route's trunk was freed, the reserved ones are held once
+        self.assertEqual([o._sem.load() for o in self.m1.outputs], [0, 1])
+        self.assertEqual(self.fabric.reservations, {})
+
+    def test_reserved_trunks_are_not_available_to_other_routes(self):
+        self.fabric.reserve("show", self.routes)
+        with self.assertRaises(UnroutableOutput):
+            self.root.select(2, self.sources[1])
+
+    def test_cancelling_frees_the_trunks(self):
+        self.fabric.reserve("show", self.routes)
+        self.fabric.cancel("show")
+        self.assertEqual(sum(o.locked for o in self.m1.outputs), 1)
+        self.root.select(2, self.sources[1])
+
+    def test_a_reservation_which_cant_be_made_claims_nothing(self):
+        with self.assertRaises(UnroutableOutput):
+            self.fabric.reserve("show", [(self.root, 1, self.sources[1]),
+                                         (self.root, 2, self.sources[2])])
+        self.assertEqual(sum(o.locked for o in self.m1.outputs), 1)
+        self.assertNotIn("show", self.fabric.reservations)
+
+    def test_a_trigger_can_be_scheduled(self):
+        reservation = Planner().reserve(self.routes)
+        at = time.time() + 0.05
+        reservation.trigger(at)
+        self.assertGreaterEqual(time.time(), at)
+        with self.assertRaises(ValueError):
+            reservation.trigger()
+
+    def test_atrigger(self):
+        self.fabric.reserve("show", self.routes)
+        asyncio.run(self.fabric.atrigger("show", at=time.time()))
+        self.assertIs(self.root.outputs[1].source, self.sources[2])
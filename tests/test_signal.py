@@ -1,5 +1,10 @@
+import gc
+import weakref
 from unittest import TestCase
-from worchestic.signals import Source
+from unittest.mock import Mock
+from worchestic.fabric import FabricGraph
+from worchestic.matrix import Matrix
+from worchestic.signals import Source, SourceRegistry
 
 
 class SourceTests(TestCase):
@@ -21,3 +26,78 @@ class SourceTests(TestCase):
     def test_that_the_source_class_has_get_byuuid_classmethod(self):
         source = Source.get(self.source.uuid)
         self.assertIs(source, self.source)
+
+    def test_list_is_a_copy(self):
+        sources = Source.list()
+        Source("test3")
+        self.assertEqual(len(sources), 2)
+
+    def test_sources_are_indexed_by_name_and_preferred_output(self):
+        output = object()
+        self.source.preferred_out = output
+        self.source2.name = "test"
+        self.assertCountEqual(Source.registry.by_name("test"),
+                              [self.source, self.source2])
+        self.assertEqual(Source.registry.by_name("test2"), [])
+        self.assertEqual(Source.registry.by_preferred_out(output), [self.source])
+
+
+class SourceRegistryTests(TestCase):
+    def test_bulk_creation(self):
+        registry = SourceRegistry()
+        output = object()
+        sources = registry.create((f"s{n}" for n in range(1000)), output)
+        self.assertEqual(len(registry), 1000)
+        self.assertEqual(registry.by_name("s7"), [sources[7]])
+        self.assertEqual(len(registry.by_preferred_out(output)), 1000)
+        self.assertNotIn(sources[0], Source.registry)
+
+    def test_weak_registries_drop_unused_sources(self):
+        registry = SourceRegistry(weak=True)
+        kept = Source("kept", registry=registry)
+        Source("dropped", registry=registry)
+        gc.collect()
+        self.assertEqual(registry.list(), [kept])
+        self.assertEqual(registry.by_name("dropped"), [])
+
+    def test_unregister(self):
+        registry = SourceRegistry()
+        source = Source("s", registry=registry)
+        registry.unregister(source)
+        source.name = "renamed"
+        self.assertEqual(len(registry), 0)
+        self.assertEqual(registry.by_name("renamed"), [])
+        with self.assertRaises(KeyError):
+            registry.get(source.uuid)
+
+    def test_fabrics_have_their_own_registries(self):
+        cams = [Source("cam0"), Source("cam1")]
+        fabric1 = FabricGraph(Matrix("m1", Mock(), cams[:1], 1))
+        fabric2 = FabricGraph(Matrix("m2", Mock(), cams[1:], 1))
+        self.assertEqual(fabric1.registry.list(), cams[:1])
+        fabric1.reset_registry()
+        self.assertEqual(fabric1.registry.list(), [])
+        self.assertEqual(fabric2.registry.list(), cams[1:])
+        self.assertIn(cams[0], Source.registry)
+
+    def test_replugging_unregisters_the_replaced_source(self):
+        registry = SourceRegistry()
+        cams = [Source("cam0"), Source("cam1"), Source("cam2")]
+        matrix = Matrix("m", Mock(), [cams[0], cams[0]], 1)
+        fabric = FabricGraph(matrix, registry=registry)
+        matrix.replug_input(0, cams[1])
+        self.assertIn(cams[0], registry)
+        matrix.replug_input(1, cams[2])
+        self.assertNotIn(cams[0], registry)
+        self.assertCountEqual(fabric.registry.list(), cams[1:])
+
+    def test_replugged_sources_are_not_kept_alive(self):
+        scratch = SourceRegistry(weak=True)
+        matrix = Matrix("m", Mock(), [Source("cam", registry=scratch)], 1)
+        fabric = FabricGraph(matrix)
+        first = weakref.ref(matrix.inputs[0])
+        for n in range(1000):
+            matrix.replug_input(0, Source(f"cam{n}", registry=scratch))
+        gc.collect()
+        self.assertIsNone(first())
+        self.assertEqual(len(fabric.registry), 1)
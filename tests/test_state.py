@@ -0,0 +1,161 @@
+import os
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import Mock
+from utils import make_signal, state_of, three_level_fabric
+from worchestic.matrix import Matrix
+from worchestic.signals import Source
+from worchestic.state import (dumps, loads, snapshot, restore, StateMismatch,
+                              Journal, recover)
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        self.fabric, self.root, self.sources = three_level_fabric()
+        self.root.select(0, self.sources[0])
+        self.root.select(1, self.sources[0])
+        self.root.select(2, self.sources[4])
+
+    def test_restore_reproduces_the_routing_state(self):
+        fabric, root, sources = three_level_fabric()
+        loads(fabric, dumps(self.fabric))
+        self.assertEqual(state_of(fabric), state_of(self.fabric))
+
+    def test_restore_sends_no_driver_commands(self):
+        fabric, root, sources = three_level_fabric()
+        loads(fabric, dumps(self.fabric))
+        for matrix in fabric.matrices:
+            matrix._driver.select.assert_not_called()
+
+    def test_routing_continues_after_a_restore(self):
+        fabric, root, sources = three_level_fabric()
+        loads(fabric, dumps(self.fabric))
+        root.select(0, sources[5])
+        self.root.select(0, self.sources[5])
+        self.assertEqual(state_of(fabric), state_of(self.fabric))
+
+    def test_snapshot_files_round_trip(self):
+        fabric, root, sources = three_level_fabric()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state")
+            snapshot(self.fabric, path)
+            restore(fabric, path)
+        self.assertEqual(state_of(fabric), state_of(self.fabric))
+        self.assertIs(root.outputs[2].source, sources[4])
+
+    def test_restoring_to_a_different_fabric_raises(self):
+        other = Matrix("root", Mock(), [make_signal()], 1)
+        with self.assertRaises(StateMismatch):
+            loads([other], dumps(self.fabric))
+
+    def test_snapshot_is_compact(self):
+        outputs = sum(len(m.outputs) for m in self.fabric.matrices)
+        self.assertLess(len(dumps(self.fabric)), 20 * outputs)
+
+
+class JournalTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "journal")
+        self.fabric, self.root, self.sources = three_level_fabric()
+        self.journal = Journal.open(self.fabric, self.path, sync=True)
+        self.addCleanup(self.journal.close)
+
+    def recovered(self):
+        self.journal.flush()
+        fabric, root, sources = three_level_fabric()
+        recover(fabric, self.path)
+        return fabric, root, sources
+
+    def test_replay_reproduces_the_routing_state(self):
+        self.root.select(0, self.sources[0])
+        self.root.select(1, self.sources[4])
+        self.root.select(1, self.sources[5])
+        fabric, root, sources = self.recovered()
+        self.assertEqual(state_of(fabric), state_of(self.fabric))
+        for matrix in fabric.matrices:
+            matrix._driver.select.assert_not_called()
+
+    def test_replay_includes_replugged_inputs(self):
+        n2 = self.root.inputs[2].port[0]
+        m3 = n2.inputs[0].port[0]
+        Source.reset_registry()
+        spare = make_signal("spare")
+        m3.replug_input(0, spare)
+        self.root.select(2, spare)
+        fabric, root, sources = self.recovered()
+        make_signal("spare")
+        recover(fabric, self.path)
+        self.assertEqual(state_of(fabric), state_of(self.fabric))
+        self.assertEqual(root.outputs[2].source.name, "spare")
+
+    def test_torn_records_are_dropped(self):
+        self.root.select(0, self.sources[0])
+        self.journal.flush()
+        expected = state_of(self.fabric)
+        size = os.path.getsize(self.path)
+        with open(self.path, 'ab') as fh:
+            fh.write(b'\x40\x00\x00\x00torn')
+        fabric, root, sources = three_level_fabric()
+        recover(fabric, self.path)
+        self.assertEqual(state_of(fabric), expected)
+        self.assertEqual(os.path.getsize(self.path), size)
+
+    def test_compaction_snapshots_and_empties_the_journal(self):
+        self.root.select(0, self.sources[0])
+        self.journal.compact()
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.root.select(1, self.sources[4])
+        fabric, root, sources = self.recovered()
+        self.assertEqual(state_of(fabric), state_of(self.fabric))
+
+    def test_compaction_keeps_replugged_inputs(self):
+        n2 = self.root.inputs[2].port[0]
+        m3 = n2.inputs[0].port[0]
+        Source.reset_registry()
+        spare = make_signal("spare")
+        m3.replug_input(0, spare)
+        self.root.select(2, spare)
+        self.journal.compact()
+        self.root.select(0, self.sources[0])
+        fabric, root, sources = three_level_fabric()
+        make_signal("spare")
+        recover(fabric, self.path)
+        self.assertEqual(state_of(fabric), state_of(self.fabric))
+        m3 = root.inputs[2].port[0].inputs[0].port[0]
+        self.assertEqual([s.name for s in m3.inputs], ["spare", "s3-1"])
+        self.assertEqual(root.outputs[2].source.name, "spare")
+
+    def test_a_reopened_journal_keeps_replugged_inputs(self):
+        m3 = self.root.inputs[2].port[0].inputs[0].port[0]
+        Source.reset_registry()
+        m3.replug_input(0, make_signal("spare"))
+        self.journal.close()
+        fabric, root, sources = three_level_fabric()
+        make_signal("spare")
+        with Journal.open(fabric, self.path) as journal:
+            journal.compact()
+        fabric, root, sources = three_level_fabric()
+        recover(fabric, self.path)
+        m3 = root.inputs[2].port[0].inputs[0].port[0]
+        self.assertEqual(m3.inputs[0].name, "spare")
+
+    def test_concurrent_routes_share_fsyncs(self):
+        self.journal.interval = 0.02
+        barrier = threading.Barrier(3)
+
+        def route(idx, source):
+            barrier.wait()
+            self.root.select(idx, source)
+
+        threads = [threading.Thread(target=route, args=(i, self.sources[s]))
+                   for i, s in enumerate((0, 4, 5))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLess(self.journal.fsyncs, 3)
+        fabric, root, sources = self.recovered()
+        self.assertEqual(state_of(fabric), state_of(self.fabric))
@@ -1,4 +1,7 @@
 """ Util functions used in multiple unittests"""
+from unittest.mock import Mock
+from worchestic.fabric import FabricGraph
+from worchestic.matrix import Matrix
 from worchestic.signals import Source
 
 
@@ -10,3 +13,44 @@ def make_signal(name=""):
     if not name:
         s.name = str(s.uuid)
     return s
+
+
+def two_level_fabric():
+    """Two leaf matrices feeding a root over two trunks each
+
+    Returns the FabricGraph, the root and the sources of the leaves
+    """
+    sources1 = [make_signal("s1-0"), make_signal("s1-1"), make_signal("s1-2")]
+    m1 = Matrix("m1", Mock(), sources1, 2)
+    sources2 = [make_signal("s2-0"), make_signal("s2-1")]
+    m2 = Matrix("m2", Mock(), sources2, 2)
+    root = Matrix("root", Mock(), m1.outputs + m2.outputs, 4)
+    return FabricGraph(root), root, sources1 + sources2
+
+
+def three_level_fabric():
+    """A three level fabric, built the same way on each call
+
+    Returns the FabricGraph, the root and the sources of the leaves
+    """
+    sources1 = [make_signal("s1-0"), make_signal("s1-1"), make_signal("s1-2")]
+    m1 = Matrix("m1", Mock(), sources1, 2)
+    sources2 = [sources1[1], make_signal("s2-0")]
+    m2 = Matrix("m2", Mock(), sources2, 2)
+    sources3 = [make_signal("s3-0"), make_signal("s3-1")]
+    m3 = Matrix("m3", Mock(), sources3, 2)
+    n1 = Matrix("n1", Mock(), m1.outputs + [m2.outputs[0]], 2)
+    n2 = Matrix("n2", Mock(), m3.outputs + [m2.outputs[1]], 2)
+    root = Matrix("root", Mock(), n1.outputs + n2.outputs, 3)
+    return FabricGraph(root), root, sources1 + sources2[1:] + sources3
+
+
+def state_of(fabric):
+    """The routing state of a FabricGraph, or a list of matrices, by
+    matrix name; for comparing fabrics"""
+    return {
+        m.name: (dict(m._current), set(m._holding),
+                 [(o._sem.load(), o.source and o.source.name)
+                  for o in m.outputs])
+        for m in getattr(fabric, 'matrices', fabric)
+    }
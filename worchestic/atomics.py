@@ -5,6 +5,8 @@ try:
 except ImportError:
     class AtomicInt:
         """Slower locked classes rather than actually atomic"""
+        __slots__ = ('value', '_lock')
+
         def __init__(self, init_value):
             self.value = init_value
             self._lock = threading.Lock()
@@ -19,3 +21,7 @@ except ImportError:
 
         def load(self):
             return self.value
+
+        def store(self, value):
+            with self._lock:
+                self.value = value
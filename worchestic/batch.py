@@ -0,0 +1,208 @@
+# batch.py - Deferring and coalescing driver commands
+import asyncio
+import logging
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
+from concurrent.futures import Future
+from functools import partial
+from time import perf_counter
+from .dispatch import track, waiting_for_drivers
+
+logger = logging.getLogger(__name__)
+
+current_batch = ContextVar('current_batch', default=None)
+
+
+class Batch:
+    """Crosspoints queued for a set of matrices
+
+    Only the last crosspoint queued for each output is kept, and
+    each driver is sent all of its crosspoints in one select_many call.
+    If a driver fails, the routes queued in the batch are rolled back,
+    see on_failure, and the crosspoints they replaced sent again.
+
+    Args:
+        asynchronous (bool): the batch is sent with acommit, so
+            crosspoints for asyncio drivers may be queued
+    """
+    def __init__(self, asynchronous=False):
+        self.asynchronous = asynchronous
+        self._pending = {}
+        self._undo = []
+
+    def queue(self, matrix, input_idx: int, idx: int):
+        self._pending.setdefault(matrix, {})[idx] = input_idx
+
+    def on_failure(self, undo):
+        """Call undo if sending the batch fails
+
+        Used by Matrix.route_lock to roll back routes whose locks were
+        let go before their crosspoints were sent.
+        """
+        self._undo.append(undo)
+
+    def _rolled_back(self):
+        """Roll back the routes queued in this batch, latest first
+
+        Returns a batch of the crosspoints to send to put the hardware
+        back as it was.
+        """
+        undos, self._undo = self._undo, []
+        redo = Batch(self.asynchronous)
+        token = current_batch.set(redo)
+        try:
+            for undo in reversed(undos):
+                try:
+                    undo()
+                except Exception as e:
+                    logger.error("failed rolling back a batch: %r", e)
+        finally:
+            current_batch.reset(token)
+        # The rollback is itself a route, which mustn't be undone
+        redo._undo = []
+        return redo
+
+    def __len__(self):
+        return sum(len(xpts) for xpts in self._pending.values())
+
+    def take(self):
+        """Remove the queued crosspoints, as a list of (matrix, crosspoints)"""
+        pending, self._pending = self._pending, {}
+        return [
+            (matrix, [(inp, out) for out, inp in xpts.items()])
+            for matrix, xpts in pending.items()
+        ]
+
+    @staticmethod
+    def _commands(driver, crosspoints):
+        select_many = getattr(driver, 'select_many', None)
+        if select_many is not None:
+            return [partial(select_many, crosspoints)]
+        return [partial(driver.select, inp, out) for inp, out in crosspoints]
+
+    def commit(self):
+        """Send the queued crosspoints to the drivers"""
+        try:
+            self._send()
+        except BaseException:
+            redo = self._rolled_back()
+            try:
+                redo._send()
+            except Exception as e:
+                logger.error("failed restoring crosspoints: %r", e)
+            raise
+
+    def _send(self):
+        with waiting_for_drivers():
+            for matrix, crosspoints in self.take():
+                metrics = matrix.metrics
+                if metrics is not None:
+                    start = perf_counter()
+                for command in self._commands(matrix._driver, crosspoints):
+                    track(command())
+                if metrics is not None:
+                    self._observe(metrics, matrix, crosspoints, start)
+
+    async def acommit(self):
+        """Send the queued crosspoints to the drivers concurrently
+
+        Each driver gets its commands in order, but different drivers
+        are sent their commands at the same time. Drivers with
+        coroutine methods (see AsyncMatrixDriver) are awaited, other
+        drivers are run in the event loop's default executor, and
+        any Future they return (see ThreadedDriver) is awaited.
+        """
+        try:
+            await self._asend_all()
+        except BaseException:
+            redo = self._rolled_back()
+            try:
+                await redo._asend_all()
+            except Exception as e:
+                logger.error("failed restoring crosspoints: %r", e)
+            raise
+
+    async def _asend_all(self):
+        await asyncio.gather(*(
+            self._adrive(matrix, crosspoints)
+            for matrix, crosspoints in self.take()
+        ))
+
+    @staticmethod
+    def _observe(metrics, matrix, crosspoints, start):
+        metrics.observe('driver_command_seconds', perf_counter() - start,
+                        matrix.name)
+        metrics.observe('driver_crosspoints', len(crosspoints), matrix.name)
+
+    @classmethod
+    async def _adrive(kls, matrix, crosspoints):
+        metrics = matrix.metrics
+        if metrics is not None:
+            start = perf_counter()
+        await kls._asend(matrix._driver, crosspoints)
+        if metrics is not None:
+            kls._observe(metrics, matrix, crosspoints, start)
+
+    @classmethod
+    async def _asend(kls, driver, crosspoints):
+        loop = asyncio.get_running_loop()
+        for command in kls._commands(driver, crosspoints):
+            if asyncio.iscoroutinefunction(command.func):
+                await command()
+            else:
+                result = await loop.run_in_executor(None, command)
+                if isinstance(result, Future):
+                    await asyncio.wrap_future(result)
+
+
+@contextmanager
+def _collect(asynchronous=False):
+    """Make a new batch current, unless one already is
+
+    Yields the new batch, or None if an enclosing block
+    owns the current batch.
+    """
+    if current_batch.get() is not None:
+        yield None
+        return
+    batch = Batch(asynchronous)
+    token = current_batch.set(batch)
+    try:
+        yield batch
+    finally:
+        current_batch.reset(token)
+
+
+@contextmanager
+def batch():
+    """Queue the driver commands of selects in this block
+
+    Routes are planned, and locks claimed, as each select is made,
+    but the crosspoints are only sent to the drivers, one bulk
+    command per matrix, when the outermost batch block exits. The commands
+    are still sent if the block raises, so the hardware matches the
+    routing state. If a driver fails the routes selected in the block
+    are rolled back, and the error raised.
+    """
+    with _collect() as new:
+        try:
+            yield current_batch.get()
+        finally:
+            if new is not None:
+                new.commit()
+
+
+@asynccontextmanager
+async def abatch():
+    """The asyncio version of batch, sending the commands with acommit
+
+    The route locks are threading locks, so they are taken on the event
+    loop's thread; a select waiting for another thread's route blocks
+    the loop until that route is made.
+    """
+    with _collect(asynchronous=True) as new:
+        try:
+            yield current_batch.get()
+        finally:
+            if new is not None:
+                await new.acommit()
@@ -0,0 +1,139 @@
+# dispatch.py - Running blocking drivers on a pool of worker threads
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_pending = ContextVar('pending_driver_futures', default=None)
+
+ASYNC_DRIVER_ERROR = ("asyncio drivers can only be driven by aselect, "
+                      "or inside an abatch block")
+
+
+def is_async(driver):
+    """True if driver is an AsyncMatrixDriver"""
+    return asyncio.iscoroutinefunction(getattr(driver, 'select', None))
+
+
+def track(result):
+    """Note the result of a driver command
+
+    If the driver returned a Future it is waited for at the end of the
+    enclosing waiting_for_drivers block, or straight away if there
+    isn't one. A coroutine, from an asyncio driver, can't be waited for
+    here so raises TypeError.
+    """
+    if asyncio.iscoroutine(result):
+        result.close()
+        raise TypeError(ASYNC_DRIVER_ERROR)
+    if isinstance(result, Future):
+        futures = _pending.get()
+        if futures is None:
+            result.result()
+        else:
+            futures.append(result)
+    return result
+
+
+@contextmanager
+def waiting_for_drivers():
+    """Wait once, at the end of the block, for driver commands
+
+    Nested blocks join the outermost block. The first driver error
+    is raised once all the commands have finished.
+    """
+    if _pending.get() is not None:
+        yield
+        return
+    futures = []
+    token = _pending.set(futures)
+    try:
+        yield
+    finally:
+        _pending.reset(token)
+        wait(futures)
+    for future in futures:
+        future.result()
+
+
+class ThreadedDriver:
+    """Runs the commands of a blocking driver on a worker pool
+
+    Commands for this driver are run one at a time, in the order
+    they were issued, but commands for different drivers sharing
+    the pool run in parallel. select, select_many and read_crosspoints
+    return a Future.
+    """
+    def __init__(self, driver, executor):
+        self.driver = driver
+        self._executor = executor
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._running = False
+
+    def select(self, input: int, output: int):
+        return self._submit(self.driver.select, input, output)
+
+    def select_many(self, crosspoints):
+        return self._submit(self._select_many, crosspoints)
+
+    def read_crosspoints(self):
+        """Read back the crosspoints after any queued commands"""
+        return self._submit(self.driver.read_crosspoints)
+
+    def _select_many(self, crosspoints):
+        select_many = getattr(self.driver, 'select_many', None)
+        if select_many is not None:
+            return select_many(crosspoints)
+        for input, output in crosspoints:
+            self.driver.select(input, output)
+
+    def _submit(self, fn, *args):
+        future = Future()
+        with self._lock:
+            self._queue.append((future, fn, args))
+            if self._running:
+                return future
+            self._running = True
+        self._executor.submit(self._drain)
+        return future
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._running = False
+                    return
+                future, fn, args = self._queue.popleft()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+
+
+class DriverDispatcher:
+    """A pool of worker threads for blocking drivers
+
+    Examples:
+        >>> dispatcher = DriverDispatcher(max_workers=4)
+        >>> video = Matrix("video", dispatcher.wrap(SerialDriver(port)), inputs, 4)
+    """
+    def __init__(self, max_workers=None):
+        self.executor = ThreadPoolExecutor(max_workers,
+                                           thread_name_prefix='worchestic')
+
+    def wrap(self, driver):
+        """Return a ThreadedDriver running driver on this pool"""
+        return ThreadedDriver(driver, self.executor)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
@@ -0,0 +1,320 @@
+# fabric.py - A whole fabric view of a set of cascaded matrices
+import asyncio
+import threading
+from array import array
+from concurrent.futures import Future
+from .batch import batch, abatch, current_batch
+from .matrix import Matrix, MatrixOutput, ShortestPathRouter, hop_cost
+from .planner import Planner
+from .signals import Source, SourceRegistry
+
+
+class FabricGraph:
+    """The topology of a set of cascaded matrices
+
+    Matrices are registered with the graph, along with everything
+    upstream of them, and the topology is compiled into integer indexed
+    CSR style arrays. Input slot ``i`` of the matrix numbered ``m``
+    is at ``offsets[m] + i``, and ``kinds``/``targets`` record whether
+    the slot is empty, a source (by source number) or a trunk (by
+    upstream matrix number).
+
+    Lock state is read from the trunks at query time, so only
+    replugging inputs requires the graph to be recompiled. The arrays
+    serve reachable and trunk_usage; routes are not searched over them,
+    route uses the ShortestPathRouter search and cache over the matrices
+    themselves, see route.
+
+    Args:
+        *matrices: matrices to register
+        cost: edge cost function, as used by ShortestPathRouter
+        delegate (bool): If True registered matrices route via this graph,
+            and so with its cost.
+        registry (SourceRegistry): the registry to add the sources plugged
+            into the matrices to, a new weak one if not given
+
+    Examples:
+        >>> fabric = FabricGraph(root_matrix)
+        >>> fabric.reachable(root_matrix)
+        {Source(cam1), Source(cam2)}
+    """
+    EMPTY, SOURCE, TRUNK = 0, 1, 2
+
+    def __init__(self, *matrices, cost=hop_cost, delegate=True, registry=None):
+        self.matrices = []
+        self.cost = cost
+        self.delegate = delegate
+        # Share the route cache of the matrices unless the cost differs,
+        # and don't cache costs which look beyond the searched matrices
+        if cost is Matrix.router.cost:
+            self.router = Matrix.router
+        else:
+            self.router = ShortestPathRouter(cost)
+        self.registry = SourceRegistry(weak=True) if registry is None else registry
+        # name -> planner.Reservation
+        self.reservations = {}
+        self._ids = {}
+        self._compiled = False
+        self._lock = threading.RLock()
+        for matrix in matrices:
+            self.register(matrix)
+
+    def register(self, matrix: Matrix):
+        """Add matrix, and every matrix upstream of it, to the graph"""
+        pending = [matrix]
+        while pending:
+            matrix = pending.pop()
+            if matrix in self._ids:
+                continue
+            self._ids[matrix] = len(self.matrices)
+            self.matrices.append(matrix)
+            matrix.fabric = self
+            if self.delegate:
+                matrix.router = self
+            pending.extend(inp.port[0] for inp in matrix.inputs
+                           if isinstance(inp, MatrixOutput))
+            self.registry.register_many(inp for inp in matrix.inputs
+                                       if isinstance(inp, Source))
+        self.invalidate()
+
+    def plugs(self, source: Source):
+        """True if source is plugged into an input of any matrix"""
+        return any(inp is source for matrix in self.matrices
+                   for inp in matrix.inputs)
+
+    def reset_registry(self):
+        """Forget the sources registered with this fabric
+
+        Other fabrics, and the default registry of Source, are left
+        as they are.
+        """
+        self.registry.clear()
+
+    def register_group(self, group):
+        """Register every matrix of a MatrixGroup"""
+        for matrix in group.matrices.values():
+            self.register(matrix)
+
+    @property
+    def current_batch(self):
+        return current_batch.get()
+
+    def batch(self):
+        """Queue the driver commands of selects in this block
+
+        See worchestic.batch.batch, selects on any matrix are queued,
+        not only those on matrices registered with this graph.
+
+        Examples:
+            >>> with fabric.batch():
+            ...     root.select(0, cam1)
+            ...     root.select(1, cam2)
+        """
+        return batch()
+
+    def abatch(self):
+        """The asyncio version of FabricGraph.batch"""
+        return abatch()
+
+    def plan(self, routes):
+        """Plan a list of (matrix, output idx, source) routes, without
+        changing anything; see planner.Planner.plan"""
+        return Planner(self.cost).plan(routes)
+
+    def feasible(self, routes):
+        """True if every (matrix, output idx, source) route can be made"""
+        return Planner(self.cost).feasible(routes)
+
+    def salvo(self, routes):
+        """Select a list of (matrix, output idx, source) routes as one batch
+
+        The whole salvo is planned first, so if any route can't be
+        made nothing is selected or driven.
+        """
+        return Planner(self.cost).salvo(routes)
+
+    async def asalvo(self, routes):
+        """The asyncio version of salvo, driving matrices concurrently"""
+        return await Planner(self.cost).asalvo(routes)
+
+    def reserve(self, name, routes):
+        """Reserve the trunks for a named salvo of (matrix, output idx,
+        source) routes, to be made later with trigger
+
+        See planner.Planner.reserve
+        """
+        if name in self.reservations:
+            raise ValueError(f"A salvo named {name!r} is already reserved")
+        reservation = Planner(self.cost).reserve(routes, name)
+        self.reservations[name] = reservation
+        return reservation
+
+    def trigger(self, name, at: float = None):
+        """Make the reserved salvo name, at the time.time() at if given"""
+        self.reservations[name].trigger(at)
+        del self.reservations[name]
+
+    async def atrigger(self, name, at: float = None):
+        """The asyncio version of trigger, driving every matrix at once"""
+        await self.reservations[name].atrigger(at)
+        del self.reservations[name]
+
+    def cancel(self, name):
+        """Give up the trunks reserved for the salvo name"""
+        self.reservations[name].cancel()
+        del self.reservations[name]
+
+    def reconcile(self):
+        """Bring the hardware of every matrix into line with the routing state
+
+        The crosspoints of every matrix are read back first, which
+        happens in parallel for ThreadedDriver drivers, then only
+        those which differ are driven, one bulk command per matrix.
+        Matrices whose drivers can't read back are fully re-driven.
+
+        Returns:
+            {matrix: [(input, output), ...]} for the matrices driven
+        """
+        # Start every read before waiting for any of them
+        readings = [(m, self._start_read(m._driver)) for m in self.matrices]
+        driven = {}
+        with self.batch():
+            for matrix, crosspoints in readings:
+                if isinstance(crosspoints, Future):
+                    try:
+                        crosspoints = crosspoints.result()
+                    except NotImplementedError:
+                        crosspoints = {}
+                driven[matrix] = matrix.reconcile(crosspoints)
+        return {m: xpts for m, xpts in driven.items() if xpts}
+
+    @staticmethod
+    def _start_read(driver):
+        try:
+            reading = driver.read_crosspoints()
+        except (AttributeError, NotImplementedError):
+            return {}
+        if asyncio.iscoroutine(reading):
+            reading.close()
+            raise TypeError("asyncio drivers can only be read by areconcile")
+        return reading
+
+    async def areconcile(self):
+        """The asyncio version of reconcile, reading back and driving
+        the matrices concurrently"""
+        readings = await asyncio.gather(*(self._aread(m._driver)
+                                          for m in self.matrices))
+        driven = {}
+        async with self.abatch():
+            for matrix, crosspoints in zip(self.matrices, readings):
+                driven[matrix] = matrix.reconcile(crosspoints)
+        return {m: xpts for m, xpts in driven.items() if xpts}
+
+    @classmethod
+    async def _aread(kls, driver):
+        read = getattr(driver, 'read_crosspoints', None)
+        if read is None:
+            return {}
+        try:
+            if asyncio.iscoroutinefunction(read):
+                return await read()
+            result = await asyncio.get_running_loop().run_in_executor(None, read)
+            if isinstance(result, Future):
+                result = await asyncio.wrap_future(result)
+            return result
+        except NotImplementedError:
+            return {}
+
+    def invalidate(self):
+        """Mark the compiled topology as stale"""
+        self._compiled = False
+
+    def compile(self):
+        """Rebuild the adjacency arrays from the registered matrices"""
+        offsets = array('l', [0])
+        kinds = array('b')
+        targets = array('l')
+        slots = []
+        sources = {}
+        idx = 0
+        # Registering a newly plugged upstream matrix extends
+        # self.matrices, so this can't be a for loop.
+        while idx < len(self.matrices):
+            for inp in self.matrices[idx].inputs:
+                if isinstance(inp, MatrixOutput):
+                    upstream = inp.port[0]
+                    if upstream not in self._ids:
+                        self.register(upstream)
+                    kinds.append(self.TRUNK)
+                    targets.append(self._ids[upstream])
+                elif inp is None:
+                    kinds.append(self.EMPTY)
+                    targets.append(-1)
+                else:
+                    kinds.append(self.SOURCE)
+                    targets.append(sources.setdefault(inp, len(sources)))
+                slots.append(inp)
+            offsets.append(len(kinds))
+            idx += 1
+
+        self.offsets = offsets
+        self.kinds = kinds
+        self.targets = targets
+        self.slots = slots
+        self.sources = list(sources)
+        self._compiled = True
+
+    def _ensure_compiled(self):
+        if not self._compiled:
+            with self._lock:
+                if not self._compiled:
+                    self.compile()
+
+    def _slots(self, node):
+        return range(self.offsets[node], self.offsets[node + 1])
+
+    def reachable(self, matrix: Matrix):
+        """Return the set of sources which can currently reach matrix"""
+        self._ensure_compiled()
+        found = set()
+        seen = set()
+        pending = [self._ids[matrix]]
+        while pending:
+            node = pending.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            for slot in self._slots(node):
+                kind = self.kinds[slot]
+                if kind == self.SOURCE:
+                    found.add(self.sources[self.targets[slot]])
+                elif kind == self.TRUNK:
+                    trunk = self.slots[slot]
+                    if trunk.locked:
+                        found.add(trunk.source)
+                    else:
+                        pending.append(self.targets[slot])
+        return found
+
+    def carrying(self, source: Source):
+        """Return the set of outputs of this graph carrying source"""
+        return MatrixOutput.carrying(source, self.matrices)
+
+    def trunk_usage(self):
+        """Report (claimed, total) trunks from each upstream matrix"""
+        self._ensure_compiled()
+        usage = {}
+        for slot, kind in enumerate(self.kinds):
+            if kind == self.TRUNK:
+                trunk = self.slots[slot]
+                claimed, total = usage.get(trunk.port[0], (0, 0))
+                usage[trunk.port[0]] = claimed + trunk.locked, total + 1
+        return usage
+
+    def route(self, matrix: Matrix, source: Source):
+        """Return the first hop of the cheapest route, or None
+
+        Routes are found, and cached, by the ShortestPathRouter in
+        self.router, so the graph can be used as the router of a Matrix.
+        """
+        return self.router.route(matrix, source)
@@ -1,4 +1,4 @@
-from contextlib import suppress
+from .batch import abatch
 
 class SourceGroup:
     """Manages groups of signal sources with companion relationships and output assignments.
@@ -29,6 +29,8 @@ class SourceGroup:
 
     Attributes:
         groups (dict): Dictionary containing the group names and their associated signal source
+            Use add_group and remove_group to change the groups, so the companion
+            index is kept up to date.
     """
     def __init__(self, /, **kwargs):
         self.groups = kwargs
@@ -36,6 +38,40 @@ class SourceGroup:
             for grp, output in assignments.items():
                 for signal in self.groups[grp]:
                     signal.preferred_out = output
+        self._reindex()
+
+    def _reindex(self):
+        """Rebuild the source -> position and position -> companions maps"""
+        positions = {}
+        companions = {}
+        for sourceset in self.groups.values():
+            for idx, source in enumerate(sourceset):
+                if source is not None:
+                    positions.setdefault(source, idx)
+                    companions.setdefault(idx, []).append(source)
+        self._positions = positions
+        self._companions = {idx: tuple(c) for idx, c in companions.items()}
+
+    def add_group(self, name, sources, preferred_out=None):
+        """Add, or replace, a group of sources
+
+        Args:
+            name (str): The group name
+            sources: list of sources, None may be used for empty positions
+            preferred_out: if given, set as the preferred output of every source
+        """
+        self.groups[name] = sources
+        if preferred_out is not None:
+            for signal in sources:
+                if signal is not None:
+                    signal.preferred_out = preferred_out
+        self._reindex()
+
+    def remove_group(self, name):
+        """Remove a group of sources, returning the removed sources"""
+        sources = self.groups.pop(name)
+        self._reindex()
+        return sources
 
     def get_companions(self, source):
         """Get all sources at same index position across groups.
@@ -57,22 +93,10 @@ class SourceGroup:
 
             get_companions(B) would return {E} since B and E are both at index 1
         """
-        idx = None
-        for sourceset in self.groups.values():
-            with suppress(ValueError):
-                idx = sourceset.index(source)
-                break
-
-        if idx is not None:
-            rv = set()
-            for sourceset in self.groups.values():
-                with suppress(IndexError):
-                    companion = sourceset[idx]
-                    if companion is not None and companion is not source:
-                        rv.add(companion)
-            return rv
-
-        return set()
+        idx = self._positions.get(source)
+        if idx is None:
+            return set()
+        return {c for c in self._companions[idx] if c is not source}
 
 
 class MatrixGroup:
@@ -125,9 +149,26 @@ class MatrixGroup:
                     outp.select(other_src, nolock=True)
                 else:
                     print(f"skipping {other_src}, no pref output")
+            if mat.metrics is not None:
+                mat.metrics.observe('companion_fanout', len(companions),
+                                    mat.name)
+
+    async def aselect(self, matrix, idx, src, no_companions=False):
+        """Asynchronous version of select
+
+        The source and its companions are routed first, then the
+        crosspoints are sent to all the matrices concurrently; so
+        the latency is that of the slowest device rather than the
+        sum of them.
+        """
+        async with abatch():
+            self.select(matrix, idx, src, no_companions)
 
     def get_output(self, name, idx: int):
         return self.matrices[name].outputs[idx]
 
     def available(self, group):
         return self.matrices[group].available_sources
+
+    def is_available(self, group, src):
+        return self.matrices[group].is_available(src)
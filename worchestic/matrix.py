@@ -1,11 +1,24 @@
 # vid_matrix.py - Video matrix control logic
 
-from contextlib import suppress
+import asyncio
+from contextlib import suppress, contextmanager, nullcontext, ExitStack
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextvars import ContextVar
 from dataclasses import dataclass
-from typing import Union
+from functools import partial
+from heapq import heappush, heappop
+from itertools import count
+from operator import attrgetter
+from time import perf_counter
+from typing import Protocol, Union
 from .signals import Source, Sink
+from .batch import abatch, current_batch
+from .dispatch import track, waiting_for_drivers, is_async, ASYNC_DRIVER_ERROR
 from .atomics import AtomicInt
 import logging
+import threading
+import weakref
 
 logger = logging.getLogger(__name__)
 
@@ -22,9 +35,247 @@ class UnroutableOutput(ValueError):
     pass
 
 
+_propagation = ContextVar('source_propagation', default=None)
+# Matrices whose route_lock the current thread or task holds
+_held_routes = ContextVar('held_route_locks', default=frozenset())
+# The hops of a route being traced, see metrics.RouteTracer
+route_trace = ContextVar('route_trace', default=None)
+# The changes made under the outermost route_lock, see _Undo
+_undo = ContextVar('route_undo', default=None)
+# {(matrix, source): AvailableSource} hops to use instead of asking
+# the router, see planner.Planner
+planned_routes = ContextVar('planned_routes', default=None)
+# Callable giving the trunk locks of an output as seen by a plan being
+# made, see is_locked and planner.Planner
+lock_view = ContextVar('lock_view', default=None)
+
+
+class _Propagation:
+    """Source changes waiting to be pushed downstream
+
+    A changed output takes its new source straight away, only the fan-out
+    to the outputs fed by it waits. Changed outputs are then processed
+    upstream first, ordered by the rank of their matrix, and an output
+    changed several times fans out once, and not at all if it ends up
+    back on its old source. Sinks other than matrices are told their
+    final source once all the outputs have been processed.
+    """
+    def __init__(self):
+        # output -> its source before the first change
+        self.pending = {}
+        self.queue = []
+        self.sinks = {}
+        self.tie = count()
+
+    def add(self, output: 'MatrixOutput', source):
+        if output not in self.pending:
+            heappush(self.queue, (self.rank(output._device), next(self.tie),
+                                  output))
+            self.pending[output] = output._source
+        if output._source is not source:
+            output._index_source(output._source, source)
+            output._source = source
+            output._invalidate_downstream()
+
+    @staticmethod
+    def rank(matrix):
+        """The longest chain of matrices upstream of matrix
+
+        Ranks are kept on the matrices until an input is replugged.
+        """
+        if not isinstance(matrix, Matrix):
+            return 0
+        generation = Matrix._generation
+
+        def known(m):
+            return m._rank is not None and m._rank[0] == generation
+
+        visiting = set()
+        stack = [matrix]
+        while stack:
+            current = stack[-1]
+            if known(current):
+                stack.pop()
+                continue
+            visiting.add(current)
+            upstream = [inp.port[0] for inp in current.inputs
+                        if isinstance(inp, MatrixOutput)]
+            todo = [m for m in upstream if not known(m) and m not in visiting]
+            if todo:
+                stack.extend(todo)
+                continue
+            rank = 1 + max((m._rank[1] for m in upstream if known(m)),
+                           default=-1)
+            current._rank = generation, rank
+            stack.pop()
+        return matrix._rank[1]
+
+    def run(self):
+        # Sinks may make more changes, so go round until none are left
+        while self.queue or self.sinks:
+            while self.queue:
+                _, _, output = heappop(self.queue)
+                self._update(output, self.pending.pop(output))
+            sinks, self.sinks = self.sinks, {}
+            for sink, output in sinks.values():
+                sink.source_changed(output._source)
+
+    def _update(self, output, old):
+        source = output._source
+        if source is old:
+            return
+        connection = output.connection
+        if isinstance(connection, Matrix.Input):
+            matrix = connection.matrix
+            for idx in list(matrix._users.get(connection.idx, ())):
+                self.add(matrix.outputs[idx], source)
+        elif connection:
+            self.sinks[id(connection)] = connection, output
+
+
+class _Undo:
+    """The state of each output before the current operation changed it
+
+    Every change under the outermost route_lock is noted here, by
+    Matrix._changing, so if the operation raises it can be rolled back
+    as a whole: crosspoints, claims and lock counts are restored, the
+    sources pushed back downstream, and the previous crosspoints driven
+    again for the outputs which were driven. Changes made outside this
+    process, see partition.RemoteOutput, are undone by the callables
+    given to compensate.
+    """
+    __slots__ = ('saved', 'driven', 'compensations')
+
+    def __init__(self):
+        # output -> (current input, holding, lock count, source)
+        self.saved = {}
+        self.driven = set()
+        # key -> callable, the first registered for each key is kept
+        self.compensations = {}
+
+    def save(self, matrix, idx):
+        output = matrix.outputs[idx]
+        if output not in self.saved:
+            self.saved[output] = (matrix._current.get(idx), idx in matrix._holding,
+                                  output._sem.load(), output._source)
+
+    def compensate(self, key, undo):
+        """Call undo on rollback, unless something was already
+        registered for key"""
+        self.compensations.setdefault(key, undo)
+
+    def rollback(self):
+        for key, undo in reversed(list(self.compensations.items())):
+            try:
+                undo()
+            except Exception as e:
+                logger.error("failed rolling back %s: %r", key, e)
+        if not self.saved:
+            return
+        # Routine for a route which can't be made, driver failures
+        # are logged as errors where they happen
+        logger.debug("Rolling back changes to %d outputs", len(self.saved))
+        with propagation() as changes:
+            for output, (current, holding, locks, source) in self.saved.items():
+                matrix, idx = output.port
+                if current is None:
+                    matrix._clear_current(idx)
+                else:
+                    matrix._set_current(idx, current)
+                if holding:
+                    matrix._holding.add(idx)
+                else:
+                    matrix._holding.discard(idx)
+                output._sem.store(locks)
+                output._invalidate_downstream()
+                changes.add(output, source)
+                if current is not None and output in self.driven:
+                    self._redrive(matrix, current, idx)
+
+    @staticmethod
+    def _redrive(matrix, input_idx, idx):
+        # Best effort, the original error is the one to report
+        try:
+            matrix._drive(input_idx, idx)
+        except Exception as e:
+            logger.error("%s: failed restoring %s->%s: %r",
+                         matrix, input_idx, idx, e)
+
+
+def _undo_route(undo):
+    """Roll back a route whose driver commands failed after its route
+    locks were let go, see Batch.on_failure
+
+    Best effort: routes made since, through the same outputs, are
+    overwritten.
+    """
+    matrices = [output.port[0] for output in undo.saved]
+    with _all_locked(matrices) if matrices else nullcontext():
+        undo.rollback()
+
+
+def _all_locked(matrices):
+    """The route_lock of every matrix in matrices, and their upstream"""
+    matrices = list(matrices)
+    if not matrices:
+        raise ValueError("No matrices given")
+    return matrices[0].route_lock(*matrices[1:])
+
+
+@contextmanager
+def propagation():
+    """Push the source changes made in this block downstream in one pass
+
+    Without this each change is pushed downstream as it is made.
+    Inside the block a changed output reports its new source at once,
+    so later routes in the block can share its trunk, but the outputs
+    downstream of it may report their old source until the block exits.
+    Nested blocks join the outermost.
+
+    Examples:
+        >>> with propagation():
+        ...     for idx, source in enumerate(new_sources):
+        ...         leaf.replug_input(idx, source)
+    """
+    if _propagation.get() is not None:
+        yield _propagation.get()
+        return
+    changes = _Propagation()
+    token = _propagation.set(changes)
+    try:
+        yield changes
+    finally:
+        try:
+            changes.run()
+        finally:
+            _propagation.reset(token)
+
+
+def _changing(device, idx):
+    """Matrix._changing, if device is a Matrix"""
+    if isinstance(device, Matrix):
+        device._changing(idx)
+
+
+def _route_lock(device):
+    """The route_lock of device, if it is a Matrix"""
+    if isinstance(device, Matrix):
+        return device.route_lock()
+    return nullcontext()
+
+
 class MatrixOutput:
     """A Matrix output is a source, which is
     the output of a specific discoverable matrix"""
+    __slots__ = ('_source', '_sem', '_device', '_idx', 'connection',
+                 '__weakref__')
+    # matrix -> {source uuid: indexes of its outputs carrying that
+    # source}; emptied entries are removed, see _index_source
+    _carrying = weakref.WeakKeyDictionary()
+    # source -> the outputs carrying it, for queries over every matrix
+    _carried_by = weakref.WeakKeyDictionary()
+    _carrying_lock = threading.Lock()
+
     def __init__(self, device: 'Matrix',
                  idx: int, sink: Sink = None):
         self._source = None
@@ -39,9 +290,64 @@ class MatrixOutput:
             sink.source_changed(self._source)
 
     def _source_changed(self, source):
-        if self._source is not source:
-            self._source = source
-            self.connection and self.connection.source_changed(source)
+        with propagation() as changes:
+            changes.add(self, source)
+
+    def _index_source(self, old, new):
+        device = self._device
+        with self._carrying_lock:
+            index = self._carrying.get(device)
+            if index is None:
+                index = self._carrying[device] = {}
+            if old is not None:
+                outputs = index.get(old.uuid)
+                if outputs is not None:
+                    outputs.discard(self._idx)
+                    if not outputs:
+                        del index[old.uuid]
+                outputs = self._carried_by.get(old)
+                if outputs is not None:
+                    outputs.discard(self)
+                    if not outputs:
+                        del self._carried_by[old]
+            if new is not None:
+                index.setdefault(new.uuid, set()).add(self._idx)
+                outputs = self._carried_by.get(new)
+                if outputs is None:
+                    outputs = self._carried_by[new] = weakref.WeakSet()
+                outputs.add(self)
+            if not index:
+                del self._carrying[device]
+
+    @classmethod
+    def carrying(kls, source, matrices=None):
+        """Return the set of outputs currently carrying source
+
+        Args:
+            matrices: only look at the outputs of these matrices, see
+                FabricGraph.carrying; every matrix if not given
+        """
+        with kls._carrying_lock:
+            if matrices is None:
+                outputs = kls._carried_by.get(source)
+                if outputs is None:
+                    return set()
+                if not outputs:
+                    # Only outputs of discarded matrices carried it
+                    del kls._carried_by[source]
+                return set(outputs)
+            found = set()
+            for matrix in matrices:
+                index = kls._carrying.get(matrix)
+                if index is not None:
+                    found.update(matrix.outputs[idx]
+                                 for idx in index.get(source.uuid, ()))
+            return found
+
+    def _invalidate_downstream(self):
+        """Drop the cached reachability of whatever is fed by this output"""
+        invalidate = getattr(self.connection, 'invalidate_sources', None)
+        invalidate and invalidate()
 
     def __str__(self):
         return f"{self._device.name}.outputs[{self._idx}]"
@@ -65,22 +371,34 @@ class MatrixOutput:
 
     def select(self, src: 'InputSignal', nolock: bool = False):
         """Select an alternate signal for this output, locking the output"""
-        if src.uuid != self.uuid:
-            if self.locked:
-                raise LockedOutput(f"{self} is locked/in use")
-            self._device._select(self._idx, src)
-            self._source_changed(src)
-        if not nolock:
-            self.claim()
+        with _route_lock(self._device):
+            if src.uuid != self.uuid or not self._device._routed(self._idx):
+                if self.locked:
+                    raise LockedOutput(f"{self} is locked/in use")
+                with waiting_for_drivers():
+                    self._device._select(self._idx, src)
+                self._source_changed(src)
+            if not nolock:
+                self.claim()
+
+    async def aselect(self, src: 'InputSignal', nolock: bool = False):
+        """Select asynchronously, driving the matrices on the route concurrently"""
+        async with abatch():
+            self.select(src, nolock)
 
     def release(self):
         """Release a lock on the output"""
-        self._sem.dec()
-        if self._sem.load() < 0:
-            # Attempt to recover!
-            self._sem.inc()
-            raise AlreadyUnlocked("Invalid lock state")
-        self._device.release(self._idx)
+        with _route_lock(self._device):
+            _changing(self._device, self._idx)
+            self._sem.dec()
+            if self._sem.load() < 0:
+                # Attempt to recover!
+                self._sem.inc()
+                raise AlreadyUnlocked("Invalid lock state")
+            self._invalidate_downstream()
+            if not self._sem.load():
+                # Last user gone, so free the route feeding us
+                self._device.release(self._idx)
 
     def claim(self):
         """Claim a lock on the output
@@ -89,21 +407,302 @@ class MatrixOutput:
         by a downstream matrix, to prevent the output from being
         selected being reassigning to a different source.    
         """
-        self._sem.inc()
+        with _route_lock(self._device):
+            _changing(self._device, self._idx)
+            self._sem.inc()
+            self._invalidate_downstream()
 
 
 class MatrixDriver:
     def select(self, input: int, output: int):
         raise NotImplementedError()
 
+    def select_many(self, crosspoints):
+        """Select a list of (input, output) crosspoints
+
+        Drivers which can send several crosspoints in one
+        command should override this.
+        """
+        for input, output in crosspoints:
+            self.select(input, output)
+
+    def read_crosspoints(self):
+        """Return the crosspoints the hardware holds, as {output: input}
+
+        Optional; drivers which can read back the state of the
+        hardware should override this, so Matrix.reconcile only
+        drives the crosspoints which differ. Outputs whose input
+        is unknown are left out.
+        """
+        raise NotImplementedError()
+
+
+class AsyncMatrixDriver(Protocol):
+    """A driver whose commands are coroutines
+
+    Matrices with asyncio drivers must be selected with the
+    aselect methods, or inside an abatch block; otherwise the select
+    raises TypeError and is rolled back. The route locks are still
+    threading locks, taken on the event loop's thread, so an aselect
+    waiting for a route being made by another thread blocks the loop
+    until it is done. A driver
+    may also provide an ``async def select_many(crosspoints)``
+    and an ``async def read_crosspoints()``.
+    """
+    async def select(self, input: int, output: int) -> None:
+        pass
+
 
 InputSignal = Union[MatrixOutput, Source]
 
 
+def is_locked(output: 'MatrixOutput'):
+    """True if output is claimed
+
+    While a Planner is planning this includes the trunks claimed, less
+    those released, by the routes planned so far; cost functions should
+    use this rather than output.locked.
+    """
+    view = lock_view.get()
+    if view is None:
+        return output.locked
+    return bool(view(output))
+
+
+def hop_cost(matrix: 'Matrix', idx: int, inp: InputSignal):
+    """Default edge cost for the router.
+
+    Matches the path_len reported by iter_sources; so an already
+    claimed trunk carrying the source is free, and any other
+    hop costs one.
+    """
+    if isinstance(inp, MatrixOutput) and is_locked(inp):
+        return 0
+    return 1
+
+
+def scarce_trunk_cost(matrix: 'Matrix', idx: int, inp: InputSignal):
+    """Edge cost which steers routes away from busy upstream matrices
+
+    An unclaimed trunk costs more the fewer unclaimed outputs
+    its matrix has left, so routes spread across parallel trunks
+    rather than using up the last path to a source.
+    """
+    if isinstance(inp, MatrixOutput) and not is_locked(inp):
+        outputs = inp.port[0].outputs
+        busy = sum(1 for o in outputs if is_locked(o))
+        return 1 + busy / len(outputs)
+    return hop_cost(matrix, idx, inp)
+
+
+class _Live:
+    """The trunk locks and sources as they are, see shortest_path"""
+    @staticmethod
+    def locks(output):
+        return output.locked
+
+    @staticmethod
+    def source_of(output):
+        return output._source
+
+
+def shortest_path(matrix: 'Matrix', source: Source, cost=hop_cost, view=_Live):
+    """Find the cheapest route from matrix back to source
+
+    Runs Dijkstra's algorithm upstream across the fabric. Between routes
+    of the same cost the one with the fewest trunks not already carrying
+    the source wins, so trunks are shared, and released trunks whose
+    crosspoints still carry the source are re-used. This is the search
+    used by ShortestPathRouter, FabricGraph and planner.Planner.
+
+    Args:
+        cost: callable(matrix, input_idx, input), see ShortestPathRouter
+        view: gives locks(output) and source_of(output) for each trunk,
+            so a plan can be searched against the routes planned so far.
+
+    Returns:
+        (hops, path_len, expanded) where hops is a list of (matrix,
+        input idx, input) from matrix to the source, or None if there
+        is no route, and expanded is the set of matrices searched.
+    """
+    tie = count()
+    # Entries: (cost, fresh, tie, node, path, path_len) where node is
+    # None once the source is reached, path is a (hop, rest) linked
+    # list and fresh counts the trunks not already carrying the source.
+    queue = [(0, 0, next(tie), matrix, None, 0)]
+    expanded = set()
+    while queue:
+        total, fresh, _, node, path, path_len = heappop(queue)
+        if node is None:
+            hops = []
+            while path is not None:
+                hop, path = path
+                hops.append(hop)
+            hops.reverse()
+            return hops, path_len, expanded
+        if node in expanded:
+            continue
+        expanded.add(node)
+        for idx, inp in enumerate(node.inputs):
+            if isinstance(inp, MatrixOutput):
+                new = int(view.source_of(inp) is not source)
+                if view.locks(inp):
+                    if new:
+                        continue
+                    target, length = None, path_len
+                else:
+                    target, length = inp.port[0], path_len + 1
+                    if target in expanded:
+                        continue
+            elif inp is source and inp is not None:
+                new, target, length = 0, None, path_len + 1
+            else:
+                continue
+            weight = cost(node, idx, inp)
+            if weight is not None:
+                heappush(queue, (total + weight, fresh + new, next(tie),
+                                 target, ((node, idx, inp), path), length))
+    return None, None, expanded
+
+
+# A cached route which can't be used, see ShortestPathRouter._recall
+_STALE = object()
+
+
+class ShortestPathRouter:
+    """Finds the cheapest route from a matrix back to a source
+
+    Runs Dijkstra's algorithm upstream across the fabric, from the
+    matrix towards the source, see shortest_path. Each matrix is
+    expanded at most once and the search stops at the first route to
+    the source, so the cost grows with the number of trunks, not the
+    number of paths.
+
+    Routes can be kept in a bounded LRU cache, keyed on the matrix and
+    source. The cache holds weak references, so it keeps nothing in
+    the fabric alive. A cached route is used while every matrix the
+    search expanded has the same Matrix.stamp, as the search only looks
+    at the inputs of those matrices. That holds for hop_cost, but not for costs which
+    look elsewhere in the fabric, like scarce_trunk_cost, which shouldn't
+    be cached.
+
+    Args:
+        cost: callable(matrix, input_idx, input) giving the cost
+            of using that input of matrix, or None if the input
+            must not be used.
+        cache_size (int): The number of routes to cache, 0 to disable.
+    """
+    def __init__(self, cost=hop_cost, cache_size=0):
+        self.cost = cost
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def cache_info(self):
+        """Return the hits, misses and size of the route cache"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._cache), 'maxsize': self.cache_size}
+
+    def cache_clear(self):
+        with self._cache_lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+    def route(self, matrix: 'Matrix', source: Source):
+        """Return the first hop of the cheapest route, or None
+
+        The first hop is returned as an Matrix.AvailableSource of matrix.
+        """
+        if not self.cache_size:
+            return self._search(matrix, source)[0]
+
+        key = id(matrix), source.uuid
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                route = self._recall(matrix, source, entry)
+                if route is not _STALE:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return route
+            self.misses += 1
+
+        route, expanded = self._search(matrix, source)
+        entry = self._remember(matrix, source, route, expanded)
+        with self._cache_lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return route
+
+    @staticmethod
+    def _remember(matrix, source, route, expanded):
+        """A cache entry for route, holding only weak references so
+        the cache keeps no matrix, source or trunk alive"""
+        hop = None
+        if route is not None:
+            hop = route.input_idx, route.path_len, weakref.ref(route.path)
+        return (weakref.ref(matrix), weakref.ref(source), hop,
+                [(weakref.ref(m), m.stamp) for m in expanded])
+
+    @staticmethod
+    def _recall(matrix, source, entry):
+        """The route kept in entry, or _STALE if anything it refers to
+        has gone or changed"""
+        matrix_ref, source_ref, hop, stamps = entry
+        # The ids in the key may have been re-used
+        if matrix_ref() is not matrix or source_ref() is not source:
+            return _STALE
+        for ref, stamp in stamps:
+            searched = ref()
+            if searched is None or searched.stamp != stamp:
+                return _STALE
+        if hop is None:
+            return None
+        input_idx, path_len, path = hop
+        path = path()
+        if path is None:
+            return _STALE
+        return matrix.AvailableSource(input_idx, path_len, path, source)
+
+    def _search(self, matrix: 'Matrix', source: Source):
+        """Return the first hop of the cheapest route, and the
+        matrices expanded to find it"""
+        hops, path_len, expanded = shortest_path(matrix, source, self.cost)
+        if hops is None:
+            return None, expanded
+        _, idx, inp = hops[0]
+        return matrix.AvailableSource(idx, path_len, inp, source), expanded
+
+
 class Matrix:
     """An instance of this class
-    represents a single switch element"""
+    represents a single switch element
+
+    Each matrix has a re-entrant lock. Anything which changes the
+    routing through a matrix holds the locks of that matrix and every
+    matrix upstream of it, see route_lock. Notifications of source
+    changes flowing downstream don't take locks.
+    """
+    router = ShortestPathRouter(cache_size=1024)
+    fabric = None
+    # See state.Journal
+    journal = None
+    # Anything with an observe(metric, value, device) method,
+    # see metrics.Recorder
+    metrics = None
+    # See metrics.RouteTracer
+    tracer = None
+    _creation_order = count()
+    # Bumped whenever any input is replugged, see upstream
+    _generation = 0
+
     class Input:
+        __slots__ = ('matrix', 'idx')
+
         def __init__(self, matrix, idx):
             self.matrix = matrix
             self.idx = idx
@@ -111,14 +710,36 @@ class Matrix:
         def source_changed(self, src):
             self.matrix._input_changed(self.idx, src)
 
+        def invalidate_sources(self):
+            self.matrix._input_state_changed(self.idx)
+
     def __init__(self, name: str, driver: MatrixDriver, inputs: InputSignal,
-                 nr_outputs: int):
+                 nr_outputs: int, router: ShortestPathRouter = None):
         self.name = name
+        if router is not None:
+            self.router = router
         self._driver = driver
         self.inputs = inputs[:] # Take a shallow copy, to avoid surprises
                                 # when re-plugging inputs
         self.outputs = [None] * nr_outputs
         self._current = {}
+        self._reachable = None
+        # (reachability index, available_sources) see available_sources
+        self._available = None
+        # Outputs whose route holds its claim on its input
+        self._holding = set()
+        # input idx -> the outputs currently routed from it
+        self._users = {}
+        self._lock = threading.RLock()
+        self._order = next(self._creation_order)
+        self._upstream = None
+        self._rank = None
+        # See stamp
+        self._topology = 0
+        self._input_keys = [0] * len(self.inputs)
+        self._signature = 0
+        for idx in range(len(self.inputs)):
+            self._input_state_changed(idx)
         for idx in range(nr_outputs):
             self.outputs[idx] = MatrixOutput(self, idx)
 
@@ -129,8 +750,124 @@ class Matrix:
     def __str__(self):
         return self.name
 
+    @property
+    def stamp(self):
+        """Identifies the state of the inputs of this matrix
+
+        The stamp changes when an input is replugged and when a trunk
+        input is locked, unlocked or changes source. The source of an
+        unlocked trunk counts too, as the router prefers trunks already
+        carrying the source, see shortest_path. It is an incrementally
+        updated hash of the trunk states, so returning to an earlier
+        state gives the earlier stamp back.
+        """
+        return self._topology, self._signature
+
+    def _input_state_changed(self, idx):
+        inp = self.inputs[idx]
+        key = 0
+        if isinstance(inp, MatrixOutput) and (inp.locked or inp._source):
+            key = hash((idx, inp.locked, id(inp._source)))
+        self._signature ^= self._input_keys[idx] ^ key
+        self._input_keys[idx] = key
+        self._invalidate_sources()
+
+    @property
+    def rank(self):
+        """The length of the longest chain of matrices upstream of this one"""
+        return _Propagation.rank(self)
+
+    def upstream(self):
+        """Return the set of this matrix and every matrix upstream of it
+
+        The set is kept until an input anywhere is replugged.
+        """
+        generation = Matrix._generation
+        cached = self._upstream
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        found = {self}
+        pending = [self]
+        while pending:
+            for inp in pending.pop().inputs:
+                if isinstance(inp, MatrixOutput):
+                    device = inp.port[0]
+                    if device not in found:
+                        found.add(device)
+                        pending.append(device)
+        found = frozenset(found)
+        self._upstream = generation, found
+        return found
+
+    @contextmanager
+    def route_lock(self, *others: 'Matrix'):
+        """Hold the locks of this matrix and every matrix upstream of it
+
+        These are all the matrices a route to this matrix can use.
+        The locks are taken in the order the matrices were created, so
+        concurrent routes can't deadlock, and routes through
+        disjoint sets of matrices don't block each other.
+
+        Args:
+            others: more matrices to lock, along with their upstream
+        """
+        def closure():
+            return self.upstream().union(*(m.upstream() for m in others))
+
+        held = _held_routes.get()
+        if self in held and held.issuperset(others):
+            # Already held, by a select further downstream
+            yield
+            return
+
+        metrics = self.metrics
+        if metrics is not None:
+            start = perf_counter()
+        while True:
+            matrices = sorted(closure(), key=attrgetter('_order'))
+            with ExitStack() as stack:
+                for matrix in matrices:
+                    stack.enter_context(matrix._lock)
+                # Retry if an input was replugged while we waited
+                if closure().issubset(matrices):
+                    if metrics is not None:
+                        metrics.observe('route_lock_wait_seconds',
+                                        perf_counter() - start, self.name)
+                    token = _held_routes.set(held.union(matrices))
+                    undo = _Undo()
+                    undo_token = _undo.set(undo)
+                    try:
+                        yield
+                    except BaseException:
+                        _undo.reset(undo_token)
+                        undo_token = None
+                        undo.rollback()
+                        raise
+                    else:
+                        # Commands queued in a batch sent after we let go
+                        # of the locks; roll back if they fail
+                        batch = current_batch.get()
+                        if batch is not None and (undo.saved
+                                                  or undo.compensations):
+                            batch.on_failure(partial(_undo_route, undo))
+                    finally:
+                        if undo_token is not None:
+                            _undo.reset(undo_token)
+                        _held_routes.reset(token)
+                        # Log the changes while still holding the locks,
+                        # so the journal has them in the order they were made
+                        if self.journal is not None:
+                            self.journal.commit()
+                    break
+        if self.journal is not None:
+            # Wait for the journal after letting go of the locks, so
+            # other routes can join the same write
+            self.journal.wait()
+
     @dataclass
     class AvailableSource:
+        # No defaults, so the fields can be slots.
+        __slots__ = ('input_idx', 'path_len', 'path', 'source')
         input_idx: int
         path_len: int
         path: InputSignal
@@ -138,21 +875,153 @@ class Matrix:
 
     @property
     def available_sources(self):
-        """List the available sources for this matrix"""
-        return set(x.source for x in self.iter_sources())
+        """The set of available sources for this matrix
+
+        The set is kept with the reachability index, so polling it
+        is cheap while nothing upstream changes.
+        """
+        reachable = self._reachability_index()
+        cached = self._available
+        if cached is None or cached[0] is not reachable:
+            self._available = cached = reachable, frozenset(reachable[1])
+        return cached[1]
+
+    def routes_to(self, source: Source):
+        """List the AvailableSource entries which reach source"""
+        return self._reachability_index()[1].get(source, [])
+
+    def is_available(self, source: Source):
+        """True if source can be routed to this matrix
+
+        Uses the reachability index if it is already built, otherwise
+        asks the router, which searches for the one source rather than
+        listing every route the fabric has.
+        """
+        reachable = self._reachable
+        if reachable is not None:
+            return source in reachable[1]
+        return self.router.route(self, source) is not None
+
+    def query_sources(self, source: Source = None, max_path_len: int = None,
+                      exclude_locked: bool = False, unique: bool = False):
+        """Lazily iterate over the routes into this matrix
+
+        Unlike iter_sources this doesn't build the reachability index
+        for this matrix, so a caller can stop as soon as it has found
+        what it wants. The index of an upstream matrix is used if it
+        is already built.
+
+        Args:
+            source: only routes to this source
+            max_path_len: only routes with at most this path_len;
+                upstream matrices which can't meet it aren't walked
+            exclude_locked: skip routes which would share a claimed trunk
+            unique: only the first route found to each source
+
+        Yields:
+            AvailableSource entries
+        """
+        routes = self._stream_sources(max_path_len, exclude_locked)
+        if source is not None:
+            routes = (r for r in routes if r.source is source)
+        if unique:
+            routes = self._first_per_source(routes)
+        return routes
+
+    @staticmethod
+    def _first_per_source(routes):
+        seen = set()
+        for route in routes:
+            if route.source not in seen:
+                seen.add(route.source)
+                yield route
+
+    def _stream_sources(self, limit, exclude_locked):
+        reachable = self._reachable
+        if reachable is not None and not exclude_locked:
+            # The index can't tell which routes cross a claimed trunk
+            # further upstream, so is only used when that doesn't matter.
+            for route in reachable[0]:
+                if limit is None or route.path_len <= limit:
+                    yield route
+            return
+
+        for idx, inp in enumerate(self.inputs):
+            if isinstance(inp, MatrixOutput):
+                if inp.locked:
+                    if not exclude_locked:
+                        yield self.AvailableSource(idx, 0, inp, inp._source)
+                    continue
+                if limit is not None and limit < 1:
+                    continue
+                upstream = inp.port[0]._stream_sources(
+                    None if limit is None else limit - 1, exclude_locked)
+                for route in upstream:
+                    yield self.AvailableSource(idx, route.path_len + 1,
+                                               inp, route.source)
+            elif inp is not None and (limit is None or limit >= 1):
+                yield self.AvailableSource(idx, 1, inp, inp)
+
+    def _reachability_index(self):
+        """Return the cheapest route into this matrix through each input
+        to each source, and those routes keyed by the source they reach.
+
+        Each upstream matrix contributes one entry per source from its
+        own index, so the index grows with inputs times sources rather
+        than with the number of paths through the fabric. The index is
+        built on first use and kept until something upstream of this
+        matrix changes, see _invalidate_sources.
+        """
+        reachable = self._reachable
+        if reachable is None:
+            with self.route_lock():
+                cheapest = {}
+                for route in self._walk_sources():
+                    key = route.input_idx, route.source
+                    kept = cheapest.get(key)
+                    if kept is None or route.path_len < kept.path_len:
+                        cheapest[key] = route
+                routes = list(cheapest.values())
+                index = {}
+                for route in routes:
+                    index.setdefault(route.source, []).append(route)
+                self._reachable = reachable = routes, index
+        return reachable
+
+    def _invalidate_sources(self):
+        """Forget the reachability index for this matrix and everything
+        downstream of it.
+
+        A matrix downstream of one without an index either has no index
+        itself, or doesn't use ours as all of its trunks from us are
+        locked; in which case it is told directly when they change.
+        So there is nothing to pass on if we have no index.
+        """
+        if self._reachable is None:
+            return
+        self._reachable = None
+        for output in self.outputs:
+            output._invalidate_downstream()
 
     def iter_sources(self):
+        return iter(self._reachability_index()[0])
+
+    def _walk_sources(self):
+        # Checked once, as this runs for every route into the matrix
+        debug = logger.isEnabledFor(logging.DEBUG)
         for idx, inp in enumerate(self.inputs):
             if isinstance(inp, MatrixOutput):
                 if inp.locked:
                     # If the input is locked don't recurse.
                     # but it is available itself.
-                    logger.debug(f"locked - {idx}, {inp}")
+                    if debug:
+                        logger.debug("locked - %s, %s", idx, inp)
                     yield self.AvailableSource(idx,  0, inp, inp._source)
                     continue
 
                 for source in inp.port[0].iter_sources():
-                    logger.debug(f"unlocked - {idx}, {source.source.uuid}")
+                    if debug:
+                        logger.debug("unlocked - %s, %s", idx, source.source.uuid)
                     yield self.AvailableSource(idx, source.path_len + 1,
                                                inp, source.source)
             else:
@@ -160,44 +1029,209 @@ class Matrix:
                     yield self.AvailableSource(idx, 1, inp, inp)
 
     def _input_changed(self, idx, source):
-        for out, inp in self._current.items():
+        for out in list(self._users.get(idx, ())):
             #if self.outputs[out].locked:
             #    raise LockedOutput(f"Input {idx} is used by locked output {self.outputs[out]}")
-            if idx == inp:
-                self.outputs[out]._source_changed(source)
+            self.outputs[out]._source_changed(source)
+
+    def outputs_using(self, idx):
+        """Return the output indexes currently routed from input idx"""
+        return set(self._users.get(idx, ()))
+
+    def _changing(self, idx, driving=False):
+        """Note output idx is about to change, so the change can be
+        rolled back and journalled"""
+        undo = _undo.get()
+        if undo is not None:
+            undo.save(self, idx)
+            if driving:
+                undo.driven.add(self.outputs[idx])
+        if self.journal is not None:
+            self.journal.touch(self, idx)
+
+    def _set_current(self, idx, input_idx):
+        self._changing(idx)
+        previous = self._current.get(idx)
+        if previous is not None:
+            self._users[previous].discard(idx)
+        self._current[idx] = input_idx
+        self._users.setdefault(input_idx, set()).add(idx)
+
+    def _clear_current(self, idx):
+        self._changing(idx)
+        previous = self._current.pop(idx, None)
+        if previous is not None:
+            self._users[previous].discard(idx)
 
     def replug_input(self, idx, source):
         """Changes the input found on a source"""
-        self._input_changed(idx, source)
-        self.inputs[idx] = source
-        # Propagate the change to the output, and it
-        # should notify us of it's connected signal
-        if isinstance(source, MatrixOutput):
-            source.connected_to(self.Input(self, idx))
+        others = [source.port[0]] if isinstance(source, MatrixOutput) else []
+        with self.route_lock(*others):
+            self._input_changed(idx, source)
+            old, self.inputs[idx] = self.inputs[idx], source
+            self._topology += 1
+            Matrix._generation += 1
+            self._input_state_changed(idx)
+            if self.fabric is not None:
+                self.fabric.invalidate()
+                if isinstance(source, Source):
+                    self.fabric.registry.register(source)
+                if isinstance(old, Source) and not self.fabric.plugs(old):
+                    self.fabric.registry.unregister(old)
+            if self.journal is not None:
+                self.journal.replugged(self, idx, source)
+            # Propagate the change to the output, and it
+            # should notify us of it's connected signal
+            if isinstance(source, MatrixOutput):
+                source.connected_to(self.Input(self, idx))
 
     def select(self, idx, source: Source):
         """Sets output (idx) to connect to source
 
         Propagates up the switch fabric as necessary.
         """
-        self.outputs[idx].select(source, nolock=True)
+        tracer = self.tracer
+        traced = nullcontext() if tracer is None else tracer.route(self, idx, source)
+        with traced:
+            with self.route_lock():
+                self.outputs[idx].select(source, nolock=True)
+
+    async def aselect(self, idx, source: Source):
+        """Sets output (idx) to connect to source, asynchronously
+
+        The crosspoints for every matrix on the route are sent
+        concurrently once the route has been planned.
+        """
+        async with abatch():
+            self.select(idx, source)
 
     def _select(self, idx, source: Source):
         "internal select function"
-        logger.info(f"{self}: assigning {idx} to {source.uuid}")
+        logger.info("%s: assigning %s to %s", self, idx, source.uuid)
+        if self._rehold(idx, source):
+            return
         self.release(idx)
 
-        routes = [s for s in self.iter_sources() if s.source == source]
-        if not routes:
+        planned = planned_routes.get()
+        route = None if planned is None else planned.get((self, source))
+        if route is None:
+            metrics = self.metrics
+            if metrics is None:
+                route = self.router.route(self, source)
+            else:
+                start = perf_counter()
+                route = self.router.route(self, source)
+                metrics.observe('route_search_seconds',
+                                perf_counter() - start, self.name)
+        if route is None:
             raise UnroutableOutput(f"{self}:{source.uuid} is not routable to output {idx}")
 
-        route = min(routes, key=lambda s: s.path_len)
         if isinstance(route.path, MatrixOutput):
-            logger.info(f"({self})Using output {route.path}({route.path_len}) "
-                        f"for {idx}")
+            logger.info("(%s)Using output %s(%s) for %s",
+                        self, route.path, route.path_len, idx)
             route.path.select(route.source)
-        self._driver.select(route.input_idx, idx)
-        self._current[idx] = route.input_idx
+        trace = route_trace.get()
+        if trace is not None:
+            trace.append((self, idx, route.input_idx, False))
+        self._drive(route.input_idx, idx)
+        self._set_current(idx, route.input_idx)
+        self._holding.add(idx)
+
+    def _rehold(self, idx, source: Source):
+        """Hold output idx on its old crosspoint, if it still carries source
+
+        A released output keeps its crosspoint, so if nothing has
+        re-used its input since, it can be claimed again without
+        driving anything.
+        """
+        current = self._current.get(idx)
+        if (current is None or idx in self._holding
+                or self.outputs[idx]._source is not source):
+            return False
+        inp = self.inputs[current]
+        if isinstance(inp, MatrixOutput):
+            if inp._source is not source:
+                return False
+            inp.select(source)
+        elif inp is not source:
+            return False
+        logger.debug("%s: re-holding %s on %s", self, idx, current)
+        trace = route_trace.get()
+        if trace is not None:
+            trace.append((self, idx, current, True))
+        self._changing(idx)
+        self._holding.add(idx)
+        return True
+
+    def read_crosspoints(self):
+        """Read the crosspoints the hardware holds, as {output: input}
+
+        Returns an empty dict if the driver can't read them back.
+        """
+        try:
+            crosspoints = self._driver.read_crosspoints()
+        except (AttributeError, NotImplementedError):
+            return {}
+        if asyncio.iscoroutine(crosspoints):
+            crosspoints.close()
+            raise TypeError("asyncio drivers can only be read by "
+                            "FabricGraph.areconcile")
+        if isinstance(crosspoints, Future):
+            crosspoints = crosspoints.result()
+        return crosspoints
+
+    def reconcile(self, crosspoints=None):
+        """Drive the crosspoints where the hardware differs from the
+        routing state
+
+        For use after the hardware has been power cycled, or when
+        starting up with restored state. Outputs which aren't routed
+        are left as they are.
+
+        Args:
+            crosspoints: the hardware state as {output: input}, read
+                with read_crosspoints if not given
+
+        Returns:
+            The (input, output) crosspoints driven
+        """
+        with self.route_lock():
+            if crosspoints is None:
+                crosspoints = self.read_crosspoints()
+            changes = [(inp, out) for out, inp in sorted(self._current.items())
+                       if crosspoints.get(out) != inp]
+            for inp, out in changes:
+                self._drive(inp, out)
+        if changes:
+            logger.info("%s: reconciled %d crosspoints", self, len(changes))
+        return changes
+
+    def _routed(self, idx):
+        """True if output idx is routed and holds its input"""
+        return idx in self._holding
+
+    def _drive(self, input_idx, idx):
+        """Send a crosspoint to the driver, or queue it in the
+        current batch
+
+        Raises TypeError for an asyncio driver outside an abatch, as
+        nothing would send the command; under the route locks, so the
+        route is rolled back.
+        """
+        batch = current_batch.get()
+        if (batch is None or not batch.asynchronous) and is_async(self._driver):
+            raise TypeError(ASYNC_DRIVER_ERROR)
+        self._changing(idx, driving=True)
+        if batch is not None:
+            batch.queue(self, input_idx, idx)
+        elif self.metrics is None:
+            track(self._driver.select(input_idx, idx))
+        else:
+            start = perf_counter()
+            track(self._driver.select(input_idx, idx))
+            self.metrics.observe('driver_command_seconds',
+                                 perf_counter() - start, self.name)
+            self.metrics.observe('driver_crosspoints', 1, self.name)
 
     def release(self, idx):
         """Releases a hold on any signal which feeds this input
@@ -205,9 +1239,13 @@ class Matrix:
            - Allows the currently used input for this output to be switched
              to a different signal
         """
-        try:
-            current = self.inputs[self._current[idx]]
-            current.release()
-            logger.debug(f"released {current and current.uuid}")
-        except (KeyError, AttributeError) as e:
-            logger.debug(f"skipping release: {e!r}")
+        with self.route_lock():
+            try:
+                if idx in self._holding:
+                    self._changing(idx)
+                self._holding.remove(idx)
+                current = self.inputs[self._current[idx]]
+                current.release()
+                logger.debug("released %s", current and current.uuid)
+            except (KeyError, AttributeError) as e:
+                logger.debug("skipping release: %r", e)
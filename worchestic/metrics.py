@@ -0,0 +1,197 @@
+# metrics.py - Timings and counts from the routing hot paths
+import json
+import logging
+import random
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from .matrix import Matrix, route_trace
+
+trace_logger = logging.getLogger('worchestic.trace')
+
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# name -> (help text, buckets)
+METRICS = {
+    'route_search_seconds': ("Time spent finding a route", TIME_BUCKETS),
+    'route_lock_wait_seconds': ("Time spent waiting for route locks",
+                                TIME_BUCKETS),
+    'driver_command_seconds': ("Time spent sending a command to a driver",
+                               TIME_BUCKETS),
+    'driver_crosspoints': ("Crosspoints sent per driver command",
+                           COUNT_BUCKETS),
+    'companion_fanout': ("Companion sources routed per group select",
+                         COUNT_BUCKETS),
+}
+
+
+class Histogram:
+    """Counts of observed values falling into fixed buckets"""
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Yield (upper bound, count of values <= it), as Prometheus does"""
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Recorder:
+    """Keeps a histogram of each metric for each device, in memory
+
+    Any object with the same observe method can be used as the
+    metrics of a matrix instead, to send the values elsewhere.
+
+    Examples:
+        >>> recorder = metrics.enable()
+        >>> root.select(0, cam1)
+        >>> print(recorder.prometheus())
+    """
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, metric: str, value: float, device: str = ''):
+        """Record a value for metric, one of the names in METRICS"""
+        key = metric, device
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                buckets = METRICS.get(metric, ('', TIME_BUCKETS))[1]
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def histogram(self, metric: str, device: str = ''):
+        """Return the Histogram for metric and device, or None"""
+        return self._histograms.get((metric, device))
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def prometheus(self, prefix='worchestic_'):
+        """Return the histograms in the Prometheus text format"""
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        lines = []
+        last = None
+        for (metric, device), histogram in histograms:
+            name = prefix + metric
+            if metric != last:
+                help_text = METRICS.get(metric, (metric,))[0]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                last = metric
+            label = f'device="{_escape(device)}"'
+            for bound, count in histogram.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f'{name}_bucket{{{label},le="{le}"}} {count}')
+            lines.append(f"{name}_sum{{{label}}} {histogram.sum}")
+            lines.append(f"{name}_count{{{label}}} {histogram.count}")
+        return ''.join(line + '\n' for line in lines)
+
+
+class RouteTracer:
+    """Records the hops of a sample of routes
+
+    Each sampled Matrix.select produces one record, a dict with the
+    matrix, output and source asked for, every hop taken, upstream
+    first, as {matrix, output, input, reused}, where reused means an existing
+    crosspoint was claimed again, how long it took and any error.
+    Records are logged as JSON to the worchestic.trace logger, with
+    the dict as the ``route`` attribute of the log record, unless a
+    sink is given.
+
+    Args:
+        rate (float): the fraction of routes to trace
+        sink: callable given each record
+    """
+    def __init__(self, rate=0.01, sink=None):
+        self.rate = rate
+        self.sink = sink or self._log
+        self._random = random.Random()
+
+    def sampled(self):
+        return self.rate >= 1 or self._random.random() < self.rate
+
+    @contextmanager
+    def route(self, matrix, idx, source):
+        """Trace the route made in this block, if it is sampled"""
+        if route_trace.get() is not None or not self.sampled():
+            # Part of a route already being traced, or not sampled
+            yield
+            return
+        hops = []
+        token = route_trace.set(hops)
+        error = None
+        start = perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            seconds = perf_counter() - start
+            route_trace.reset(token)
+            self.sink({
+                'matrix': matrix.name,
+                'output': idx,
+                'source': source.name,
+                'uuid': str(source.uuid),
+                'hops': [{'matrix': m.name, 'output': out, 'input': inp,
+                          'reused': reused}
+                         for m, out, inp, reused in hops],
+                'seconds': seconds,
+                'error': error,
+            })
+
+    @staticmethod
+    def _log(record):
+        trace_logger.info("route %s", json.dumps(record),
+                          extra={'route': record})
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def enable(recorder=None):
+    """Send the metrics of every matrix to recorder, a new Recorder
+    if not given, and return it"""
+    if recorder is None:
+        recorder = Recorder()
+    Matrix.metrics = recorder
+    return recorder
+
+
+def disable():
+    """Stop collecting metrics from matrices without their own"""
+    Matrix.metrics = None
+
+
+def enable_tracing(rate=0.01, sink=None):
+    """Trace a sample of the routes made on every matrix,
+    returns the RouteTracer"""
+    Matrix.tracer = tracer = RouteTracer(rate, sink)
+    return tracer
+
+
+def disable_tracing():
+    Matrix.tracer = None
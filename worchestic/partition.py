@@ -0,0 +1,468 @@
+# partition.py - Splitting a fabric across processes
+"""Splitting a fabric across processes
+
+Each process owns some of the matrices and their drivers, and serves
+them with a PartitionServer. Another process connects to it with a
+Partition, whose RemoteOutput proxies stand in for the trunks coming
+from those matrices; they are used as inputs of local matrices like any
+other MatrixOutput.
+
+A router searching upstream sees the remote matrix as one hop from every
+source it can reach, and selecting a RemoteOutput asks the owning
+process to make, and claim, the rest of the route with its own router.
+So each process only searches its own matrices, and route planning
+spreads across processes, and hosts when the address is a (host, port).
+
+The view of a remote matrix is fetched again after ``ttl`` seconds, or
+when Partition.refresh is called; changes this process makes through a
+partition are seen straight away. Changes made there by other processes
+are only seen after that, in the meantime a route through the stale
+view fails with the error raised by the owner and is rolled back.
+Partitions must be cascaded without loops, as a route holds the route
+locks of each process along it while waiting for the next upstream.
+
+FabricGraph compiles the topology of a single process, so matrices fed
+by a RemoteOutput should use ShortestPathRouter, the default router.
+
+Examples:
+    In the process owning the leaf matrices::
+
+        >>> PartitionServer([leaf1, leaf2], "/run/worchestic/rack1").serve_forever()
+
+    In the process owning the root::
+
+        >>> rack1 = Partition("/run/worchestic/rack1")
+        >>> root = Matrix("root", driver, rack1.matrix("leaf1").outputs, 4)
+        >>> root.select(0, rack1.source("cam1"))
+"""
+import logging
+import multiprocessing
+import threading
+import time
+from functools import partial
+from multiprocessing.connection import Listener, Client
+from uuid import UUID
+from .matrix import (Matrix, MatrixOutput, LockedOutput, AlreadyUnlocked,
+                     _undo)
+from .signals import Source
+
+logger = logging.getLogger(__name__)
+
+_mirror_lock = threading.Lock()
+
+
+def _authkey(authkey):
+    # Processes started by multiprocessing share their parent's key
+    if authkey is None:
+        return multiprocessing.current_process().authkey
+    return authkey
+
+
+def _mirror(uuid, name):
+    """The Source of this process standing in for a source of another"""
+    key = UUID(uuid)
+    with _mirror_lock:
+        try:
+            return Source.get(key)
+        except KeyError:
+            pass
+        return Source(name, guid=key)
+
+
+def _state(output):
+    """How an output's source is sent to another process"""
+    source = output.source
+    return None if source is None else (str(source.uuid), source.name)
+
+
+class PartitionServer:
+    """Serves the matrices owned by this process to other partitions
+
+    Each connection is served by its own thread, with requests run as
+    the equivalent calls on the matrices, so they take the route locks
+    and are journalled as usual.
+
+    Args:
+        matrices: the matrices to serve, by name
+        address: a Unix socket path, or a (host, port)
+        authkey (bytes): shared with the clients, defaults to the key of
+            this process, which processes it starts inherit
+    """
+    def __init__(self, matrices, address, authkey=None):
+        self.matrices = {m.name: m for m in matrices}
+        self._authkey = _authkey(authkey)
+        self._listener = Listener(address, authkey=self._authkey)
+        self.address = self._listener.address
+        self._closed = False
+        self._thread = None
+
+    def start(self):
+        """Serve in a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name=f"partition {self.address}",
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                return
+            except multiprocessing.AuthenticationError as e:
+                logger.warning("%s: refused a connection: %r", self.address, e)
+                continue
+            if self._closed:
+                conn.close()
+                return
+            threading.Thread(target=self._serve, args=(conn,),
+                             daemon=True).start()
+
+    def close(self):
+        """Stop accepting connections"""
+        if self._closed:
+            return
+        self._closed = True
+        # accept() isn't woken by closing the listener, so connect to it
+        try:
+            Client(self.address, authkey=self._authkey).close()
+        except OSError:
+            pass
+        self._listener.close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    op, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = 'ok', getattr(self, '_op_' + op)(*args)
+                except Exception as e:
+                    reply = 'error', e
+                try:
+                    conn.send(reply)
+                except (EOFError, OSError):
+                    return
+                except Exception as e:
+                    # The result or error couldn't be pickled
+                    conn.send(('error', RuntimeError(repr(e))))
+
+    def _output(self, name, idx):
+        return self.matrices[name].outputs[idx]
+
+    def _op_outputs(self, name):
+        return len(self.matrices[name].outputs)
+
+    def _op_sources(self, name):
+        # Shortest path_len to each source
+        lengths = {}
+        for route in self.matrices[name].iter_sources():
+            if route.source is not None:
+                length = lengths.get(route.source)
+                if length is None or route.path_len < length:
+                    lengths[route.source] = route.path_len
+        return [(str(source.uuid), source.name, length)
+                for source, length in lengths.items()]
+
+    def _op_crosspoints(self, name):
+        return dict(self.matrices[name]._current)
+
+    def _op_select(self, name, idx, uuid, claim):
+        output = self._output(name, idx)
+        output.select(self._source(output._device, UUID(uuid)),
+                      nolock=not claim)
+        return _state(output)
+
+    @staticmethod
+    def _source(matrix, key):
+        """The Source with uuid key, from the registry of the fabric
+        of matrix if it is in one, else the default registry"""
+        fabric = matrix.fabric
+        if fabric is not None:
+            try:
+                return fabric.registry.get(key)
+            except KeyError:
+                pass
+        return Source.get(key)
+
+    def _op_claim(self, name, idx):
+        output = self._output(name, idx)
+        output.claim()
+        return _state(output)
+
+    def _op_release(self, name, idx):
+        output = self._output(name, idx)
+        output.release()
+        return _state(output)
+
+    def _op_state(self, name, idx):
+        return _state(self._output(name, idx))
+
+
+class RemoteOutput(MatrixOutput):
+    """An output of a matrix owned by another partition
+
+    The lock count is kept here; the owner holds a single claim on the
+    output while it is above zero, as the trunk can only feed this
+    process. Changes to it are rolled back with the route which made
+    them.
+    """
+    __slots__ = ()
+
+    def _call(self, op, *args):
+        device = self._device
+        try:
+            return device.partition.call(op, device.name, self._idx, *args)
+        finally:
+            device.invalidate()
+
+    def _update(self, state):
+        self._source_changed(None if state is None else _mirror(*state))
+
+    def _saving(self):
+        undo = _undo.get()
+        if undo is not None:
+            undo.compensate(self, partial(self._restore, self._sem.load()))
+
+    def _restore(self, locks):
+        held = self.locked
+        self._sem.store(locks)
+        if held and not locks:
+            op = 'release'
+        elif locks and not held:
+            op = 'claim'
+        else:
+            op = 'state'
+        self._update(self._call(op))
+        self._invalidate_downstream()
+
+    def select(self, src: Source, nolock: bool = False):
+        """Select src on the output, in the owning process, and lock it"""
+        with self._device._lock:
+            if self.locked:
+                if src.uuid != self.uuid:
+                    raise LockedOutput(f"{self} is locked/in use")
+                if not nolock:
+                    self.claim()
+                return
+            self._saving()
+            self._update(self._call('select', str(src.uuid), not nolock))
+            if not nolock:
+                self._sem.inc()
+                self._invalidate_downstream()
+
+    def claim(self):
+        with self._device._lock:
+            self._saving()
+            if not self.locked:
+                self._update(self._call('claim'))
+            self._sem.inc()
+            self._invalidate_downstream()
+
+    def release(self):
+        with self._device._lock:
+            if not self.locked:
+                raise AlreadyUnlocked("Invalid lock state")
+            self._saving()
+            self._sem.dec()
+            self._invalidate_downstream()
+            if not self.locked:
+                self._update(self._call('release'))
+
+
+class RemoteMatrix:
+    """Stands in for a matrix owned by another partition
+
+    Its inputs are the sources the matrix can reach, as reported by
+    the owner, so a router reaches each of them in one hop from here;
+    the route taken to them is left to the owner.
+    """
+    def __init__(self, partition: 'Partition', name: str):
+        self.partition = partition
+        self.name = name
+        self._lock = threading.RLock()
+        self._order = next(Matrix._creation_order)
+        # Remote crosspoints aren't known here, see planner._Overlay
+        self._current = {}
+        self._holding = frozenset()
+        self._inputs = None
+        self._path_lens = []
+        self._fetched = None
+        self._version = 0
+        self.outputs = [RemoteOutput(self, idx)
+                        for idx in range(partition.call('outputs', name))]
+
+    def __str__(self):
+        return f"{self.partition.address}:{self.name}"
+
+    @property
+    def _rank(self):
+        # Nothing upstream of it is in this process
+        return Matrix._generation, 0
+
+    @property
+    def inputs(self):
+        fetched = self._fetched
+        if fetched is None or time.monotonic() - fetched > self.partition.ttl:
+            self.refresh()
+        return self._inputs
+
+    @property
+    def stamp(self):
+        """Changes when the sources reachable through the matrix do"""
+        self.inputs
+        return 0, self._version
+
+    def refresh(self):
+        """Fetch the sources reachable through the matrix"""
+        with self._lock:
+            reply = self.partition.call('sources', self.name)
+            inputs = [_mirror(uuid, name) for uuid, name, _ in reply]
+            self._path_lens = [length for _, _, length in reply]
+            changed = inputs != self._inputs
+            self._inputs = inputs
+            self._fetched = time.monotonic()
+            if changed:
+                self._version += 1
+                self._invalidate_sources()
+
+    def invalidate(self):
+        """Fetch the reachable sources again when next needed"""
+        self._fetched = None
+        self._invalidate_sources()
+
+    def _invalidate_sources(self):
+        for output in self.outputs:
+            output._invalidate_downstream()
+
+    def upstream(self):
+        return frozenset((self,))
+
+    def iter_sources(self):
+        inputs = self.inputs
+        return iter([Matrix.AvailableSource(idx, length, source, source)
+                     for idx, (source, length)
+                     in enumerate(zip(inputs, self._path_lens))])
+
+    def _stream_sources(self, limit, exclude_locked):
+        return (route for route in self.iter_sources()
+                if limit is None or route.path_len <= limit)
+
+
+class Partition:
+    """A connection to the matrices served by a PartitionServer
+
+    Args:
+        address: the address the server listens on
+        authkey (bytes): as given to the server
+        ttl (float): seconds before the sources reachable through a
+            remote matrix are fetched again
+        timeout (float): seconds to keep trying to connect, while the
+            server starts up
+    """
+    def __init__(self, address, authkey=None, ttl: float = 1.0,
+                 timeout: float = 5.0):
+        self.address = address
+        self.ttl = ttl
+        self._conn = self._connect(address, _authkey(authkey), timeout)
+        self._lock = threading.Lock()
+        self._matrices = {}
+
+    @staticmethod
+    def _connect(address, authkey, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return Client(address, authkey=authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.01)
+
+    def __str__(self):
+        return f"Partition({self.address})"
+
+    def call(self, op, *args):
+        """Run a request in the server, raising any error it raised"""
+        with self._lock:
+            self._conn.send((op, args))
+            status, result = self._conn.recv()
+        if status == 'error':
+            raise result
+        return result
+
+    def matrix(self, name: str) -> RemoteMatrix:
+        """The RemoteMatrix for a matrix served by the partition"""
+        matrix = self._matrices.get(name)
+        if matrix is None:
+            matrix = self._matrices[name] = RemoteMatrix(self, name)
+        return matrix
+
+    def output(self, name: str, idx: int) -> RemoteOutput:
+        return self.matrix(name).outputs[idx]
+
+    def sources(self, name: str):
+        """The sources which can be routed to the matrix name"""
+        return list(self.matrix(name).inputs)
+
+    def source(self, name: str):
+        """The source called name reachable through any matrix fetched
+        from this partition"""
+        for matrix in self._matrices.values():
+            for source in matrix.inputs:
+                if source.name == name:
+                    return source
+        raise KeyError(name)
+
+    def crosspoints(self, name: str):
+        """The routed crosspoints of the matrix name, as {output: input}"""
+        return self.call('crosspoints', name)
+
+    def refresh(self):
+        """Forget the fetched view of every remote matrix"""
+        for matrix in list(self._matrices.values()):
+            matrix.invalidate()
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def serve(build, address, authkey=None):
+    """Serve the matrices returned by build() until the process is killed
+
+    For use as the target of a process, see spawn_partition.
+    """
+    PartitionServer(build(), address, authkey).serve_forever()
+
+
+def spawn_partition(build, address, authkey=None, context='spawn'):
+    """Start a process owning the matrices build() returns, and serving
+    them at address
+
+    build must be picklable, a module level function say, as it is
+    called in the new process.
+
+    Returns:
+        The started multiprocessing.Process; connect with Partition(address)
+    """
+    process = multiprocessing.get_context(context).Process(
+        target=serve, args=(build, address, authkey), daemon=True)
+    process.start()
+    return process
@@ -0,0 +1,322 @@
+# planner.py - Checking routes are feasible before driving them
+import asyncio
+import time
+from .batch import batch, abatch
+from .matrix import (Matrix, MatrixOutput, LockedOutput, UnroutableOutput,
+                     hop_cost, planned_routes, lock_view,
+                     shortest_path, _all_locked)
+
+
+class RoutePlan:
+    """The hops of one planned route
+
+    Each hop is a (matrix, output idx, input idx, input) tuple,
+    from the matrix the route was asked for back towards the source.
+    new_trunks lists the trunks the route claims which weren't
+    already carrying the source.
+    """
+    __slots__ = ('matrix', 'idx', 'source', 'hops', 'new_trunks')
+
+    def __init__(self, matrix, idx, source):
+        self.matrix = matrix
+        self.idx = idx
+        self.source = source
+        self.hops = []
+        self.new_trunks = []
+
+    def __repr__(self):
+        return f"RoutePlan({self.matrix}.outputs[{self.idx}] <- {self.source})"
+
+
+def _locked(routes):
+    """The route_lock of every matrix in a list of routes"""
+    return _all_locked(route[0] for route in routes)
+
+
+class Reservation:
+    """Trunks claimed ahead of time for a salvo, see Planner.reserve
+
+    Each route keeps a claim on the trunk feeding it, with the route
+    upstream of the trunk already made, so triggering the salvo only
+    sends the last crosspoint of each route.
+    """
+    def __init__(self, name, routes):
+        self.name = name
+        # (matrix, output idx, source, AvailableSource of matrix)
+        self.routes = routes
+        self.active = True
+
+    def __repr__(self):
+        return f"Reservation({self.name!r}, {len(self.routes)} routes)"
+
+    @property
+    def trunks(self):
+        """The trunks claimed by this reservation"""
+        return [route.path for _, _, _, route in self.routes
+                if isinstance(route.path, MatrixOutput)]
+
+    def trigger(self, at: float = None):
+        """Make the reserved routes, as one batch
+
+        Args:
+            at: a time.time() to wait for before sending them
+        """
+        if at is not None:
+            time.sleep(max(0, at - time.time()))
+        with _locked(self.routes):
+            with batch():
+                self._fire()
+
+    async def atrigger(self, at: float = None):
+        """The asyncio version of trigger, driving every matrix at once"""
+        if at is not None:
+            await asyncio.sleep(max(0, at - time.time()))
+        async with abatch():
+            with _locked(self.routes):
+                self._fire()
+
+    def cancel(self):
+        """Give up the reserved trunks"""
+        with _locked(self.routes):
+            self._check_active()
+            self._release()
+
+    def _check_active(self):
+        if not self.active:
+            raise ValueError(f"{self} has already been used or cancelled")
+
+    def _fire(self):
+        self._check_active()
+        for matrix, idx, source, route in self.routes:
+            token = planned_routes.set({(matrix, source): route})
+            try:
+                matrix.select(idx, source)
+            finally:
+                planned_routes.reset(token)
+        # The routes hold their own claims now
+        self._release()
+
+    def _release(self):
+        for trunk in self.trunks:
+            trunk.release()
+        self.active = False
+
+
+class _Overlay:
+    """The routing state of a set of matrices, with the changes
+    made by the routes planned so far laid over it"""
+    def __init__(self):
+        self.sem = {}
+        self.source = {}
+        self.current = {}
+        self.holding = {}
+
+    def locks(self, output):
+        return self.sem.get(output, output._sem.load())
+
+    def source_of(self, output):
+        return self.source.get(output, output._source)
+
+    def current_of(self, matrix, idx):
+        return self.current.get((matrix, idx), matrix._current.get(idx))
+
+    def holds(self, matrix, idx):
+        return self.holding.get((matrix, idx), idx in matrix._holding)
+
+
+class Planner:
+    """Plans routes against the current trunk locks, without touching
+    any driver or changing the routing state
+
+    A salvo is planned route by route, each route seeing the trunks
+    claimed and released by those before it, so a salvo which would
+    run out of trunks part way through is turned down before anything
+    is sent to the hardware. Routes are found with the same rules as
+    the routers, with trunks already carrying the source preferred;
+    pass scarce_trunk_cost as the cost to also keep unclaimed trunks
+    spread over the upstream matrices.
+
+    Args:
+        cost: edge cost function, as used by ShortestPathRouter. It
+            sees the planned trunk locks through is_locked.
+
+    Examples:
+        >>> planner = Planner()
+        >>> planner.feasible([(root, 0, cam1), (root, 1, cam2)])
+        True
+        >>> planner.salvo([(root, 0, cam1), (root, 1, cam2)])
+    """
+    def __init__(self, cost=hop_cost):
+        self.cost = cost
+
+    def plan(self, routes):
+        """Plan a list of (matrix, output idx, source) routes
+
+        Returns:
+            A list of RoutePlan, in the order given
+
+        Raises:
+            LockedOutput, UnroutableOutput: as the selects would have
+        """
+        overlay = _Overlay()
+        plans = []
+        token = lock_view.set(overlay.locks)
+        try:
+            for matrix, idx, source in routes:
+                plan = RoutePlan(matrix, idx, source)
+                self._select(overlay, matrix, idx, source, plan)
+                plans.append(plan)
+        finally:
+            lock_view.reset(token)
+        return plans
+
+    def feasible(self, routes):
+        """True if every route in the list can be made"""
+        try:
+            self.plan(routes)
+        except (LockedOutput, UnroutableOutput):
+            return False
+        return True
+
+    def reserve(self, routes, name=None):
+        """Claim the trunks for a list of (matrix, output idx, source)
+        routes ahead of time
+
+        The outputs keep their current routes, but the route to each
+        matrix is made up to, and including, the trunk feeding it,
+        which stays claimed until the Reservation is triggered or
+        cancelled. If any route can't be reserved nothing is.
+
+        Returns:
+            A Reservation
+        """
+        routes = list(routes)
+        reserved = []
+        with _locked(routes):
+            with batch():
+                for matrix, idx, source in routes:
+                    path = self._search(_Overlay(), matrix, source)
+                    if path is None:
+                        raise UnroutableOutput(f"{matrix}:{source} is not "
+                                               f"routable to output {idx}")
+                    _, input_idx, inp = path[0]
+                    if isinstance(inp, MatrixOutput):
+                        inp.select(source)
+                    reserved.append((matrix, idx, source, Matrix.AvailableSource(
+                        input_idx, len(path), inp, source)))
+        return Reservation(name, reserved)
+
+    def salvo(self, routes):
+        """Plan the routes, then make them as one batch
+
+        The routes are planned and made holding the route locks of
+        every matrix involved, and follow the planned hops; so nothing
+        is driven unless the whole salvo can be made.
+        """
+        routes = list(routes)
+        with _locked(routes):
+            plans = self.plan(routes)
+            with batch():
+                self._apply(plans)
+        return plans
+
+    async def asalvo(self, routes):
+        """The asyncio version of salvo, driving matrices concurrently
+
+        The crosspoints are sent after the route locks are let go; if a
+        driver fails the salvo is rolled back then, see batch.Batch.
+        """
+        routes = list(routes)
+        async with abatch():
+            with _locked(routes):
+                plans = self.plan(routes)
+                self._apply(plans)
+        return plans
+
+    @staticmethod
+    def _apply(plans):
+        for plan in plans:
+            hops = {(m, plan.source): Matrix.AvailableSource(inp_idx, 0, inp,
+                                                              plan.source)
+                    for m, _, inp_idx, inp in plan.hops}
+            token = planned_routes.set(hops)
+            try:
+                plan.matrix.select(plan.idx, plan.source)
+            finally:
+                planned_routes.reset(token)
+
+    def _select(self, overlay, matrix, idx, source, plan):
+        """Matrix.select, on the overlay"""
+        output = matrix.outputs[idx]
+        if overlay.source_of(output) is source and overlay.holds(matrix, idx):
+            return
+        if overlay.locks(output):
+            raise LockedOutput(f"{output} is locked/in use")
+        self._route(overlay, matrix, idx, source, plan)
+
+    def _claim(self, overlay, trunk, source, plan):
+        """MatrixOutput.select, on the overlay"""
+        upstream, idx = trunk.port
+        if not (overlay.source_of(trunk) is source
+                and overlay.holds(upstream, idx)):
+            if overlay.locks(trunk):
+                raise LockedOutput(f"{trunk} is locked/in use")
+            self._route(overlay, upstream, idx, source, plan)
+        if not overlay.locks(trunk):
+            plan.new_trunks.append(trunk)
+        overlay.sem[trunk] = overlay.locks(trunk) + 1
+
+    def _route(self, overlay, matrix, idx, source, plan):
+        """Matrix._select, on the overlay"""
+        if self._rehold(overlay, matrix, idx, source, plan):
+            return
+        self._release(overlay, matrix, idx)
+        path = self._search(overlay, matrix, source)
+        if path is None:
+            raise UnroutableOutput(f"{matrix}:{source} is not routable "
+                                   f"to output {idx}")
+        _, input_idx, inp = path[0]
+        plan.hops.append((matrix, idx, input_idx, inp))
+        if isinstance(inp, MatrixOutput):
+            self._claim(overlay, inp, source, plan)
+        self._connect(overlay, matrix, idx, input_idx, source)
+
+    def _rehold(self, overlay, matrix, idx, source, plan):
+        """Matrix._rehold, on the overlay"""
+        current = overlay.current_of(matrix, idx)
+        if (current is None or overlay.holds(matrix, idx)
+                or overlay.source_of(matrix.outputs[idx]) is not source):
+            return False
+        inp = matrix.inputs[current]
+        if isinstance(inp, MatrixOutput):
+            if overlay.source_of(inp) is not source:
+                return False
+            self._claim(overlay, inp, source, plan)
+        elif inp is not source:
+            return False
+        overlay.holding[matrix, idx] = True
+        return True
+
+    @staticmethod
+    def _connect(overlay, matrix, idx, input_idx, source):
+        overlay.current[matrix, idx] = input_idx
+        overlay.holding[matrix, idx] = True
+        overlay.source[matrix.outputs[idx]] = source
+
+    def _release(self, overlay, matrix, idx):
+        """Matrix.release, on the overlay"""
+        while overlay.holds(matrix, idx):
+            overlay.holding[matrix, idx] = False
+            inp = matrix.inputs[overlay.current_of(matrix, idx)]
+            if not isinstance(inp, MatrixOutput):
+                return
+            locks = overlay.locks(inp) - 1
+            overlay.sem[inp] = locks
+            if locks:
+                return
+            matrix, idx = inp.port
+
+    def _search(self, overlay, matrix, source):
+        """Find the cheapest path to source, as a list of
+        (matrix, input idx, input) hops"""
+        return shortest_path(matrix, source, self.cost, overlay)[0]
@@ -1,39 +1,260 @@
 # signals,py - Information and different video streams in the code
 from typing import Protocol
+import threading
 import uuid
+import weakref
+
+
+class SourceRegistry:
+    """Sources by uuid, indexed by name and preferred output
+
+    Sources are added to the default registry, Source.registry, when
+    they are created, unless another is given. Each FabricGraph also
+    keeps a registry of the sources plugged into its matrices, so
+    several fabrics can share a process without seeing each other's
+    sources.
+
+    Args:
+        weak (bool): hold the sources by weak reference, so sources
+            nothing else refers to drop out of the registry
+
+    Examples:
+        >>> streams = SourceRegistry(weak=True)
+        >>> cams = streams.create(f"ndi{n}" for n in range(1000))
+        >>> streams.by_name("ndi7")
+        [Source(ndi7)]
+    """
+    def __init__(self, weak: bool = False):
+        self.weak = weak
+        self._lock = threading.RLock()
+        # uuid -> source, or a weak reference to it
+        self._sources = {}
+        # weak reference -> uuid, for the sources which have gone
+        self._refs = {}
+        # uuids of sources which have gone, but are still indexed
+        self._dead = []
+        # uuid -> [name, preferred output], as indexed
+        self._keys = {}
+        self._by_name = {}
+        self._by_output = {}
+
+    def __len__(self):
+        with self._lock:
+            self._purge()
+            return len(self._sources)
+
+    def __contains__(self, source):
+        return self._lookup(source.uuid) is source
+
+    def _lookup(self, guid):
+        with self._lock:
+            held = self._sources.get(guid)
+        if held is None or not self.weak:
+            return held
+        return held()
+
+    def _gone(self, ref):
+        # Called by the garbage collector, at any point, so only
+        # noted here, see _purge
+        self._dead.append(ref)
+
+    def _purge(self):
+        while self._dead:
+            guid = self._refs.pop(self._dead.pop(), None)
+            if guid is None:
+                continue
+            held = self._sources.get(guid)
+            if held is not None and held() is None:
+                del self._sources[guid]
+                self._unindex(guid)
+
+    def _unindex(self, guid):
+        name, output = self._keys.pop(guid)
+        self._drop(self._by_name, name, guid)
+        self._drop(self._by_output, output, guid)
+
+    @staticmethod
+    def _index(index, key, guid):
+        if key is not None:
+            index.setdefault(key, set()).add(guid)
+
+    @staticmethod
+    def _drop(index, key, guid):
+        guids = index.get(key)
+        if guids is not None:
+            guids.discard(guid)
+            if not guids:
+                del index[key]
+
+    def register(self, source: 'Source'):
+        self.register_many((source,))
+
+    def register_many(self, sources):
+        """Register many sources, taking the lock once"""
+        with self._lock:
+            self._purge()
+            for source in sources:
+                guid = source.uuid
+                if self._lookup(guid) is source:
+                    continue
+                if guid in self._sources:
+                    # Replacing another source with the same uuid
+                    self._unindex(guid)
+                if self.weak:
+                    ref = weakref.ref(source, self._gone)
+                    self._refs[ref] = guid
+                    self._sources[guid] = ref
+                else:
+                    self._sources[guid] = source
+                self._keys[guid] = [source._name, source._preferred_out]
+                self._index(self._by_name, source._name, guid)
+                self._index(self._by_output, source._preferred_out, guid)
+                if self not in source._registries:
+                    source._registries += (self,)
+
+    def create(self, names, preferred_out=None):
+        """Create and register a source for each name
+
+        Returns:
+            The new sources, in the order of names
+        """
+        sources = [Source._unregistered(name, preferred_out) for name in names]
+        self.register_many(sources)
+        return sources
+
+    def unregister(self, source: 'Source'):
+        with self._lock:
+            guid = source.uuid
+            if self._lookup(guid) is not source:
+                return
+            del self._sources[guid]
+            self._unindex(guid)
+            source._registries = tuple(r for r in source._registries
+                                       if r is not self)
+
+    def _reindex(self, source, index, old, new):
+        """Called by source when an indexed attribute changes"""
+        with self._lock:
+            if self._lookup(source.uuid) is not source:
+                return
+            position = 0 if index == 'name' else 1
+            index = self._by_name if index == 'name' else self._by_output
+            self._drop(index, old, source.uuid)
+            self._index(index, new, source.uuid)
+            self._keys[source.uuid][position] = new
+
+    def get(self, guid):
+        """Return the source with the uuid guid, raising KeyError if
+        there isn't one"""
+        source = self._lookup(guid)
+        if source is None:
+            raise KeyError(guid)
+        return source
+
+    def _find(self, index, key):
+        with self._lock:
+            self._purge()
+            guids = list(index.get(key, ()))
+        found = (self._lookup(guid) for guid in guids)
+        return [source for source in found if source is not None]
+
+    def by_name(self, name: str):
+        """List the sources called name"""
+        return self._find(self._by_name, name)
+
+    def by_preferred_out(self, output):
+        """List the sources whose preferred output is output"""
+        return self._find(self._by_output, output)
+
+    def list(self):
+        """List the registered sources"""
+        with self._lock:
+            self._purge()
+            held = list(self._sources.values())
+        if not self.weak:
+            return held
+        return [source for source in (ref() for ref in held)
+                if source is not None]
+
+    def clear(self):
+        """Forget every source"""
+        for source in self.list():
+            self.unregister(source)
 
 
 class Source:
-    _registry = {}
+    __slots__ = ('uuid', '_name', '_preferred_out', '_registries',
+                 '__weakref__')
+    # The registry sources are added to when created, see reset_registry
+    registry = SourceRegistry()
+
+    def __init__(self, name, preferred_out=None, registry=None, guid=None):
+        self._init(name, preferred_out, guid)
+        if registry is None:
+            registry = self.registry
+        registry.register(self)
 
-    def __init__(self, name, preferred_out=None):
-        self.uuid = uuid.uuid4()
-        self.name = name
-        self.preferred_out = preferred_out
-        self.register(self)
+    def _init(self, name, preferred_out, guid):
+        self.uuid = uuid.uuid4() if guid is None else guid
+        self._name = name
+        self._preferred_out = preferred_out
+        self._registries = ()
+
+    @classmethod
+    def _unregistered(kls, name, preferred_out=None):
+        source = kls.__new__(kls)
+        source._init(name, preferred_out, None)
+        return source
 
     def __repr__(self):
         return f"Source({self.name})"
 
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        old, self._name = self._name, name
+        for registry in self._registries:
+            registry._reindex(self, 'name', old, name)
+
+    @property
+    def preferred_out(self):
+        return self._preferred_out
+
+    @preferred_out.setter
+    def preferred_out(self, output):
+        old, self._preferred_out = self._preferred_out, output
+        for registry in self._registries:
+            registry._reindex(self, 'preferred_out', old, output)
+
     @classmethod
     def register(kls, self):
-        kls._registry[self.uuid] = self
+        kls.registry.register(self)
+
+    @classmethod
+    def create(kls, names, preferred_out=None):
+        """Create and register a source for each name, in bulk"""
+        return kls.registry.create(names, preferred_out)
 
     @classmethod
     def list(kls):
-        return kls._registry.values()
+        """A list of the sources in the default registry"""
+        return kls.registry.list()
 
     @classmethod
-    def reset_registry(kls):
-        """Forget all previous;y created monitors.
+    def reset_registry(kls, weak=False):
+        """Start a new, empty, default registry
 
-        mostly useful of ensuring tests are independent
+        mostly useful of ensuring tests are independent. Registries
+        of a FabricGraph aren't affected, see FabricGraph.reset_registry
         """
-        kls._registry = {}
+        kls.registry = SourceRegistry(weak)
 
     @classmethod
     def get(kls, guid):
-        return kls._registry[guid]
+        return kls.registry.get(guid)
 
 class Sink(Protocol):
     def source_changed(source) -> None:
@@ -0,0 +1,541 @@
+# state.py - Saving and restoring the routing state of a fabric
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from operator import attrgetter
+from uuid import UUID
+from .matrix import Matrix, MatrixOutput, _all_locked
+from .signals import Source
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'WOST'
+VERSION = 1
+_header = struct.Struct('<4sHI')
+# name length, number of inputs, number of outputs
+_matrix = struct.Struct('<HII')
+# current input (-1 for none), holding its input, lock count
+_output = struct.Struct('<iBi')
+
+
+class StateMismatch(ValueError):
+    """The saved state doesn't match the fabric it's restored to"""
+    pass
+
+
+def _matrices(fabric):
+    """Accept a FabricGraph, or an iterable of matrices"""
+    return list(getattr(fabric, 'matrices', fabric))
+
+
+def dumps(fabric):
+    """Return the routing state of the matrices as bytes
+
+    Only the crosspoints, claims and lock counts are saved; the source
+    on each output follows from those, so sources needn't keep their
+    uuid across restarts.
+    """
+    matrices = _matrices(fabric)
+    parts = [_header.pack(MAGIC, VERSION, len(matrices))]
+    with _all_locked(matrices):
+        for matrix in matrices:
+            name = matrix.name.encode('utf-8')
+            parts.append(_matrix.pack(len(name), len(matrix.inputs),
+                                      len(matrix.outputs)))
+            parts.append(name)
+            for idx, output in enumerate(matrix.outputs):
+                parts.append(_output.pack(matrix._current.get(idx, -1),
+                                          idx in matrix._holding,
+                                          output._sem.load()))
+    return b''.join(parts)
+
+
+def snapshot(fabric, path, fsync=True):
+    """Save the routing state of the matrices to path
+
+    The file is written alongside and renamed into place, so
+    a crash leaves either the old or the new snapshot.
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as fh:
+        fh.write(dumps(fabric))
+        if fsync:
+            fh.flush()
+            os.fsync(fh.fileno())
+    os.replace(tmp, path)
+
+
+def loads(fabric, data):
+    """Restore routing state, from dumps, to the matrices
+
+    No driver commands are sent; the hardware is assumed to still
+    hold the saved crosspoints. The matrices must be named and
+    plugged as they were when the state was saved.
+    """
+    matrices = {m.name: m for m in _matrices(fabric)}
+    magic, version, count = _header.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise StateMismatch(f"Not a version {VERSION} routing state")
+    offset = _header.size
+    saved = []
+    for _ in range(count):
+        name_len, nr_inputs, nr_outputs = _matrix.unpack_from(data, offset)
+        offset += _matrix.size
+        name = bytes(data[offset:offset + name_len]).decode('utf-8')
+        offset += name_len
+        matrix = matrices.get(name)
+        if matrix is None:
+            raise StateMismatch(f"No matrix named {name}")
+        if (nr_inputs, nr_outputs) != (len(matrix.inputs), len(matrix.outputs)):
+            raise StateMismatch(f"{name} has changed shape")
+        end = offset + nr_outputs * _output.size
+        saved.append((matrix, _output.iter_unpack(data[offset:end])))
+        offset = end
+
+    with _all_locked(list(matrices.values())):
+        for matrix, outputs in saved:
+            _restore_matrix(matrix, outputs)
+        restored = [m for m, _ in saved]
+        _restore_sources(restored)
+        for matrix in restored:
+            for idx in range(len(matrix.inputs)):
+                matrix._input_state_changed(idx)
+
+
+def _restore_matrix(matrix, outputs):
+    matrix._current = {}
+    matrix._users = {}
+    matrix._holding = set()
+    matrix._reachable = None
+    for idx, (current, holding, locks) in enumerate(outputs):
+        _restore_output(matrix, idx, current, holding, locks)
+
+
+def _restore_output(matrix, idx, current, holding, locks):
+    matrix._clear_current(idx)
+    if current >= 0:
+        matrix._set_current(idx, current)
+    matrix._holding.discard(idx)
+    if holding:
+        matrix._holding.add(idx)
+    matrix.outputs[idx]._sem.store(locks)
+
+
+def _restore_sources(matrices):
+    """Set the source of each output from the restored crosspoints,
+    upstream matrices first."""
+    for matrix in sorted(matrices, key=attrgetter('rank')):
+        for idx, output in enumerate(matrix.outputs):
+            current = matrix._current.get(idx)
+            source = None
+            if current is not None:
+                source = matrix.inputs[current]
+                if isinstance(source, MatrixOutput):
+                    source = source.source
+            output._index_source(output._source, source)
+            output._source = source
+            if output.connection and not isinstance(output.connection,
+                                                    Matrix.Input):
+                output.connection.source_changed(source)
+
+
+def restore(fabric, path):
+    """Restore the routing state saved by snapshot, without driving
+    any crosspoints"""
+    with open(path, 'rb') as fh:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            loads(fabric, data)
+
+
+# Journal records are framed by their length and a CRC32, so a record
+# torn by a crash can be recognised and dropped.
+_frame = struct.Struct('<II')
+_count = struct.Struct('<H')
+_string = struct.Struct('<H')
+# output idx, then as _output
+_output_entry = struct.Struct('<IiBi')
+# input idx, kind of input plugged in
+_replug_entry = struct.Struct('<IB')
+_index = struct.Struct('<I')
+
+_OUTPUT = 1
+_REPLUG = 2
+# The most entries a record can count
+_MAX_ENTRIES = (1 << 16) - 1
+_UNPLUGGED = 0
+_SOURCE = 1
+_TRUNK = 2
+
+
+def _record(entries):
+    """Frame a list of entries as one journal record"""
+    payload = _count.pack(len(entries)) + b''.join(entries)
+    return _frame.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _pack_string(value):
+    value = value.encode('utf-8')
+    return _string.pack(len(value)) + value
+
+
+def _unpack_string(data, offset):
+    length, = _string.unpack_from(data, offset)
+    offset += _string.size
+    return bytes(data[offset:offset + length]).decode('utf-8'), offset + length
+
+
+class Journal:
+    """A write-ahead journal of routing changes
+
+    Each change to the routing, made under a route_lock, is appended
+    to the journal as one record when the outermost route_lock is
+    released. The records hold the resulting state of each changed
+    output, rather than the operation, so replaying them needs neither
+    the router nor the sources of the original run, and replaying a
+    record twice is harmless.
+
+    Records are written and fsync'd by a background thread, so routes
+    committed close together share an fsync (group commit). With
+    sync=True a route doesn't return until its record is on disk (it
+    lets go of its locks while it waits); otherwise up to interval
+    seconds of routing can be lost in a crash.
+
+    When the journal grows beyond max_bytes it is compacted: a snapshot
+    of the fabric is written to snapshot_path and the journal emptied,
+    but for the replugged inputs, which the snapshot doesn't hold.
+    Use Journal.open to restore the snapshot and replay the journal
+    before attaching a journal to a fabric.
+    """
+    def __init__(self, fabric, path, snapshot_path=None, sync=False,
+                 interval=0.005, max_bytes=1 << 20):
+        self.path = path
+        self.snapshot_path = snapshot_path or f"{path}.snap"
+        self.sync = sync
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.fsyncs = 0
+        self._matrices = _matrices(fabric)
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._buffer = []
+        self._appended = 0
+        self._durable = 0
+        self._closed = False
+        self._error = None
+        self._io = threading.Lock()
+        # (matrix name, input idx) -> the latest replug entry, written
+        # back to the journal when it is emptied, see compact
+        self._plugs = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as fh:
+                for payload, _ in _records(fh.read()):
+                    for kind, name, fields, entry in _entries(payload):
+                        if kind == _REPLUG:
+                            self._plugs[name, fields[0]] = entry
+        self._fh = open(path, 'ab')
+        self._size = self._fh.tell()
+        self._flusher = threading.Thread(target=self._run, daemon=True,
+                                         name=f"journal {path}")
+        self._flusher.start()
+        for matrix in self._matrices:
+            matrix.journal = self
+
+    @classmethod
+    def open(cls, fabric, path, snapshot_path=None, **kwargs):
+        """Recover the routing state from the snapshot and journal at
+        path, then start journalling changes to the fabric"""
+        recover(fabric, path, snapshot_path or f"{path}.snap")
+        return cls(fabric, path, snapshot_path, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _pending(self):
+        try:
+            return self._local.pending
+        except AttributeError:
+            self._local.pending = pending = ({}, {})
+            return pending
+
+    def touch(self, matrix, idx):
+        """Note output idx of matrix has changed"""
+        self._pending()[0][matrix, idx] = None
+
+    def replugged(self, matrix, idx, source):
+        """Note input idx of matrix has been replugged to source"""
+        self._pending()[1][matrix, idx] = source
+
+    def commit(self):
+        """Append the changes noted by this thread as one record"""
+        outputs, replugs = self._pending()
+        if not outputs and not replugs:
+            return
+        self._local.pending = ({}, {})
+        entries = []
+        for (matrix, idx), source in replugs.items():
+            entries.append(self._replug(matrix, idx, source))
+        for matrix, idx in outputs:
+            entries.append(bytes((_OUTPUT,)) + _pack_string(matrix.name)
+                           + _output_entry.pack(idx,
+                                                matrix._current.get(idx, -1),
+                                                idx in matrix._holding,
+                                                matrix.outputs[idx]._sem.load()))
+        record = _record(entries)
+        with self._cond:
+            if self._closed:
+                raise ValueError("Journal is closed")
+            for (matrix, idx), entry in zip(replugs, entries):
+                self._plugs[matrix.name, idx] = entry
+            self._buffer.append(record)
+            self._appended += 1
+            seq = self._appended
+            self._cond.notify_all()
+        self._local.seq = seq
+
+    def wait(self):
+        """With sync, wait until this thread's last record is on disk"""
+        if self.sync:
+            with self._cond:
+                self._wait(getattr(self._local, 'seq', 0))
+
+    @staticmethod
+    def _replug(matrix, idx, source):
+        entry = bytes((_REPLUG,)) + _pack_string(matrix.name)
+        if isinstance(source, MatrixOutput):
+            device, out = source.port
+            return (entry + _replug_entry.pack(idx, _TRUNK)
+                    + _pack_string(device.name) + _index.pack(out))
+        if source is None:
+            return entry + _replug_entry.pack(idx, _UNPLUGGED)
+        return (entry + _replug_entry.pack(idx, _SOURCE)
+                + _pack_string(source.name or '') + source.uuid.bytes)
+
+    def _wait(self, seq):
+        while self._durable < seq and self._error is None:
+            self._cond.wait()
+        if self._error is not None:
+            raise self._error
+
+    def flush(self):
+        """Wait until every committed record is on disk"""
+        with self._cond:
+            self._wait(self._appended)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._buffer and not self._closed:
+                    self._cond.wait()
+                if not self._buffer:
+                    return
+            if not self._closed:
+                # Let more routes join this write
+                time.sleep(self.interval)
+            try:
+                with self._io:
+                    self._write_buffer()
+            except OSError as e:
+                logger.error("Journal %s failed: %r", self.path, e)
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+            if self._size > self.max_bytes:
+                # Routes waiting on us hold their locks, so don't wait
+                # for them; we'll try again after the next write.
+                self.compact(blocking=False)
+
+    def _write_buffer(self):
+        """Write and fsync the buffered records. Call with _io held, so
+        records reach the file in the order they were committed."""
+        with self._cond:
+            records, self._buffer = self._buffer, []
+            seq = self._appended
+        if records:
+            data = b''.join(records)
+            self._fh.write(data)
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self.fsyncs += 1
+            self._size += len(data)
+        with self._cond:
+            self._durable = seq
+            self._cond.notify_all()
+
+    def compact(self, blocking=True):
+        """Write a snapshot of the fabric and empty the journal
+
+        The snapshot doesn't record which inputs are plugged, so the
+        latest replug of each input is written back to the journal.
+        Returns False if blocking is False and a matrix was busy.
+        """
+        locks = [m._lock for m in sorted(self._matrices, key=attrgetter('_order'))]
+        taken = []
+        try:
+            for lock in locks:
+                if not lock.acquire(blocking):
+                    return False
+                taken.append(lock)
+            # Nothing can commit while we hold every lock, so once the
+            # buffer is written the snapshot covers the whole journal.
+            with self._io:
+                self._write_buffer()
+                snapshot(self._matrices, self.snapshot_path)
+                self._fh.truncate(0)
+                self._fh.seek(0)
+                plugs = list(self._plugs.values())
+                for start in range(0, len(plugs), _MAX_ENTRIES):
+                    self._fh.write(_record(plugs[start:start + _MAX_ENTRIES]))
+                self._fh.flush()
+                os.fsync(self._fh.fileno())
+                self._size = self._fh.tell()
+            return True
+        finally:
+            for lock in reversed(taken):
+                lock.release()
+
+    def close(self):
+        """Write any remaining records and stop journalling"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._flusher.join()
+        for matrix in self._matrices:
+            if matrix.journal is self:
+                matrix.journal = None
+        self._fh.close()
+
+
+def _records(data):
+    """Yield the payload of each intact record, and the offset after it"""
+    offset = 0
+    while offset + _frame.size <= len(data):
+        length, crc = _frame.unpack_from(data, offset)
+        start = offset + _frame.size
+        payload = bytes(data[start:start + length])
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            return
+        offset = start + length
+        yield payload, offset
+
+
+def _entries(payload):
+    """Yield each entry of a record as (kind, matrix name, fields, entry)
+
+    fields are those of _restore_output for an output entry, and
+    (input idx, kind plugged, detail) for a replug, where detail is
+    (matrix name, output idx) for a trunk and (name, uuid) for a source.
+    entry is the bytes of the entry, as written.
+    """
+    count, = _count.unpack_from(payload, 0)
+    offset = _count.size
+    for _ in range(count):
+        start = offset
+        kind = payload[offset]
+        name, offset = _unpack_string(payload, offset + 1)
+        if kind == _OUTPUT:
+            fields = _output_entry.unpack_from(payload, offset)
+            offset += _output_entry.size
+        else:
+            idx, plugged = _replug_entry.unpack_from(payload, offset)
+            offset += _replug_entry.size
+            detail = None
+            if plugged == _TRUNK:
+                device, offset = _unpack_string(payload, offset)
+                out, = _index.unpack_from(payload, offset)
+                offset += _index.size
+                detail = device, out
+            elif plugged == _SOURCE:
+                source_name, offset = _unpack_string(payload, offset)
+                detail = source_name, UUID(bytes=payload[offset:offset + 16])
+                offset += 16
+            fields = idx, plugged, detail
+        yield kind, name, fields, payload[start:offset]
+
+
+def _find_source(fabric, name, uuid):
+    """Find a source by uuid, or failing that by a unique name, in the
+    registry of the fabric, then the default registry"""
+    registries = [Source.registry]
+    own = getattr(fabric, 'registry', None)
+    if own is not None:
+        registries.insert(0, own)
+    for registry in registries:
+        try:
+            return registry.get(uuid)
+        except KeyError:
+            pass
+    for registry in registries:
+        found = registry.by_name(name)
+        if len(found) == 1:
+            return found[0]
+    raise StateMismatch(f"Can't identify the source {name}")
+
+
+def replay(fabric, data):
+    """Apply the records of a journal to the matrices
+
+    Returns the length of the intact part of the journal; anything
+    after that was torn by a crash.
+    """
+    matrices = {m.name: m for m in _matrices(fabric)}
+
+    def matrix_named(name):
+        try:
+            return matrices[name]
+        except KeyError:
+            raise StateMismatch(f"No matrix named {name}") from None
+
+    good = 0
+    with _all_locked(list(matrices.values())):
+        for payload, good in _records(data):
+            for kind, name, fields, _ in _entries(payload):
+                matrix = matrix_named(name)
+                if kind == _OUTPUT:
+                    _restore_output(matrix, *fields)
+                    continue
+                idx, plugged, detail = fields
+                source = None
+                if plugged == _TRUNK:
+                    device, out = detail
+                    source = matrix_named(device).outputs[out]
+                elif plugged == _SOURCE:
+                    source = _find_source(fabric, *detail)
+                if matrix.inputs[idx] is not source:
+                    matrix.replug_input(idx, source)
+        restored = list(matrices.values())
+        for matrix in restored:
+            matrix._reachable = None
+        _restore_sources(restored)
+        for matrix in restored:
+            for idx in range(len(matrix.inputs)):
+                matrix._input_state_changed(idx)
+    return good
+
+
+def recover(fabric, path, snapshot_path=None):
+    """Restore the snapshot, if any, then replay the journal at path
+
+    A torn record at the end of the journal is cut off.
+    """
+    snapshot_path = snapshot_path or f"{path}.snap"
+    if os.path.exists(snapshot_path):
+        restore(fabric, snapshot_path)
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return
+    with open(path, 'r+b') as fh:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size = len(data)
+            good = replay(fabric, data)
+        if good != size:
+            logger.warning("Dropping %d bytes torn from %s", size - good, path)
+            fh.truncate(good)